@@ -4,9 +4,21 @@
 #include <filesystem>
 #include <algorithm>
 #include <cmath>
+#include <functional>
+#include <thread>
+#include <mutex>
+#include <condition_variable>
+#include <atomic>
+#include <memory>
+#include <cstdlib>
+#include <cctype>
+#include <unistd.h>
+#include <sys/resource.h>
 
 #include <poppler-document.h>
 #include <poppler-page.h>
+#include <poppler-page-renderer.h>
+#include <poppler-image.h>
 #include <tesseract/baseapi.h>
 #include <leptonica/allheaders.h>
 #include <nlohmann/json.hpp>
@@ -17,32 +29,218 @@ using namespace std;
 namespace fs = std::filesystem;
 
 // --- DEBUG HELPER ---
+// Batch mode logs from several threads; one line at a time
+mutex log_mutex;
 void log(string msg) {
+    lock_guard<mutex> lock(log_mutex);
     cerr << "[CPP-DEBUG] " << msg << endl;
 }
 
-// --- VISION PIPELINE: THICKEN TEXT ---
-string preprocess_image(string filepath) {
-    log("Processing image: " + filepath);
-    cv::Mat img = cv::imread(filepath);
-    if (img.empty()) {
-        log("ERROR: Could not read image file");
-        return "";
+// --- OUTPUT ---
+// Compact single-line JSON. Invalid UTF-8 from a broken PDF is replaced
+// instead of throwing and losing the whole job.
+string dump_line(const json& j) {
+    return j.dump(-1, ' ', false, json::error_handler_t::replace);
+}
+
+// Called once per PDF page, in page order: (page number, start, end, text, method).
+// start/end are character (code point) offsets into the joined content.
+using PageCallback = function<void(int, size_t, size_t, const string&, const string&)>;
+
+// PDF extraction threads per job (--threads N). 0 = one per core.
+int pdf_threads = 0;
+
+// Write intermediate OCR images to the scratch folder (--debug-images)
+bool debug_images = false;
+
+// Pages handed to a thread at a time. Small ranges keep pages finishing
+// roughly in order, so page 1 can be streamed out almost immediately.
+const int PAGE_RANGE = 4;
+
+// --- TESSERACT HANDLES ---
+// Tesseract loads its language model on Init(), which costs more than OCR-ing
+// a small receipt. Initialized instances live in a process-wide pool and
+// are reused by every pass (all rotations, every page, and every job in
+// --server / --batch mode), even though PDF page threads come and go per job.
+// TessBaseAPI is not thread-safe: a thread checks one out (TesseractLease)
+// for as long as it OCRs an image, and the pool grows to the number of
+// images OCR'd at the same time.
+class TesseractPool {
+public:
+    unique_ptr<tesseract::TessBaseAPI> acquire() {
+        {
+            lock_guard<mutex> lock(mtx);
+            if (!idle.empty()) {
+                unique_ptr<tesseract::TessBaseAPI> api = std::move(idle.back());
+                idle.pop_back();
+                return api;
+            }
+        }
+        // A failed Init is not remembered: the next acquire tries again, so a
+        // transient failure (e.g. tessdata on a share not mounted yet) doesn't
+        // disable OCR for the rest of a --server / --batch process
+        unique_ptr<tesseract::TessBaseAPI> api(new tesseract::TessBaseAPI());
+        if (api->Init(NULL, "eng")) {
+            log("ERROR: Tesseract Init failed.");
+            return nullptr;
+        }
+        // PSM 4 = Single Column (Great for receipts/invoices)
+        // PSM 6 = Single Block (Also good)
+        // We try 4 here as it handles lists well
+        api->SetPageSegMode(tesseract::PSM_SINGLE_COLUMN);
+        return api;
     }
 
-    // 1. Upscale (3x) - Keeps text shape
-    cv::resize(img, img, cv::Size(), 3.0, 3.0, cv::INTER_CUBIC);
+    void release(unique_ptr<tesseract::TessBaseAPI> api) {
+        lock_guard<mutex> lock(mtx);
+        idle.push_back(std::move(api));
+    }
 
-    // 2. Grayscale
-    cv::Mat gray;
-    if (img.channels() == 3) {
-        cv::cvtColor(img, gray, cv::COLOR_BGR2GRAY);
+private:
+    mutex mtx;
+    vector<unique_ptr<tesseract::TessBaseAPI>> idle;
+};
+
+TesseractPool tesseract_pool;
+
+// The handle this thread has checked out, if any
+thread_local tesseract::TessBaseAPI* current_tesseract = nullptr;
+
+// Checks a handle out of the pool for the current scope; nested leases on
+// the same thread share the outer one
+class TesseractLease {
+public:
+    TesseractLease() {
+        if (current_tesseract) return;
+        owned = tesseract_pool.acquire();
+        current_tesseract = owned.get();
+    }
+    ~TesseractLease() {
+        if (!owned) return;
+        current_tesseract = nullptr;
+        tesseract_pool.release(std::move(owned));
+    }
+    TesseractLease(const TesseractLease&) = delete;
+    TesseractLease& operator=(const TesseractLease&) = delete;
+
+private:
+    unique_ptr<tesseract::TessBaseAPI> owned;
+};
+
+// The leased handle (nullptr outside a TesseractLease or if Init failed)
+tesseract::TessBaseAPI* get_tesseract() {
+    return current_tesseract;
+}
+
+// --- SCALE SELECTION ---
+// Tesseract reads best at roughly this median glyph height (px)
+const double TARGET_TEXT_HEIGHT = 30.0;
+const double TARGET_DPI = 300.0;
+const double MIN_SCALE = 0.25;
+const double MAX_SCALE = 4.0;
+
+// Text height is measured on a copy no larger than this (long side, px)
+const int MEASURE_MAX_SIDE = 2000;
+
+// Fewer character-sized blobs than this and the measurement is not trusted
+const size_t MIN_GLYPHS = 20;
+
+// Below this long side an image with no usable measurement is treated as a
+// thumbnail and upscaled 3x (the old fixed behaviour)
+const int THUMBNAIL_SIDE = 1200;
+
+// Working image ceiling (--max-pixels). 40 MP of 8-bit gray = 40 MB per copy.
+long long max_pixels = 40000000LL;
+
+// Median height of character-sized ink blobs, in pixels of `gray` (0 = unsure)
+double measure_text_height(const cv::Mat& gray) {
+    double factor = (double)max(gray.cols, gray.rows) / MEASURE_MAX_SIDE;
+    cv::Mat probe = factor > 1.0 ? cv::Mat() : gray;
+    if (factor > 1.0) {
+        cv::resize(gray, probe, cv::Size(), 1.0 / factor, 1.0 / factor, cv::INTER_AREA);
     } else {
-        gray = img;
+        factor = 1.0;
+    }
+
+    cv::Mat ink, labels, stats, centroids;
+    cv::threshold(probe, ink, 0, 255, cv::THRESH_BINARY_INV | cv::THRESH_OTSU);
+    int n = cv::connectedComponentsWithStats(ink, labels, stats, centroids, 8);
+
+    vector<int> heights;
+    for (int i = 1; i < n; ++i) {
+        int w = stats.at<int>(i, cv::CC_STAT_WIDTH);
+        int h = stats.at<int>(i, cv::CC_STAT_HEIGHT);
+        // Not specks, and not rules, borders or photos
+        if (h < 4 || h > probe.rows / 8 || w > h * 3) continue;
+        heights.push_back(h);
+    }
+    if (heights.size() < MIN_GLYPHS) return 0;
+    nth_element(heights.begin(), heights.begin() + heights.size() / 2, heights.end());
+    return heights[heights.size() / 2] * factor;
+}
+
+// DPI from the file header; 72/96 are mostly placeholder values, so ignored
+double read_dpi(string filepath) {
+    // Header only: the image itself is already decoded (cv::imread)
+    l_int32 format = IFF_UNKNOWN;
+    if (findFileFormat(filepath.c_str(), &format)) return 0;
+    FILE* fp = fopen(filepath.c_str(), "rb");
+    if (!fp) return 0;
+    l_int32 xres = 0, yres = 0;
+    if (format == IFF_JFIF_JPEG) fgetJpegResolution(fp, &xres, &yres);
+    else if (format == IFF_PNG) fgetPngResolution(fp, &xres, &yres);
+    else if (L_FORMAT_IS_TIFF(format)) getTiffResolution(fp, &xres, &yres);
+    fclose(fp);
+    return (xres >= 100 && xres <= 1200) ? xres : 0;
+}
+
+// Upscale factor from the measured text height, else the DPI, else the
+// image size; then capped so the working image stays under max_pixels.
+// known_dpi: set for rendered PDF pages; otherwise read from the file header
+double choose_scale(string filepath, double known_dpi, const cv::Mat& gray, json& debug_info) {
+    double scale = 1.0;
+    string source = "default";
+    double text_height = measure_text_height(gray);
+    if (text_height > 0) {
+        scale = TARGET_TEXT_HEIGHT / text_height;
+        source = "text_height";
+        debug_info["text_height_px"] = text_height;
+    } else if (double dpi = known_dpi > 0 ? known_dpi : read_dpi(filepath)) {
+        scale = TARGET_DPI / dpi;
+        source = "dpi";
+        debug_info["dpi"] = dpi;
+    } else if (max(gray.cols, gray.rows) < THUMBNAIL_SIDE) {
+        scale = 3.0;
+        source = "thumbnail";
+    }
+    scale = min(MAX_SCALE, max(MIN_SCALE, scale));
+
+    double pixels = (double)gray.cols * gray.rows;
+    if (pixels * scale * scale > max_pixels) {
+        scale = sqrt(max_pixels / pixels);
+        debug_info["capped"] = true;
+    }
+    debug_info["scale"] = round(scale * 100) / 100;
+    debug_info["scale_source"] = source;
+    return scale;
+}
+
+// --- VISION PIPELINE: THICKEN TEXT ---
+// Binarizes an 8-bit gray image in memory. filepath/known_dpi only feed
+// the DPI fallback of choose_scale.
+cv::Mat preprocess_gray(cv::Mat gray, string filepath, double known_dpi, json& debug_info) {
+    debug_info["input_size"] = {gray.cols, gray.rows};
+
+    // 2. Resize to a readable text height - cubic up (keeps text shape), area down
+    double scale = choose_scale(filepath, known_dpi, gray, debug_info);
+    if (fabs(scale - 1.0) > 0.05) {
+        cv::resize(gray, gray, cv::Size(), scale, scale, scale > 1.0 ? cv::INTER_CUBIC : cv::INTER_AREA);
     }
+    debug_info["working_size"] = {gray.cols, gray.rows};
+    debug_info["image_mb"] = round(gray.total() * gray.elemSize() / 1e5) / 10;
 
     // 3. ADAPTIVE THRESHOLD (Tuned for Receipts)
-    // BlockSize=31 (Larger area to ignore paper texture)
+    // BlockSize=31 (Larger area to ignore paper texture; ~1 line at TARGET_TEXT_HEIGHT)
     // C=15 (Higher contrast requirement to drop background noise)
     cv::Mat binary;
     cv::adaptiveThreshold(gray, binary, 255, 
@@ -54,59 +252,66 @@ string preprocess_image(string filepath) {
     // This connects broken lines in thin fonts.
     cv::Mat kernel = cv::getStructuringElement(cv::MORPH_RECT, cv::Size(2, 2));
     cv::erode(binary, binary, kernel);
+    return binary;
+}
+
+// Returns the binarized image in memory (empty if the file can't be read).
+cv::Mat preprocess_image(string filepath, json& debug_info) {
+    log("Processing image: " + filepath);
+    cv::Mat img = cv::imread(filepath);
+    if (img.empty()) {
+        log("ERROR: Could not read image file");
+        return img;
+    }
 
-    string temp_path = "output/temp_processed.png";
-    fs::create_directories("output");
-    cv::imwrite(temp_path, binary);
-    log("Saved preprocessed image to: " + temp_path);
-    return temp_path;
+    // 1. Grayscale first, so the resize moves 1 channel, not 3
+    cv::Mat gray;
+    if (img.channels() == 3) {
+        cv::cvtColor(img, gray, cv::COLOR_BGR2GRAY);
+    } else {
+        gray = img;
+    }
+    img.release();
+    return preprocess_gray(gray, filepath, 0, debug_info);
 }
 
-// --- ROTATION HELPER ---
-void rotate_90(string input_path, string output_path) {
-    cv::Mat src = cv::imread(input_path);
-    if (src.empty()) return;
-    cv::Mat dst;
-    cv::rotate(src, dst, cv::ROTATE_90_CLOCKWISE);
-    cv::imwrite(output_path, dst);
+// --- IMAGE HELPERS ---
+cv::Mat rotate_cw(const cv::Mat& img, int quarter_turns) {
+    cv::Mat out;
+    switch (quarter_turns % 4) {
+        case 1: cv::rotate(img, out, cv::ROTATE_90_CLOCKWISE); break;
+        case 2: cv::rotate(img, out, cv::ROTATE_180); break;
+        case 3: cv::rotate(img, out, cv::ROTATE_90_COUNTERCLOCKWISE); break;
+        default: out = img;
+    }
+    return out;
 }
 
-// --- EXTRACTORS ---
+cv::Mat downscale_to(const cv::Mat& img, int max_side) {
+    double scale = (double)max_side / max(img.cols, img.rows);
+    if (scale >= 1.0) return img;
+    cv::Mat out;
+    cv::resize(img, out, cv::Size(), scale, scale, cv::INTER_AREA);
+    return out;
+}
 
-string extract_pdf(string filepath) {
-    string full_text = "";
-    poppler::document* doc = poppler::document::load_from_file(filepath);
-    if (!doc) return "";
-    int pages = doc->pages();
-    for (int i = 0; i < pages; ++i) {
-        poppler::page* p = doc->create_page(i);
-        if (p) {
-            std::vector<char> bytes = p->text().to_utf8();
-            full_text.append(bytes.begin(), bytes.end());
-            full_text += "\n";
-            delete p;
-        }
-    }
-    delete doc;
-    return full_text;
+// Only with --debug-images (or "debug_images" in a server job)
+string save_debug_image(string scratch_dir, string name, const cv::Mat& img) {
+    fs::create_directories(scratch_dir);
+    string path = scratch_dir + "/debug_" + name + ".png";
+    cv::imwrite(path, img);
+    return path;
 }
 
-string run_tesseract(string image_path, int* confidence_out) {
-    tesseract::TessBaseAPI* api = new tesseract::TessBaseAPI();
-    if (api->Init(NULL, "eng")) { 
-        log("ERROR: Tesseract Init failed.");
-        return "";
-    }
-    
-    // PSM 4 = Single Column (Great for receipts/invoices)
-    // PSM 6 = Single Block (Also good)
-    // We try 4 here as it handles lists well
-    api->SetPageSegMode(tesseract::PSM_SINGLE_COLUMN);
+// --- EXTRACTORS ---
 
-    Pix* image = pixRead(image_path.c_str());
-    if (!image) return "";
+// OCR straight from the cv::Mat buffer (8-bit gray or BGR), no temp file
+string run_tesseract(const cv::Mat& img, int* confidence_out) {
+    tesseract::TessBaseAPI* api = get_tesseract();
+    if (!api || img.empty()) return "";
 
-    api->SetImage(image);
+    api->SetImage(img.data, img.cols, img.rows, img.channels(), (int)img.step);
+    api->SetSourceResolution(300);
     
     char* outText = api->GetUTF8Text();
     string result = "";
@@ -117,96 +322,499 @@ string run_tesseract(string image_path, int* confidence_out) {
     
     *confidence_out = api->MeanTextConf();
     
-    api->End();
-    delete api;
-    pixDestroy(&image);
+    // Drop the page results but keep the loaded model for the next pass
+    api->Clear();
     return result;
 }
 
-string extract_image_ocr(string filepath, json &debug_info) {
-    string current_image = preprocess_image(filepath);
-    if (current_image == "") return "";
-    
+// --- ORIENTATION SEARCH ---
+// A full pass at or above this mean confidence is accepted and ends the
+// search; an upright receipt needs exactly one pass.
+const int ACCEPT_CONF = 60;
+
+// OSD answers below this confidence are ignored (too little text to judge)
+const float OSD_MIN_CONF = 1.5f;
+
+// Long side of the downscaled copies used for OSD and rotation probes
+const int PROBE_MAX_SIDE = 1000;
+
+const string ROT_NAMES[] = {"0_deg", "90_deg", "180_deg", "270_deg"};
+
+// Tesseract OSD on a downscaled copy. Returns the clockwise quarter turns
+// that make the image upright, or -1 if OSD is unavailable or unsure
+// (it needs osd.traineddata next to the language model).
+int detect_orientation(const cv::Mat& img, json& debug_info) {
+    tesseract::TessBaseAPI* api = get_tesseract();
+    if (!api) return -1;
+
+    cv::Mat probe = downscale_to(img, PROBE_MAX_SIDE);
+    api->SetPageSegMode(tesseract::PSM_OSD_ONLY);
+    api->SetImage(probe.data, probe.cols, probe.rows, probe.channels(), (int)probe.step);
+    api->SetSourceResolution(300);
+    int orient_deg = 0;
+    float orient_conf = 0;
+    const char* script = nullptr;
+    float script_conf = 0;
+    bool ok = api->DetectOrientationScript(&orient_deg, &orient_conf, &script, &script_conf);
+    api->Clear();
+    api->SetPageSegMode(tesseract::PSM_SINGLE_COLUMN);
+
+    if (!ok) {
+        debug_info["osd"] = "unavailable";
+        return -1;
+    }
+    debug_info["osd"]["degrees"] = orient_deg;
+    debug_info["osd"]["conf"] = orient_conf;
+    if (orient_conf < OSD_MIN_CONF) return -1;
+    // orient_deg is how far the page is rotated clockwise; turn it back
+    return ((360 - orient_deg) % 360) / 90;
+}
+
+// Re-orders order[from:] by OCR confidence on small copies, best first
+void rank_by_probe(const cv::Mat& img, vector<int>& order, size_t from, json& debug_info) {
+    cv::Mat probe = downscale_to(img, PROBE_MAX_SIDE);
+    vector<pair<int, int>> scored;  // (confidence, quarter turns)
+    for (size_t i = from; i < order.size(); ++i) {
+        int conf = 0;
+        run_tesseract(rotate_cw(probe, order[i]), &conf);
+        debug_info["rotations"][ROT_NAMES[order[i]]]["probe_conf"] = conf;
+        scored.push_back({conf, order[i]});
+    }
+    stable_sort(scored.begin(), scored.end(), [](const pair<int, int>& a, const pair<int, int>& b) {
+        return a.first > b.first;
+    });
+    for (size_t i = 0; i < scored.size(); ++i) order[from + i] = scored[i].second;
+}
+
+// Orientation search + OCR on an already preprocessed image
+string ocr_image(const cv::Mat& base, string scratch_dir, json &debug_info, bool save_debug) {
+    TesseractLease tesseract;  // One warm handle for every pass on this image
+    if (save_debug) debug_info["preprocessed_image"] = save_debug_image(scratch_dir, "preprocessed", base);
+
+    // Try OSD's answer first, then upright, then the rest
+    vector<int> order;
+    int detected = detect_orientation(base, debug_info);
+    if (detected >= 0) order.push_back(detected);
+    for (int k = 0; k < 4; ++k) {
+        if (k != detected) order.push_back(k);
+    }
+
     string best_text = "";
     int best_conf = -1;
-    string best_img = "";
-
-    // ROTATION LOOP
-    int rot_codes[] = {-1, 0, 1, 2}; // Just indices for tracking
-    string rot_names[] = {"0_deg", "90_deg", "180_deg", "270_deg"};
-
-    for (int i = 0; i < 4; i++) {
-        // Save rotation step
-        string current_rot_path = "output/debug_" + rot_names[i] + ".png";
-        
-        if (i == 0) {
-            // 0 deg: Just copy base
-            cv::Mat temp = cv::imread(current_image);
-            cv::imwrite(current_rot_path, temp);
-        } else {
-            // Rotate previous result
-            rotate_90(current_image, current_image); 
-            cv::Mat temp = cv::imread(current_image);
-            cv::imwrite(current_rot_path, temp);
-        }
+    int best_rot = -1;
+    int passes = 0;
+    bool probed = false;
 
+    for (size_t n = 0; n < order.size(); ++n) {
+        int k = order[n];
+        cv::Mat rotated = rotate_cw(base, k);
         int conf = 0;
-        string text = run_tesseract(current_image, &conf);
-        
-        debug_info["rotations"][rot_names[i]]["path"] = current_rot_path;
-        debug_info["rotations"][rot_names[i]]["conf"] = conf;
+        string text = run_tesseract(rotated, &conf);
+        passes++;
+
+        debug_info["rotations"][ROT_NAMES[k]]["conf"] = conf;
+        if (save_debug) debug_info["rotations"][ROT_NAMES[k]]["path"] = save_debug_image(scratch_dir, ROT_NAMES[k], rotated);
 
         // Logic: Prefer text with length AND confidence
         if (conf > best_conf && text.length() > 20) {
             best_conf = conf;
             best_text = text;
-            best_img = current_rot_path;
+            best_rot = k;
+        }
+        if (best_conf >= ACCEPT_CONF) break;
+
+        // The first guess was not good enough: rank the others cheaply
+        // so the next full pass is the most likely one
+        if (!probed && n + 2 < order.size()) {
+            rank_by_probe(base, order, n + 1, debug_info);
+            probed = true;
         }
     }
-    
-    if (best_img != "") debug_info["best_image"] = best_img;
-    else debug_info["best_image"] = "output/debug_0_deg.png"; // Default
 
+    debug_info["ocr_passes"] = passes;
+    debug_info["best_rotation"] = best_rot >= 0 ? ROT_NAMES[best_rot] : "none";
+    debug_info["conf"] = best_conf;
     return best_text;
 }
 
-// --- MAIN ---
-int main(int argc, char* argv[]) {
-    if (argc < 2) return 1;
-    string file_path = argv[1];
-    
+string extract_image_ocr(string filepath, string scratch_dir, json &debug_info, bool save_debug) {
+    cv::Mat base = preprocess_image(filepath, debug_info["preprocess"]);
+    if (base.empty()) return "";
+    return ocr_image(base, scratch_dir, debug_info, save_debug);
+}
+
+// --- PDF EXTRACTION ---
+// Pages whose text layer has fewer visible characters than this per square
+// inch are treated as scanned and OCR'd (~47 chars on a Letter page)
+const double MIN_TEXT_DENSITY = 0.5;
+
+// Resolution scanned pages are rendered at for OCR
+const double RENDER_DPI = 300.0;
+
+size_t utf8_length(const string& text) {
+    size_t n = 0;
+    for (unsigned char c : text) {
+        if ((c & 0xC0) != 0x80) n++;
+    }
+    return n;
+}
+
+size_t visible_chars(const string& text) {
+    size_t n = 0;
+    for (unsigned char c : text) {
+        if ((c & 0xC0) != 0x80 && !isspace(c)) n++;
+    }
+    return n;
+}
+
+// OCR of one page rendered through poppler (gray, RENDER_DPI). "" if the
+// page can't be rendered (poppler built without a renderer).
+string ocr_pdf_page(poppler::page* p, string scratch_dir, json& page_debug, bool save_debug) {
+    if (!poppler::page_renderer::can_render()) return "";
+    poppler::page_renderer renderer;
+    renderer.set_image_format(poppler::image::format_gray8);
+    renderer.set_render_hints(poppler::page_renderer::antialiasing | poppler::page_renderer::text_antialiasing);
+    poppler::image img = renderer.render_page(p, RENDER_DPI, RENDER_DPI);
+    if (!img.is_valid()) return "";
+
+    // Wraps poppler's buffer (no copy); preprocess_gray makes its own copies
+    cv::Mat gray(img.height(), img.width(), CV_8UC1, (void*)img.const_data(), img.bytes_per_row());
+    cv::Mat base = preprocess_gray(gray, "", RENDER_DPI, page_debug["preprocess"]);
+    return ocr_image(base, scratch_dir, page_debug, save_debug);
+}
+
+// Text of one page: the text layer, or OCR when the layer is too sparse
+// (scanned page). method is "text_layer" or "ocr".
+string extract_pdf_page(poppler::document* doc, int index, string scratch_dir, json& page_debug,
+                        string& method, bool save_debug) {
+    method = "text_layer";
+    poppler::page* p = doc->create_page(index);
+    if (!p) return "";
+    std::vector<char> bytes = p->text().to_utf8();
+    string text(bytes.begin(), bytes.end());
+
+    poppler::rectf box = p->page_rect();
+    double square_inches = max(1.0, box.width() * box.height() / (72.0 * 72.0));
+    double density = visible_chars(text) / square_inches;
+    if (density < MIN_TEXT_DENSITY) {
+        page_debug["text_density"] = round(density * 100) / 100;
+        string ocr_text = ocr_pdf_page(p, scratch_dir + "/page_" + to_string(index + 1), page_debug, save_debug);
+        // Keep whichever found more (a sparse but real text layer can beat bad OCR)
+        if (visible_chars(ocr_text) > visible_chars(text)) {
+            text = ocr_text;
+            method = "ocr";
+        }
+    }
+    delete p;
+    return text;
+}
+
+// Extracts page ranges on several threads and hands the pages to on_page
+// in order, as soon as each one (and every page before it) is done.
+// Scanned pages are OCR'd on the same threads with a Tesseract handle
+// from the pool, so only those pages pay for OCR.
+// poppler::document is not thread-safe, so every thread opens its own.
+// Content layout: every page's text followed by "\n".
+string extract_pdf(string filepath, string scratch_dir, vector<size_t>& page_starts,
+                   vector<string>& page_methods, json& debug_info, const PageCallback& on_page,
+                   bool save_debug) {
+    poppler::document* doc = poppler::document::load_from_file(filepath);
+    if (!doc) return "";
+    int pages = doc->pages();
+
+    int threads = pdf_threads > 0 ? pdf_threads : (int)max(1u, thread::hardware_concurrency());
+    threads = max(1, min(threads, (pages + PAGE_RANGE - 1) / PAGE_RANGE));
+    log("Extracting " + to_string(pages) + " pages on " + to_string(threads) + " threads");
+
+    // One slot per page, each written by exactly one thread
+    vector<string> texts(pages);
+    vector<string> methods(pages);
+    vector<json> page_debug(pages);
+    vector<char> ready(pages, 0);
+    mutex ready_mutex;
+    condition_variable page_done;
+    atomic<int> next_page(0);
+
+    auto work = [&](poppler::document* d) {
+        while (true) {
+            int first = next_page.fetch_add(PAGE_RANGE);
+            if (first >= pages) break;
+            int last = min(first + PAGE_RANGE, pages);
+            for (int i = first; i < last; ++i) {
+                string text;
+                string method = "text_layer";
+                try {
+                    text = extract_pdf_page(d, i, scratch_dir, page_debug[i], method, save_debug);
+                } catch (...) { log("ERROR: page " + to_string(i + 1)); }
+                {
+                    lock_guard<mutex> lock(ready_mutex);
+                    texts[i] = std::move(text);
+                    methods[i] = method;
+                    ready[i] = 1;
+                }
+                page_done.notify_all();
+            }
+        }
+    };
+
+    // Thread 0 uses the document we already have; if another thread can't
+    // open its own copy it just takes no ranges and the others cover them.
+    vector<thread> pool;
+    vector<poppler::document*> copies;
+    for (int t = 0; t < threads; ++t) {
+        poppler::document* d = t == 0 ? doc : poppler::document::load_from_file(filepath);
+        if (!d) continue;
+        if (t > 0) copies.push_back(d);
+        pool.emplace_back(work, d);
+    }
+
+    string full_text = "";
+    size_t offset = 0;
+    for (int i = 0; i < pages; ++i) {
+        string text;
+        {
+            unique_lock<mutex> lock(ready_mutex);
+            page_done.wait(lock, [&] { return ready[i] != 0; });
+            text = std::move(texts[i]);
+        }
+        size_t length = utf8_length(text);
+        page_starts.push_back(offset);
+        page_methods.push_back(methods[i]);
+        if (on_page) {
+            on_page(i + 1, offset, offset + length, text, methods[i]);
+        } else {
+            full_text += text;
+            full_text += "\n";
+        }
+        offset += length + 1;
+    }
+
+    for (auto& t : pool) t.join();
+    for (auto* d : copies) delete d;
+    delete doc;
+
+    // OCR details, only for the pages that needed it
+    for (int i = 0; i < pages; ++i) {
+        if (!page_debug[i].is_null()) debug_info["ocr_pages"][to_string(i + 1)] = page_debug[i];
+    }
+    return full_text;
+}
+
+// --- JOB RUNNER ---
+// With on_page set, PDF pages are streamed through it and "content" is left
+// out of the result (the caller joins the pages, see docproc_pool.py).
+json process_file(string file_path, string scratch_dir, const PageCallback& on_page = nullptr,
+                  bool save_debug = false) {
     if (!fs::exists(file_path)) {
-        json err; err["status"] = "error"; 
-        cout << err.dump(4) << endl; 
-        return 1;
+        json err; err["status"] = "error";
+        err["filepath"] = file_path;
+        return err;
     }
-    
-    fs::create_directories("output");
+
     string extension = fs::path(file_path).extension().string();
     transform(extension.begin(), extension.end(), extension.begin(), ::tolower);
 
     string extracted_text = "";
     string method = "";
     json debug_info;
+    vector<size_t> page_starts;
+    vector<string> page_methods;
+    bool streamed = false;
 
     try {
         if (extension == ".pdf") {
-            method = "PDF_POPPLER";
-            extracted_text = extract_pdf(file_path);
+            streamed = (bool)on_page;
+            extracted_text = extract_pdf(file_path, scratch_dir, page_starts, page_methods, debug_info,
+                                         on_page, save_debug);
+            size_t ocr_pages = count(page_methods.begin(), page_methods.end(), "ocr");
+            method = ocr_pages == 0 ? "PDF_POPPLER"
+                   : ocr_pages == page_methods.size() ? "PDF_OCR" : "PDF_HYBRID";
         } 
         else {
             method = "OCR_THICKENED";
-            extracted_text = extract_image_ocr(file_path, debug_info);
+            extracted_text = extract_image_ocr(file_path, scratch_dir, debug_info, save_debug);
         }
     } catch (...) { extracted_text = ""; }
 
+    // This job's largest working image (the image itself, or the biggest OCR'd page)
+    double image_mb = debug_info.value("image_mb", 0.0);
+    if (debug_info.contains("ocr_pages")) {
+        for (auto& page : debug_info["ocr_pages"]) image_mb = max(image_mb, page.value("image_mb", 0.0));
+    }
+    debug_info["job_image_mb"] = image_mb;
+
+    // High-water mark of the whole process since it started (Tesseract, every
+    // batch thread, every earlier job in --server / --batch mode)
+    struct rusage usage;
+    getrusage(RUSAGE_SELF, &usage);
+    debug_info["process_peak_rss_mb"] = usage.ru_maxrss / 1024;
+
     json output;
     output["status"] = "success";
     output["method"] = method;
-    output["content"] = extracted_text;
+    if (!streamed) output["content"] = extracted_text;
+    if (!page_starts.empty()) {
+        output["pages"] = page_starts.size();
+        output["page_starts"] = page_starts;
+        output["page_methods"] = page_methods;
+    }
     output["filepath"] = file_path;
     output["debug"] = debug_info;
+    return output;
+}
+
+// --- PAGE STREAM ---
+// Prints each page as its own line; endl flushes, so the reader gets
+// page 1 while later pages are still being extracted.
+PageCallback page_printer(json id) {
+    return [id](int page, size_t start, size_t end, const string& text, const string& method) {
+        json line;
+        if (!id.is_null()) line["id"] = id;
+        line["event"] = "page";
+        line["page"] = page;
+        line["start"] = start;
+        line["end"] = end;
+        line["method"] = method;
+        line["text"] = text;
+        cout << dump_line(line) << endl;
+    };
+}
+
+// --- SCRATCH SPACE ---
+// Nothing is written during normal OCR; only debug images need a folder.
+// Every job gets its own under output/docproc_<pid>/, so concurrent jobs
+// and concurrent docproc processes never share a file.
+string scratch_root() {
+    return "output/docproc_" + to_string(getpid());
+}
+
+string job_scratch(size_t job) {
+    return scratch_root() + "/job_" + to_string(job);
+}
+
+// --- SERVER MODE ---
+// Reads one JSON job per line on stdin: {"id": 1, "path": "output/a.pdf"}
+// Writes compact JSON lines on stdout, all echoing the "id":
+//   PDFs first stream one line per page as it is extracted:
+//     {"id": 1, "event": "page", "page": 1, "start": 0, "end": 1834, "method": "text_layer", "text": "..."}
+//   ("method" is "ocr" for scanned pages that were rendered and OCR'd)
+//   then every job ends with one result line (no "event" key).
+// Tesseract stays loaded between jobs; EOF on stdin shuts the worker down.
+int run_server() {
+    log("Server ready (scratch: " + scratch_root() + ")");
+
+    size_t jobs = 0;
+    bool kept_debug = debug_images;
+    string line;
+    while (getline(cin, line)) {
+        if (line.empty()) continue;
 
-    cout << output.dump(4) << endl;
+        json output;
+        json request;
+        try {
+            request = json::parse(line);
+        } catch (...) {
+            output["status"] = "error";
+            output["error"] = "Invalid JSON request";
+            cout << dump_line(output) << endl;
+            continue;
+        }
+
+        json id = request.contains("id") ? request["id"] : json();
+        bool save_debug = request.value("debug_images", debug_images);
+        kept_debug = kept_debug || save_debug;
+        output = process_file(request.value("path", ""), job_scratch(jobs++), page_printer(id), save_debug);
+        if (request.contains("id")) output["id"] = request["id"];
+        cout << dump_line(output) << endl;
+    }
+
+    // Debug images were asked for, so they outlive the worker
+    if (!kept_debug) fs::remove_all(scratch_root());
     return 0;
-}
\ No newline at end of file
+}
+
+// --- BATCH MODE ---
+// docproc --batch a.jpg b.pdf ...   (no files = read paths from stdin, one per line)
+// Processes the files on a thread pool sized to the cores (--jobs N), one
+// Tesseract instance per thread, and prints each result as one compact JSON
+// line as soon as it is done; "index" is the file's position in the input.
+// PDFs are not page-streamed here; their result carries the full content.
+int run_batch(vector<string> paths, int jobs) {
+    if (paths.empty()) {
+        string line;
+        while (getline(cin, line)) {
+            if (!line.empty()) paths.push_back(line);
+        }
+    }
+    int workers = jobs > 0 ? jobs : (int)max(1u, thread::hardware_concurrency());
+    workers = max(1, min(workers, (int)paths.size()));
+
+    // The files are the parallelism: keep each library single-threaded so
+    // N workers don't each start N threads of their own
+    if (pdf_threads == 0) pdf_threads = 1;
+    setenv("OMP_THREAD_LIMIT", "1", 0);
+    cv::setNumThreads(1);
+    log("Batch: " + to_string(paths.size()) + " files on " + to_string(workers) + " threads");
+
+    atomic<size_t> next_file(0);
+    atomic<int> failed(0);
+    mutex out_mutex;
+    auto work = [&]() {
+        while (true) {
+            size_t i = next_file.fetch_add(1);
+            if (i >= paths.size()) break;
+            json output = process_file(paths[i], job_scratch(i), nullptr, debug_images);
+            output["index"] = i;
+            if (output["status"] != "success") failed++;
+            string line = dump_line(output);
+            lock_guard<mutex> lock(out_mutex);
+            cout << line << endl;
+        }
+    };
+    vector<thread> pool;
+    for (int t = 0; t < workers; ++t) pool.emplace_back(work);
+    for (auto& t : pool) t.join();
+
+    if (!debug_images) fs::remove_all(scratch_root());
+    return failed ? 1 : 0;
+}
+
+// --- MAIN ---
+// Options: --threads N (PDF threads), --jobs N (batch threads),
+//          --max-pixels N (OCR image ceiling), --debug-images
+// docproc [options] <file>      page lines + result line (same format as --server)
+// docproc [options] --server
+// docproc [options] --batch [files...]
+int main(int argc, char* argv[]) {
+    vector<string> args(argv + 1, argv + argc);
+    int jobs = 0;
+    while (!args.empty()) {
+        if (args[0] == "--threads" && args.size() >= 2) {
+            pdf_threads = atoi(args[1].c_str());
+            args.erase(args.begin(), args.begin() + 2);
+        } else if (args[0] == "--jobs" && args.size() >= 2) {
+            jobs = atoi(args[1].c_str());
+            args.erase(args.begin(), args.begin() + 2);
+        } else if (args[0] == "--max-pixels" && args.size() >= 2) {
+            max_pixels = atoll(args[1].c_str());
+            args.erase(args.begin(), args.begin() + 2);
+        } else if (args[0] == "--debug-images") {
+            debug_images = true;
+            args.erase(args.begin());
+        } else {
+            break;
+        }
+    }
+    if (args.empty()) return 1;
+    string file_path = args[0];
+
+    if (file_path == "--server") return run_server();
+    if (file_path == "--batch") return run_batch(vector<string>(args.begin() + 1, args.end()), jobs);
+
+    // Single file: one JSON result with the full content, no page lines
+    json output = process_file(file_path, job_scratch(0), nullptr, debug_images);
+    if (!debug_images) fs::remove_all(scratch_root());
+
+    cout << dump_line(output) << endl;
+    return output["status"] == "success" ? 0 : 1;
+}
@@ -3,14 +3,19 @@ import pandas as pd
 import os
 import json
 import time
-import hashlib
-import subprocess
 import psutil
 import re
 from datetime import datetime
 from llm_engine import DocumentBrain
+from llm_cache import get_default_cache
 from db_engine import DatabaseEngine
 from ui_engine import UIEngine
+from ingest_pipeline import plan_uploads
+from job_queue import JobQueue
+from mathguard_engine import verify_all
+from redaction_engine import redact_document, export_redacted_corpus
+from context_packer import pack_context
+import migrations
 from streamlit_option_menu import option_menu
 
 # 1. CONFIG
@@ -21,83 +26,106 @@ UIEngine.setup_page()
 if 'page' not in st.session_state: st.session_state['page'] = "Documents"
 if 'chat_history' not in st.session_state: st.session_state['chat_history'] = []
 if 'active_filename' not in st.session_state: st.session_state['active_filename'] = None
+if 'ingest_batches' not in st.session_state: st.session_state['ingest_batches'] = []
+
+# Documents page: rows per keyset page
+DOC_PAGE_SIZE = 25
+
+# Prompt budgets for retrieved context (see context_packer.py)
+CHAT_CONTEXT_TOKENS = 1500
+GLOBAL_CONTEXT_TOKENS = 3000
 
 # --- HELPERS ---
-def get_file_hash(file_bytes):
-    return hashlib.md5(file_bytes).hexdigest()
+@st.cache_resource
+def get_db():
+    # One DatabaseEngine per server: shared SQL pool + Chroma client,
+    # each rerun works in its own scoped session
+    return DatabaseEngine()
 
-def safe_float(val):
-    if val is None: return 0.0
-    try:
-        clean_str = str(val).replace('$', '').replace(',', '').strip()
-        if clean_str.lower() == 'none' or clean_str == '': return 0.0
-        return float(clean_str)
-    except ValueError: return 0.0
+@st.cache_resource
+def run_migrations():
+    # Backfills new columns / the chunk index on existing rows (resumable, runs once per server)
+    return migrations.run_all(get_db())
+
+@st.cache_resource
+def get_job_queue():
+    # Uploads are queued here and processed by ingest_worker.py
+    return JobQueue()
+
+def record_chat_metrics(metrics):
+    # Last 50 streamed answers of this session, for the sidebar latency readout
+    if metrics.get('ttft_ms') is None or metrics.get('total_ms') is None:
+        return
+    history = st.session_state.setdefault('chat_metrics', [])
+    history.append(metrics)
+    del history[:-50]
 
 def render_system_stats():
     cpu = psutil.cpu_percent()
     ram = psutil.virtual_memory().percent
     st.sidebar.caption(f"SYSTEM HEALTH: CPU {cpu}% | RAM {ram}%")
     st.sidebar.progress(cpu / 100)
+    cache = get_default_cache().stats()
+    st.sidebar.caption(f"LLM CACHE: {cache['hits']} hits | {cache['misses']} misses | {cache['entries']} entries")
+    chat_metrics = st.session_state.get('chat_metrics')
+    if chat_metrics:
+        ttft = sorted(m['ttft_ms'] for m in chat_metrics)[len(chat_metrics) // 2]
+        total = sorted(m['total_ms'] for m in chat_metrics)[len(chat_metrics) // 2]
+        st.sidebar.caption(f"CHAT LATENCY (p50): first token {ttft:.0f} ms | answer {total:.0f} ms")
 
 # --- MODAL: UPLOAD DIALOG ---
 @st.dialog("Add New Document")
 def render_upload_modal():
-    st.write("Upload PDF, JPG, or CSV files to your workspace.")
+    st.write("Upload PDF, JPG, or CSV files (also zipped or gzipped) to your workspace.")
     uploaded_files = st.file_uploader("Drag & drop files here", accept_multiple_files=True, label_visibility="collapsed")
     
     if uploaded_files:
         if st.button("🚀 Process Files", use_container_width=True):
-            progress_bar = st.progress(0)
-            status = st.empty()
-            os.makedirs("output", exist_ok=True)
-            db = DatabaseEngine()
-            
-            for i, f in enumerate(uploaded_files):
-                status.text(f"Processing {f.name}...")
-                bytes_data = f.getvalue()
-                file_hash = get_file_hash(bytes_data)
-                save_path = os.path.join("output", f.name)
-                with open(save_path, "wb") as out: out.write(bytes_data)
-                
-                if db.check_file_hash(file_hash):
-                    status.info(f"Skipped {f.name} (Cached)")
-                    continue
-
-                try:
-                    # HYBRID PIPELINE (C++ / Pandas)
-                    raw_text = ""
-                    cpp_data = {}
-                    if f.name.lower().endswith('.csv'):
-                        df = pd.read_csv(save_path)
-                        raw_text = df.head(1000).to_markdown(index=False)
-                        cpp_data = {"method": "CSV"}
-                    else:
-                        result = subprocess.run(["./build/docproc", save_path], capture_output=True, text=True)
-                        if result.returncode == 0:
-                            cpp_data = json.loads(result.stdout)
-                            raw_text = cpp_data.get('content', '')
-                        else:
-                            st.error(f"Engine failed on {f.name}")
-                            continue
-                    
-                    # AI Analysis
-                    brain = DocumentBrain()
-                    ai_data = brain.analyze_document(raw_text)
-                    db.save_document(f.name, save_path, raw_text, ai_data, cpp_data, file_hash)
-                    
-                except Exception as e:
-                    st.error(f"Error: {e}")
-                
-                progress_bar.progress((i + 1) / len(uploaded_files))
-            
-            status.success("Upload Complete!")
+            # 1. Hash everything, skip known / already queued files before any disk write
+            jobs, skipped_names = plan_uploads(get_db(), uploaded_files, job_queue=get_job_queue())
+            if skipped_names:
+                st.info(f"Skipped {len(skipped_names)} cached file(s)")
+
+            # 2. Hand the rest to the ingest worker(s); progress is polled on the page
+            if jobs:
+                batch_id, _ = get_job_queue().enqueue(jobs)
+                st.session_state['ingest_batches'].append(batch_id)
             time.sleep(1)
             st.rerun()
+
+@st.fragment(run_every=2)
+def render_ingest_status():
+    # Polls the job queue for this session's uploads; the work happens in ingest_worker.py
+    report = st.session_state.get('ingest_report')
+    if report:
+        for f in report['failures']:
+            st.error(f"Error on {f['filename']} ({f['stage']}): {f['error']}")
+        if st.button("Dismiss", key="dismiss_ingest_report"):
+            st.session_state['ingest_report'] = None
+            st.rerun(scope="fragment")
+    batches = st.session_state['ingest_batches']
+    if not batches:
+        return
+    status = get_job_queue().status(batches)
+    finished = status['done'] + status['failed']
+    if status['queued'] + status['running']:
+        st.progress(finished / max(status['total'], 1),
+                    text=f"Processing uploads: {finished}/{status['total']} done, {status['running']} running")
+        if not status['active_workers']:
+            st.caption("Waiting for an ingest worker: `python src/python/ingest_worker.py run`")
+        return
+    # All done: keep the errors on screen, reload the page for the new documents
+    st.session_state['ingest_batches'] = []
+    st.session_state['ingest_report'] = status if status['failures'] else None
+    if status['done']:
+        st.toast(f"Processed {status['done']} file(s)")
+    st.rerun()
 # ========================================================
 # 🛑 END OF MODAL FUNCTION. DO NOT INDENT CODE BELOW THIS.
 # ========================================================
 
+run_migrations()
+
 # ==========================================
 # SIDEBAR NAVIGATION
 # ==========================================
@@ -134,44 +162,84 @@ with st.sidebar:
 # PAGE 1: DOCUMENTS (Manager + MathGuard)
 # ==========================================
 if app_mode == "Documents":
-    c1, c2 = st.columns([6, 1])
+    c1, c2, c3 = st.columns([5, 1, 1])
     c1.title("Documents")
     if c2.button("➕ Add", use_container_width=True): render_upload_modal()
+    render_ingest_status()
+    if c3.button("🛡️ Verify All", use_container_width=True):
+        # Local MathGuard over the whole corpus (spawned process pool, no LLM calls)
+        progress = st.progress(0.0, text="Checking invoice math...")
+        summary = verify_all(db=get_db(), progress_callback=lambda done, total: progress.progress(
+            done / max(total, 1), text=f"Checking invoice math... {done}/{total}"))
+        progress.empty()
+        st.toast(f"Checked {summary['checked']}: {summary['correct']} ok, "
+                 f"{summary['incorrect']} discrepancies, {summary['ambiguous']} ambiguous")
 
-    db = DatabaseEngine()
+    db = get_db()
     try:
-        docs = db.get_recent_documents(limit=50)
-        if not docs:
+        # SPEND OVERVIEW (Aggregated in SQL over the typed columns)
+        spend = db.get_spend_summary(group_by="currency")[:4]
+        if not spend and not db.list_documents(limit=1)[0]:
             UIEngine.render_empty_state("No documents yet", "Upload a file to start analyzing.")
         else:
-            filter_text = st.text_input("🔍 Search files...", "")
-            
+            if spend:
+                for col, row in zip(st.columns(len(spend)), spend):
+                    col.metric(f"Spend {row['currency'] or 'N/A'} ({row['count']} docs)", f"{row['total']:,.2f}")
+
+            f1, f2 = st.columns([3, 1])
+            filter_text = f1.text_input("🔍 Search files...", "")
+            type_filter = f2.selectbox("Type", ["All"] + db.get_doc_types())
+            filters = {"doc_type": type_filter} if type_filter != "All" else {}
+
+            # KEYSET PAGINATION: a stack of page cursors, reset when the filters change
+            page_key = (filter_text, type_filter)
+            if st.session_state.get('doc_page_key') != page_key:
+                st.session_state['doc_page_key'] = page_key
+                st.session_state['doc_cursors'] = [None]
+            cursors = st.session_state['doc_cursors']
+            docs, next_cursor = db.list_documents(
+                limit=DOC_PAGE_SIZE, after=cursors[-1], filename_query=filter_text, **filters
+            )
+
             for doc in docs:
-                if filter_text.lower() in doc.filename.lower():
-                    with st.expander(f"📄 {doc.filename}  |  {doc.metadata_json.get('vendor', 'Unknown')}  |  {doc.processed_at.strftime('%Y-%m-%d')}"):
+                with st.expander(f"📄 {doc.filename}  |  {doc.vendor or 'Unknown'}  |  {doc.processed_at.strftime('%Y-%m-%d')}"):
+                    if doc.total_amount is not None:
+                        st.caption(f"{doc.doc_type or 'DOCUMENT'} · {doc.total_amount:,.2f} {doc.currency or ''}")
+
+                    # MATHGUARD INTEGRATION
+                    st.markdown("**🛡️ MathGuard Audit**")
+                    # Unique key for each button is critical in loops
+                    if st.button(f"Verify Math", key=f"math_{doc.id}"):
+                        brain = DocumentBrain()
+                        audit = brain.verify_math(db.get_document(doc.id).text_content)
                         
-                        # MATHGUARD INTEGRATION
-                        st.markdown("**🛡️ MathGuard Audit**")
-                        # Unique key for each button is critical in loops
-                        if st.button(f"Verify Math", key=f"math_{doc.id}"):
-                            brain = DocumentBrain()
-                            audit = brain.verify_math(doc.text_content)
-                            
-                            m1, m2, m3 = st.columns(3)
-                            m1.metric("Subtotal", f"${audit.get('found_subtotal', 0)}")
-                            m2.metric("Tax", f"${audit.get('found_tax', 0)}")
-                            m3.metric("Calc. Total", f"${audit.get('calculated_total', 0)}")
-                            
-                            if audit.get('is_math_correct'):
-                                st.success("✅ Integrity Verified")
-                            else:
-                                st.error("⚠️ Discrepancy Detected")
-                                st.caption(audit.get('explanation'))
-
-                        st.divider()
-                        st.markdown("**📝 AI Summary**")
-                        st.info(doc.ai_summary)
-                        st.json(doc.metadata_json)
+                        m1, m2, m3 = st.columns(3)
+                        m1.metric("Subtotal", f"${audit.get('found_subtotal', 0)}")
+                        m2.metric("Tax", f"${audit.get('found_tax', 0)}")
+                        m3.metric("Calc. Total", f"${audit.get('calculated_total', 0)}")
+                        
+                        if audit.get('is_math_correct'):
+                            st.success("✅ Integrity Verified")
+                        else:
+                            st.error("⚠️ Discrepancy Detected")
+                            st.caption(audit.get('explanation'))
+                        st.caption(f"Checked by: {audit.get('method', 'llm')}")
+
+                    st.divider()
+                    # Summary and JSON are loaded only for documents the user opens
+                    if st.toggle("📝 AI Summary & Data", key=f"details_{doc.id}"):
+                        full = db.get_document(doc.id)
+                        st.info(full.ai_summary)
+                        st.json(full.metadata_json)
+
+            p1, p2, p3 = st.columns([1, 4, 1])
+            if len(cursors) > 1 and p1.button("◀ Prev", use_container_width=True):
+                cursors.pop()
+                st.rerun()
+            p2.caption(f"Page {len(cursors)}")
+            if next_cursor and p3.button("Next ▶", use_container_width=True):
+                cursors.append(next_cursor)
+                st.rerun()
 
     except Exception as e:
         st.error(f"Database Error: {e}")
@@ -181,9 +249,10 @@ if app_mode == "Documents":
 # ==========================================
 elif app_mode == "Chats":
     st.title("Chats")
-    db = DatabaseEngine()
-    docs = db.get_recent_documents(20)
-    doc_names = [d.filename for d in docs] if docs else []
+    db = get_db()
+    docs, _ = db.list_documents(limit=20)
+    doc_ids = {d.filename: d.id for d in docs}
+    doc_names = list(doc_ids.keys())
     
     if not doc_names:
         UIEngine.render_empty_state("No chats available", "Upload documents first.")
@@ -208,12 +277,19 @@ elif app_mode == "Chats":
                 st.session_state['chat_history'].append({'role': 'user', 'content': q})
                 brain = DocumentBrain()
                 if selected_doc == "All Documents":
-                    results = db.query_similar_docs(q, n_results=5)
+                    results = db.query_similar_docs(q, n_results=10)
                 else:
-                    results = db.query_similar_docs(q, filename_filter=selected_doc)
+                    # Only search the chunks of the selected document
+                    results = db.query_similar_docs(q, doc_id=doc_ids[selected_doc], n_results=10)
                 
-                context = "\n".join(results['documents'][0]) if results['documents'] else ""
-                ans = brain.chat_with_documents(context, q)
+                # Deduplicated, relevance-ordered, trimmed to a fixed token budget
+                context = pack_context(results, q, token_budget=CHAT_CONTEXT_TOKENS)['text']
+                # Stream the answer into the chat box as it is generated
+                metrics = {}
+                with chat_box:
+                    st.markdown(f"<div style='text-align:right; background:#f3f4f6; padding:10px; border-radius:10px; margin:5px; display:inline-block;'>{q}</div>", unsafe_allow_html=True)
+                    ans = st.write_stream(brain.stream_chat_with_documents(context, q, metrics))
+                record_chat_metrics(metrics)
                 st.session_state['chat_history'].append({'role': 'ai', 'content': ans})
                 st.rerun()
 
@@ -226,15 +302,21 @@ elif app_mode == "Global Intel":
     
     user_q = st.text_input("Executive Query:", placeholder="e.g. 'How much did we pay Microsoft last year?'")
     if user_q:
-        db = DatabaseEngine()
-        results = db.query_global_context(user_q, n_results=10)
+        db = get_db()
+        results = db.query_global_context(user_q, n_results=25)
         
-        if results['documents']:
-            context = "\n".join(results['documents'][0])
+        if results['documents'] and results['documents'][0]:
+            packed = pack_context(results, user_q, token_budget=GLOBAL_CONTEXT_TOKENS)
+            context = packed['text']
             brain = DocumentBrain()
-            with st.spinner("🧠 Analyzing Enterprise Data..."):
-                answer = brain.chat_with_documents(context, user_q)
-            st.info(answer)
+            metrics = {}
+            with st.container(border=True):
+                st.write_stream(brain.stream_chat_with_documents(context, user_q, metrics))
+            record_chat_metrics(metrics)
+            if metrics.get('ttft_ms') is not None and metrics.get('total_ms') is not None:
+                st.caption(f"First token {metrics['ttft_ms']:.0f} ms · full answer {metrics['total_ms']:.0f} ms · "
+                           f"context {packed['tokens']} tokens from {len(packed['passages'])} passages "
+                           f"({packed['duplicates']} duplicates dropped)")
             with st.expander("Source Data"): st.text(context)
         else:
             st.warning("No data found.")
@@ -244,22 +326,23 @@ elif app_mode == "Global Intel":
 # ==========================================
 elif app_mode == "Risk Audit":
     st.title("Risk & Fraud Auditor")
-    db = DatabaseEngine()
-    docs = db.get_recent_documents(50)
-    options = {d.filename: d for d in docs}
+    db = get_db()
+    docs, _ = db.list_documents(limit=50)
+    options = {d.filename: d.id for d in docs}
     
     if not options:
         UIEngine.render_empty_state("No data to audit", "Upload documents first.")
     else:
         selected_file = st.selectbox("Select Invoice to Audit:", list(options.keys()))
         if st.button("⚡ Run Forensic Check"):
-            target = options[selected_file]
+            target = db.get_document(options[selected_file])
             vendor = target.metadata_json.get('vendor', '')
             
             with st.spinner("🔍 Checking Historical Patterns..."):
-                history = db.get_vendor_history(vendor, exclude_filename=target.filename)
+                # Running vendor stats: the LLM gets a few numbers, not the raw history
+                baseline = db.get_vendor_baseline(target)
                 brain = DocumentBrain()
-                audit = brain.audit_document(target.text_content, history)
+                audit = brain.audit_document(target.text_content, baseline)
                 
                 c1, c2, c3 = st.columns(3)
                 c1.metric("Risk Score", f"{audit.get('risk_score')}/100")
@@ -267,26 +350,41 @@ elif app_mode == "Risk Audit":
                 c3.metric("Action", audit.get('recommendation'))
                 
                 st.error(f"Flags: {audit.get('flags')}")
-                with st.expander("Historical Baseline"): st.json(history)
+                with st.expander("Historical Baseline"):
+                    st.json(baseline or {})
+                    st.json(db.get_vendor_history(vendor, exclude_filename=target.filename))
+
+        # BATCH MODE: every document scored against its vendor baseline in one pass
+        st.divider()
+        if st.button("📊 Rank All Documents by Anomaly"):
+            ranking = db.score_all_documents(limit=100)
+            if ranking:
+                st.dataframe(pd.DataFrame(ranking), use_container_width=True)
+            else:
+                st.info("Not enough vendor history to score yet.")
 
 # ==========================================
 # PAGE 5: PRIVACY VAULT (Redaction)
 # ==========================================
 elif app_mode == "Privacy Vault":
     st.title("Privacy Vault (GDPR)")
-    db = DatabaseEngine()
-    docs = db.get_recent_documents(50)
-    options = {d.filename: d for d in docs}
+    db = get_db()
+    docs, _ = db.list_documents(limit=50)
+    options = {d.filename: d.id for d in docs}
     
     if not options:
         UIEngine.render_empty_state("Vault Empty", "Upload documents first.")
     else:
         selected_file = st.selectbox("Select Document to Redact:", list(options.keys()))
+        llm_pass = st.checkbox("Second pass with AI (slower, catches free-form PII)", value=False)
         if st.button("🔒 Generate Public Version"):
-            target = options[selected_file]
+            target = db.get_document(options[selected_file])
             with st.spinner("🕵️ Scrubbing PII..."):
-                brain = DocumentBrain()
-                redacted = brain.redact_sensitive_data(target.metadata_json)
+                # Local rules redact JSON and text together; the AI pass is optional
+                public = redact_document(target.metadata_json, target.text_content, target.filename)
+                redacted = public['metadata']
+                if llm_pass:
+                    redacted = DocumentBrain().redact_sensitive_data(redacted, llm_pass=True, local=False)
                 
                 c1, c2 = st.columns(2)
                 with c1: 
@@ -295,5 +393,20 @@ elif app_mode == "Privacy Vault":
                 with c2: 
                     st.markdown("**Sanitized**")
                     st.json(redacted)
+                st.caption(f"Redactions: {public['redactions'] or 'none'}")
+                with st.expander("Sanitized Text"):
+                    st.text(public['text'] or "")
                 
-                st.download_button("Download JSON", data=json.dumps(redacted), file_name="safe.json")
\ No newline at end of file
+                st.download_button("Download JSON", data=json.dumps(redacted), file_name="safe.json")
+
+        # BULK MODE: whole corpus, local rules only, straight to a JSONL file
+        st.divider()
+        if st.button("📦 Export Redacted Corpus (JSONL)"):
+            out_path = os.path.join("output", f"redacted_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl")
+            progress = st.progress(0.0, text="Redacting all documents...")
+            count = export_redacted_corpus(out_path, db=get_db(), progress_callback=lambda done, total: progress.progress(
+                done / max(total, 1), text=f"Redacting all documents... {done}/{total}"))
+            progress.empty()
+            st.success(f"Redacted {count} documents → {out_path}")
+            with open(out_path, "rb") as f:
+                st.download_button("Download JSONL", data=f, file_name=os.path.basename(out_path))
@@ -0,0 +1,102 @@
+"""
+Offline throughput benchmark for the DocumentBrain batch API.
+
+Runs against a local fake chat model (no API key, no quota) with a fixed
+latency and an optional rate of injected 429 errors, so concurrency and
+retry settings can be tuned without touching Gemini.
+
+    python src/python/bench_brain.py --docs 200 --concurrency 1 8 32 --latency 0.5
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from llm_engine import DocumentBrain
+
+
+class FakeResponse:
+    def __init__(self, content):
+        self.content = content
+
+
+class FakeRateLimitError(Exception):
+    status_code = 429
+
+    def __init__(self, retry_after):
+        super().__init__(f"429 Resource has been exhausted. Please retry in {retry_after}s.")
+        self.retry_after = retry_after
+
+
+class FakeChatModel:
+    """Duck-types the `invoke` / `ainvoke` / `stream` surface DocumentBrain uses."""
+
+    def __init__(self, latency=0.5, error_rate=0.0, retry_after=0.05):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.calls = 0
+        self.reply = json.dumps({
+            "type": "INVOICE", "language": "en", "confidence_score": 99,
+            "vendor": "Fake Vendor", "date": "2025-01-01",
+            "total_amount": "100.00", "currency": "USD", "parties": [],
+            "specific_data": {}, "summary": "Fake summary."
+        })
+
+    def _maybe_fail(self):
+        self.calls += 1
+        if random.random() < self.error_rate:
+            raise FakeRateLimitError(self.retry_after)
+
+    def invoke(self, prompt):
+        time.sleep(self.latency)
+        self._maybe_fail()
+        return FakeResponse(self.reply)
+
+    async def ainvoke(self, prompt):
+        await asyncio.sleep(self.latency)
+        self._maybe_fail()
+        return FakeResponse(self.reply)
+
+    def stream(self, prompt):
+        # First token after `latency`, then the rest word by word
+        time.sleep(self.latency)
+        self._maybe_fail()
+        for word in self.reply.split(" "):
+            time.sleep(0.005)
+            yield FakeResponse(word + " ")
+
+    async def astream(self, prompt):
+        await asyncio.sleep(self.latency)
+        self._maybe_fail()
+        for word in self.reply.split(" "):
+            await asyncio.sleep(0.005)
+            yield FakeResponse(word + " ")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DocumentBrain batch throughput (offline)")
+    parser.add_argument("--docs", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds per fake LLM call")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of calls that return 429")
+    args = parser.parse_args()
+
+    texts = [f"Invoice #{i} Total: $100.00" for i in range(args.docs)]
+    for concurrency in args.concurrency:
+        fake = FakeChatModel(latency=args.latency, error_rate=args.error_rate)
+        brain = DocumentBrain(llm=fake, base_delay=0.05, cache=False)
+
+        started = time.time()
+        results = brain.analyze_batch(texts, concurrency=concurrency)
+        elapsed = time.time() - started
+
+        failed = sum(1 for r in results if isinstance(r, Exception))
+        print(f"concurrency={concurrency:>3}  docs={args.docs}  "
+              f"time={elapsed:6.2f}s  docs/s={args.docs / elapsed:7.1f}  "
+              f"llm_calls={fake.calls}  failed={failed}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import bisect
+import re
+
+# Rough token estimate (~4 characters per token for English/German text).
+# Good enough for sizing chunks; no tokenizer dependency needed.
+CHARS_PER_TOKEN = 4
+
+# A "unit" ends at sentence punctuation or a line break (OCR receipts
+# rarely have punctuation, but they do have one item per line).
+_UNIT_BREAK = re.compile(r"(?<=[.!?])\s+|\n+")
+
+
+def estimate_tokens(text):
+    return max(1, len(text) // CHARS_PER_TOKEN) if text else 0
+
+
+def _unit_spans(text, max_chars):
+    """Yields (start, end) spans of sentence/line units, none longer than max_chars."""
+    pos = 0
+    for match in _UNIT_BREAK.finditer(text):
+        yield from _split_long(text, pos, match.start(), max_chars)
+        pos = match.end()
+    yield from _split_long(text, pos, len(text), max_chars)
+
+
+def _split_long(text, start, end, max_chars):
+    # Strip surrounding whitespace
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    # Hard-wrap a run-on unit at the last space before the limit
+    while end - start > max_chars:
+        cut = text.rfind(" ", start, start + max_chars)
+        if cut <= start:
+            cut = start + max_chars
+        yield (start, cut)
+        start = cut
+        while start < end and text[start].isspace():
+            start += 1
+    if end > start:
+        yield (start, end)
+
+
+def split_units(text, max_chars=2000):
+    """Sentence/line units of a text as strings (see _UNIT_BREAK)."""
+    return [text[s:e] for s, e in _unit_spans(text, max_chars)] if text else []
+
+
+def chunk_text(text, chunk_tokens=350, overlap_tokens=50, page_starts=None):
+    """
+    Splits text into overlapping chunks on sentence/line boundaries.
+
+    page_starts: optional sorted list of character offsets where each page
+                 begins (page 1 first). When given, chunks never cross a
+                 page break and every chunk gets its page, so a citation
+                 points at exactly one page.
+
+    Returns a list of dicts: {"index", "text", "start", "end", "page"?}
+    where start/end are character offsets into the original text.
+    """
+    if not text or not text.strip():
+        return []
+
+    max_chars = chunk_tokens * CHARS_PER_TOKEN
+    overlap_chars = overlap_tokens * CHARS_PER_TOKEN
+    spans = list(_unit_spans(text, max_chars))
+
+    pages = [bisect.bisect_right(page_starts, s) for s, _ in spans] if page_starts else [None] * len(spans)
+
+    chunks = []
+    current = []
+    size = 0
+    i = 0
+    while i < len(spans):
+        start, end = spans[i]
+        unit_len = end - start
+        if current and pages[i] != current_page:
+            # New page: close the chunk, no overlap across the break
+            chunks.append((current[0][0], current[-1][1]))
+            current, size = [], 0
+        if current and size + unit_len > max_chars:
+            chunks.append((current[0][0], current[-1][1]))
+            # Carry the tail sentences over as overlap
+            carry = []
+            carry_len = 0
+            for span in reversed(current):
+                if carry_len + (span[1] - span[0]) > overlap_chars:
+                    break
+                carry.insert(0, span)
+                carry_len += span[1] - span[0]
+            # Never carry everything, or we would loop forever
+            if len(carry) == len(current):
+                carry = carry[1:]
+            current = carry
+            size = sum(e - s for s, e in current)
+            continue
+        current.append((start, end))
+        current_page = pages[i]
+        size += unit_len
+        i += 1
+    if current:
+        chunks.append((current[0][0], current[-1][1]))
+
+    result = []
+    for index, (start, end) in enumerate(chunks):
+        chunk = {"index": index, "text": text[start:end], "start": start, "end": end}
+        if page_starts:
+            chunk["page"] = bisect.bisect_right(page_starts, start)
+        result.append(chunk)
+    return result
@@ -0,0 +1,187 @@
+"""
+Packs retrieved passages into a bounded chat context.
+
+Sits between DatabaseEngine retrieval (Chroma-shaped results) and
+DocumentBrain.chat_with_documents:
+1. drop exact and near-duplicate passages (and text repeated by chunk overlap),
+2. order the rest by relevance score,
+3. trim long passages to the sentences that match the query,
+4. add passages until the token budget is full.
+"""
+import hashlib
+import re
+
+from chunking import estimate_tokens, split_units
+
+DEFAULT_BUDGET = 2000
+
+# Word-shingle Jaccard similarity at which two passages count as the same
+NEAR_DUPLICATE = 0.8
+SHINGLE_SIZE = 3
+
+# Passages longer than this are trimmed to their query-matching sentences
+TRIM_ABOVE_TOKENS = 120
+
+# Matching sentences keep this many neighbours on each side for context
+NEIGHBOURS = 1
+
+STOPWORDS = {
+    "the", "and", "for", "are", "was", "were", "what", "which", "who", "how", "did",
+    "does", "this", "that", "with", "from", "have", "has", "our", "all", "any", "much",
+    "many", "when", "where", "why", "can", "you", "your", "about", "show", "give", "list",
+}
+
+
+def query_terms(query):
+    return {w for w in re.findall(r"\w+", query.lower()) if len(w) > 2 and w not in STOPWORDS}
+
+
+def _shingles(text):
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < SHINGLE_SIZE:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def _jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def trim_to_matches(text, terms, neighbours=NEIGHBOURS):
+    """
+    Keeps only the sentences/lines that mention a query term (plus their
+    neighbours); gaps are marked with "...". Returns the text unchanged if
+    nothing matches (a semantic hit can be relevant without shared words).
+    """
+    units = split_units(text)
+    if not terms or len(units) < 2:
+        return text
+    hits = [i for i, u in enumerate(units) if terms & set(re.findall(r"\w+", u.lower()))]
+    if not hits:
+        return text
+    keep = sorted({j for i in hits for j in range(i - neighbours, i + neighbours + 1) if 0 <= j < len(units)})
+    parts = []
+    for prev, j in zip([None] + keep, keep):
+        if prev is not None and j != prev + 1:
+            parts.append("...")
+        parts.append(units[j])
+    return "\n".join(parts)
+
+
+def compact_whitespace(text):
+    # OCR layouts pad columns with long runs of spaces; they cost tokens, not meaning
+    text = re.sub(r"[ \t]+", " ", text)
+    text = re.sub(r" ?\n ?", "\n", text)
+    return re.sub(r"\s*\n\s*(\n\s*)+", "\n\n", text).strip()
+
+
+def _truncate_to_tokens(text, tokens):
+    # estimate_tokens is chars/4, so cut at the matching char count on a word boundary
+    limit = tokens * 4
+    if len(text) <= limit:
+        return text
+    cut = text.rfind(" ", 0, limit)
+    return text[:cut if cut > 0 else limit] + " ..."
+
+
+def _uncovered(text, start, end, spans):
+    """
+    The parts of a passage (document chars start..end) outside the spans
+    already in the context: a trimmed prefix/suffix, or "..." where a covered
+    span sits inside it.
+    """
+    pieces, pos = [], start
+    for s, e in sorted(spans):
+        if e <= pos or s >= end:
+            continue
+        if s > pos:
+            pieces.append(text[pos - start:s - start])
+        pos = max(pos, e)
+    if pos < end:
+        pieces.append(text[pos - start:])
+    return "\n...\n".join(piece for piece in pieces if piece.strip())
+
+
+def _source_label(meta):
+    label = meta.get('filename') or meta.get('doc_id') or "unknown"
+    if meta.get('page'):
+        label += f", p. {meta['page']}"
+    return f"[Source: {label}]"
+
+
+def pack_context(results, query, token_budget=DEFAULT_BUDGET):
+    """
+    results: Chroma-shaped dict from DatabaseEngine.hybrid_search / query_*.
+    Returns {"text", "tokens", "passages" (ids used), "duplicates", "trimmed", "dropped"}.
+    """
+    ids = (results.get('ids') or [[]])[0]
+    docs = (results.get('documents') or [[]])[0]
+    metas = (results.get('metadatas') or [[]])[0] or [{}] * len(docs)
+
+    # Relevance: the fused RRF score when present, otherwise retrieval order
+    passages = []
+    for rank, (pid, text, meta) in enumerate(zip(ids, docs, metas)):
+        meta = meta or {}
+        passages.append({
+            "id": pid, "text": text or "", "meta": meta,
+            "score": meta.get('rrf_score') or 0.0, "rank": rank,
+        })
+    passages.sort(key=lambda p: (-p['score'], p['rank']))
+
+    terms = query_terms(query)
+    seen_hashes = set()
+    kept_shingles = []
+    covered = {}  # doc_id -> [(start, end)] of text already in the context
+    stats = {"duplicates": 0, "trimmed": 0, "dropped": 0}
+    blocks, used_ids = [], []
+    used_tokens = 0
+
+    for p in passages:
+        text, meta = p['text'], p['meta']
+
+        # 1. Overlap between neighbouring chunks of the same document
+        start, end = meta.get('start'), meta.get('end')
+        doc_id = meta.get('doc_id')
+        if doc_id is not None and start is not None and end is not None:
+            text = _uncovered(text, start, end, covered.get(doc_id, []))
+            covered.setdefault(doc_id, []).append((start, end))
+
+        # 2. Exact and near duplicates
+        digest = hashlib.sha1(" ".join(text.lower().split()).encode()).hexdigest()
+        shingles = _shingles(text)
+        if not text.strip() or digest in seen_hashes or any(
+                _jaccard(shingles, other) >= NEAR_DUPLICATE for other in kept_shingles):
+            stats['duplicates'] += 1
+            continue
+        seen_hashes.add(digest)
+        kept_shingles.append(shingles)
+
+        # 3. Trim long passages to what the question is about
+        if estimate_tokens(text) > TRIM_ABOVE_TOKENS:
+            trimmed = trim_to_matches(text, terms)
+            if len(trimmed) < len(text):
+                stats['trimmed'] += 1
+                text = trimmed
+
+        # 4. Fill the budget; cut the last passage rather than leave room unused
+        block = f"{_source_label(meta)}\n{compact_whitespace(text)}"
+        remaining = token_budget - used_tokens
+        cost = estimate_tokens(block)
+        if cost > remaining:
+            if remaining < 50:
+                stats['dropped'] += 1
+                continue
+            block = _truncate_to_tokens(block, remaining)
+            cost = estimate_tokens(block)
+        blocks.append(block)
+        used_ids.append(p['id'])
+        used_tokens += cost
+
+    return {
+        "text": "\n\n".join(blocks),
+        "tokens": used_tokens,
+        "passages": used_ids,
+        **stats,
+    }
@@ -0,0 +1,368 @@
+"""
+Streaming ingestion for CSV exports (.csv, .tsv, .gz, .zip).
+
+The file is read in chunks of CHUNK_ROWS, so memory stays flat no matter
+how large the export is. While streaming:
+- every column is profiled (type, null rate, min/max, sum, top values),
+- the full data is written to a zstd-compressed Parquet file for later queries,
+- a uniform sample of rows is kept for the LLM.
+
+The LLM then gets the compact profile plus the sample (render_for_llm)
+instead of a markdown dump of the first rows.
+
+    python src/python/csv_ingest.py companies.csv.zip
+"""
+import argparse
+import codecs
+import csv
+import gzip
+import io
+import json
+import os
+import zipfile
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+CHUNK_ROWS = 50000
+
+# Rows kept for the LLM (uniform reservoir sample over the whole file)
+SAMPLE_ROWS = 15
+
+TOP_K = 5
+
+# Distinct values tracked per column for the top-k; the least frequent are
+# pruned beyond this, so counts are approximate for very high-cardinality columns
+TOP_K_CAPACITY = 200
+
+# Bytes read up front to detect the delimiter
+SNIFF_BYTES = 64 * 1024
+
+# Columns wider than this are left out of the LLM text (profile only)
+MAX_LLM_COLUMNS = 60
+
+TABULAR_EXTENSIONS = (".csv", ".tsv", ".csv.gz", ".tsv.gz", ".zip")
+
+
+def is_tabular(path):
+    """A CSV/TSV file (maybe gzipped), or a zip archive with at least one CSV/TSV in it."""
+    lower = path.lower()
+    if not lower.endswith(TABULAR_EXTENSIONS):
+        return False
+    if lower.endswith(".zip"):
+        # Reads only the archive's central directory
+        try:
+            with zipfile.ZipFile(path) as archive:
+                return bool(_csv_members(archive))
+        except (OSError, zipfile.BadZipFile):
+            return False
+    return True
+
+
+# ==========================================
+# READING
+# ==========================================
+def _csv_members(archive):
+    # Skips folders and macOS "._" resource files
+    return [n for n in archive.namelist()
+            if n.lower().endswith((".csv", ".tsv")) and not os.path.basename(n).startswith(".")]
+
+
+def member_names(path):
+    if path.lower().endswith(".zip"):
+        with zipfile.ZipFile(path) as archive:
+            return _csv_members(archive)
+    return [os.path.basename(path)]
+
+
+def open_members(path):
+    """
+    Yields (name, binary stream) for every CSV inside `path`: the file
+    itself, a gzip stream, or each .csv/.tsv member of a zip archive.
+    """
+    lower = path.lower()
+    if lower.endswith(".zip"):
+        with zipfile.ZipFile(path) as archive:
+            for name in _csv_members(archive):
+                with archive.open(name) as stream:
+                    yield name, stream
+    elif lower.endswith(".gz"):
+        with gzip.open(path, "rb") as stream:
+            yield os.path.basename(path)[:-3], stream
+    else:
+        with open(path, "rb") as stream:
+            yield os.path.basename(path), stream
+
+
+def sniff_delimiter(head, name):
+    if name.lower().endswith(".tsv"):
+        return "\t"
+    text = head.decode("utf-8", errors="replace")
+    # Drop a possibly cut-off last line
+    text = text[:text.rfind("\n")] if "\n" in text else text
+    try:
+        return csv.Sniffer().sniff(text, delimiters=",;\t|").delimiter
+    except csv.Error:
+        return ","
+
+
+def read_chunks(stream, name, chunk_rows=CHUNK_ROWS):
+    """DataFrames of up to chunk_rows rows, all values as strings (typed later)."""
+    # peek() fills the buffer once without consuming it, so pandas still
+    # reads from the first byte
+    buffered = io.BufferedReader(stream, buffer_size=SNIFF_BYTES)
+    head = buffered.peek(SNIFF_BYTES)
+    sep = sniff_delimiter(head, name)
+    encoding = "utf-8-sig" if head.startswith(codecs.BOM_UTF8) else "utf-8"
+    return pd.read_csv(
+        buffered, sep=sep, dtype=str, chunksize=chunk_rows,
+        encoding=encoding, encoding_errors="replace", on_bad_lines="warn",
+    )
+
+
+# ==========================================
+# TYPES
+# ==========================================
+def infer_type(values):
+    """Column type from the non-null strings of the first chunk."""
+    values = values.dropna()
+    if values.empty:
+        return "string"
+    numbers = pd.to_numeric(values, errors="coerce")
+    if numbers.notna().all():
+        if not values.str.contains(r"[.eE]", regex=True).any():
+            return "integer"
+        return "float"
+    dates = pd.to_datetime(values, errors="coerce", format="ISO8601")
+    if dates.notna().all():
+        return "datetime"
+    return "string"
+
+
+ARROW_TYPES = {
+    "integer": pa.int64(),
+    "float": pa.float64(),
+    "datetime": pa.timestamp("us"),
+    "string": pa.string(),
+}
+
+
+def cast_column(values, col_type):
+    """
+    Casts a string column to its profiled type. Values that don't fit
+    become null; returns (series, number of such failures).
+    """
+    if col_type == "string":
+        return values, 0
+    if col_type == "datetime":
+        cast = pd.to_datetime(values, errors="coerce", format="ISO8601").astype("datetime64[us]")
+    else:
+        cast = pd.to_numeric(values, errors="coerce")
+        if col_type == "integer":
+            whole = cast.notna() & (cast % 1 == 0)
+            cast = cast.where(whole).astype("Int64")
+    failures = int((values.notna() & cast.isna()).sum())
+    return cast, failures
+
+
+# ==========================================
+# PROFILING
+# ==========================================
+def new_profile(col_type):
+    return {
+        "type": col_type, "count": 0, "nulls": 0, "cast_failures": 0,
+        "min": None, "max": None, "sum": None, "top": {},
+    }
+
+
+def update_profile(profile, values):
+    """Folds one chunk of a typed column into its running profile."""
+    present = values.dropna()
+    profile['count'] += len(values)
+    profile['nulls'] += len(values) - len(present)
+    if present.empty:
+        return profile
+
+    if profile['type'] in ("integer", "float", "datetime"):
+        lo, hi = present.min(), present.max()
+        profile['min'] = lo if profile['min'] is None else min(profile['min'], lo)
+        profile['max'] = hi if profile['max'] is None else max(profile['max'], hi)
+    if profile['type'] in ("integer", "float"):
+        profile['sum'] = (profile['sum'] or 0) + present.sum()
+
+    if profile['type'] == "float":
+        return profile  # continuous values have no meaningful top-k
+    top = profile['top']
+    for value, count in present.astype(str).value_counts().head(TOP_K_CAPACITY).items():
+        top[value] = top.get(value, 0) + int(count)
+    if len(top) > TOP_K_CAPACITY:
+        keep = sorted(top.items(), key=lambda kv: -kv[1])[:TOP_K_CAPACITY]
+        profile['top'] = dict(keep)
+    return profile
+
+
+def _plain(value):
+    # numpy / pandas scalars -> JSON-friendly Python values
+    if value is None:
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float):
+        return round(value, 4)
+    return value
+
+
+def finish_profile(profile):
+    count = profile['count']
+    present = count - profile['nulls']
+    result = {
+        "type": profile['type'],
+        "null_rate": round(profile['nulls'] / count, 4) if count else None,
+        "min": _plain(profile['min']),
+        "max": _plain(profile['max']),
+        "sum": _plain(profile['sum']),
+        "mean": _plain(profile['sum'] / present) if profile['sum'] is not None and present else None,
+        "top": [[v, c] for v, c in sorted(profile['top'].items(), key=lambda kv: -kv[1])[:TOP_K]],
+    }
+    if profile['cast_failures']:
+        result["cast_failures"] = profile['cast_failures']
+    return result
+
+
+# ==========================================
+# INGEST
+# ==========================================
+def parquet_path_for(path, member, multiple):
+    base = path
+    for ext in (".zip", ".gz", ".csv", ".tsv"):
+        if base.lower().endswith(ext):
+            base = base[:-len(ext)]
+    if multiple:
+        base += "__" + os.path.splitext(os.path.basename(member))[0]
+    return base + ".parquet"
+
+
+def ingest_table(stream, name, parquet_path, chunk_rows=CHUNK_ROWS, rng=None):
+    """
+    Streams one CSV into Parquet, profiling every column on the way.
+    Types come from the first chunk (values that don't fit later are null
+    in Parquet and counted as cast_failures in the profile).
+    Returns {"name", "rows", "columns", "parquet", "profile", "sample"}.
+    """
+    rng = rng or np.random.default_rng()
+    writer = None
+    types, profiles = {}, {}
+    sample, rows = [], 0
+    tmp_path = parquet_path + ".tmp"
+
+    try:
+        for chunk in read_chunks(stream, name, chunk_rows):
+            chunk.columns = [str(c) for c in chunk.columns]
+            if writer is None:
+                types = {c: infer_type(chunk[c]) for c in chunk.columns}
+                profiles = {c: new_profile(t) for c, t in types.items()}
+                schema = pa.schema([(c, ARROW_TYPES[t]) for c, t in types.items()])
+                writer = pq.ParquetWriter(tmp_path, schema, compression="zstd")
+
+            typed = {}
+            for col, col_type in types.items():
+                typed[col], failures = cast_column(chunk[col], col_type)
+                profiles[col]['cast_failures'] += failures
+                update_profile(profiles[col], typed[col])
+            writer.write_table(pa.Table.from_pandas(pd.DataFrame(typed), schema=schema, preserve_index=False))
+
+            # Reservoir sample (Algorithm R) of the raw rows; the random
+            # slots are drawn for the whole chunk at once
+            fill = max(0, min(SAMPLE_ROWS - len(sample), len(chunk)))
+            sample += chunk.iloc[:fill].to_dict("records")
+            seen = rows + np.arange(fill, len(chunk))
+            slots = rng.integers(0, seen + 1) if len(seen) else seen
+            for offset in np.flatnonzero(slots < SAMPLE_ROWS):
+                sample[slots[offset]] = chunk.iloc[fill + offset].to_dict()
+            rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if writer is not None:
+        os.replace(tmp_path, parquet_path)
+    return {
+        "name": name,
+        "rows": rows,
+        "columns": len(types),
+        "parquet": parquet_path if writer is not None else None,
+        "profile": {c: finish_profile(p) for c, p in profiles.items()},
+        "sample": sample,
+    }
+
+
+def ingest_csv(path, chunk_rows=CHUNK_ROWS):
+    """
+    Ingests a CSV / TSV / .gz / .zip upload. Returns (text_for_llm, cpp_data)
+    like ingest_pipeline.extract_file; cpp_data keeps the full profiles and
+    the Parquet paths.
+    """
+    multiple = len(member_names(path)) > 1
+    tables = []
+    for name, stream in open_members(path):
+        parquet = parquet_path_for(path, name, multiple)
+        tables.append(ingest_table(stream, name, parquet, chunk_rows))
+    if not tables:
+        raise ValueError(f"No CSV data found in {os.path.basename(path)}")
+
+    cpp_data = {
+        "method": "CSV_STREAM",
+        "rows": sum(t['rows'] for t in tables),
+        "tables": [{k: t[k] for k in ("name", "rows", "columns", "parquet", "profile")} for t in tables],
+    }
+    return render_for_llm(tables), cpp_data
+
+
+# ==========================================
+# LLM TEXT
+# ==========================================
+def _profile_line(col, p):
+    parts = [f"- {col} ({p['type']}, {p['null_rate']:.0%} null)" if p['null_rate'] is not None else f"- {col} ({p['type']})"]
+    if p['min'] is not None:
+        parts.append(f"min {p['min']}, max {p['max']}")
+    if p['sum'] is not None:
+        parts.append(f"sum {p['sum']}, mean {p['mean']}")
+    if p['top'] and p['type'] == "string":
+        parts.append("top: " + ", ".join(f"{v} ({c})" for v, c in p['top']))
+    return "; ".join(parts)
+
+
+def render_for_llm(tables):
+    """Compact profile + sample rows per table, as plain text."""
+    blocks = []
+    for t in tables:
+        columns = list(t['profile'])
+        lines = [f"CSV DATASET: {t['name']} - {t['rows']} rows, {t['columns']} columns", "", "COLUMN PROFILE:"]
+        lines += [_profile_line(c, t['profile'][c]) for c in columns[:MAX_LLM_COLUMNS]]
+        if len(columns) > MAX_LLM_COLUMNS:
+            lines.append(f"... and {len(columns) - MAX_LLM_COLUMNS} more columns")
+        if t['sample']:
+            sample = pd.DataFrame(t['sample'])[columns[:MAX_LLM_COLUMNS]]
+            # CSV costs far fewer tokens than a markdown table
+            lines += ["", f"SAMPLE ROWS ({len(t['sample'])} of {t['rows']}, random, CSV):",
+                      sample.to_csv(index=False).strip()]
+        blocks.append("\n".join(lines))
+    return "\n\n".join(blocks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream a CSV / zipped CSV into Parquet and print its profile")
+    parser.add_argument("path")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+    parser.add_argument("--json", action="store_true", help="Print the full profile as JSON")
+    args = parser.parse_args()
+    text, cpp_data = ingest_csv(args.path, args.chunk_rows)
+    print(json.dumps(cpp_data, indent=2, ensure_ascii=False) if args.json else text)
+
+
+if __name__ == "__main__":
+    main()
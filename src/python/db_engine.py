@@ -1,81 +1,358 @@
-import chromadb
-from models import SessionLocal, Document
+import functools
+import threading
+from sqlalchemy import text, func, select, update, tuple_
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from models import Session, Document, Vendor, VendorAlias, VendorStats, MathCheck
+from field_parsing import extract_typed_fields
+from vendors import UNKNOWN_SLUG, normalize_vendor, vendor_slug, is_unknown, substrings
+from vendor_stats import new_stats, update_stats, sample_matrix, score_amounts, summarize
+from hybrid_search import build_fts_query, build_prefix_query, looks_like_identifier, reciprocal_rank_fusion
+from chunking import chunk_text
+from vector_index import LEGACY_COLLECTION, VectorWriter, get_active_collection_name, get_chroma_client
 import json
 import os
 import uuid
+import numpy as np
+
+_local = threading.local()
+
+def unit_of_work(method):
+    """
+    Wraps a public DatabaseEngine method in a unit of work: the outermost
+    call commits (or rolls back) and releases this thread's session, so no
+    transaction or pooled connection outlives the call. Nested calls just
+    join the running unit.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        depth = getattr(_local, "depth", 0)
+        _local.depth = depth + 1
+        try:
+            result = method(self, *args, **kwargs)
+            if depth == 0:
+                self.sql_db.commit()
+            return result
+        except Exception:
+            if depth == 0:
+                self.sql_db.rollback()
+            raise
+        finally:
+            _local.depth = depth
+            if depth == 0:
+                self.sql_db.remove()
+    return wrapper
 
 class DatabaseEngine:
+    """
+    Cheap to create: all instances share the process-wide SQL engine/pool
+    and Chroma client. Each thread works in its own scoped session.
+    """
     def __init__(self):
-        # 1. SQL Client (For Metadata/History)
-        self.sql_db = SessionLocal()
+        # 1. SQL Client (For Metadata/History): thread-local scoped session
+        self.sql_db = Session
         
-        # 2. Vector Client (For Semantic Search)
-        # Using a persistent path so it remembers vectors too
-        self.chroma_client = chromadb.PersistentClient(path="./data/xentro_vectors")
-        self.vector_col = self.chroma_client.get_or_create_collection("docs")
+        # 2. Vector Client (For Semantic Search), shared by the whole process
+        self.chroma_client = get_chroma_client()
+        self._vector_col = None
+
+    @property
+    def vector_col(self):
+        # One vector per overlapping chunk (not per document), see chunking.py.
+        # The live collection name can change after a full reindex (reindex.py).
+        name = get_active_collection_name()
+        if self._vector_col is None or self._vector_col.name != name:
+            self._vector_col = self.chroma_client.get_or_create_collection(name)
+        return self._vector_col
+
+    def _build_document(self, filename, filepath, text_content, ai_data, cpp_data, file_hash=None):
+        """Creates the SQL row for one processed file (not yet added to the session)."""
+        return Document(
+            id=str(uuid.uuid4()),
+            filename=filename,
+            file_path=filepath,
+            file_type=os.path.splitext(filename)[1].lower(),
+            file_size=os.path.getsize(filepath) if os.path.exists(filepath) else 0,
+            text_content=text_content,
+            ai_summary=ai_data.get('summary', 'No summary provided.'),
+            metadata_json=ai_data,
+            cpp_metrics=cpp_data,
+            file_hash=file_hash,
+            **extract_typed_fields(ai_data)
+        )
 
+    def _vector_meta(self, doc):
+        # We strip metadata to simple strings for Chroma compatibility
+        ai_data = doc.metadata_json or {}
+        return {
+            "filename": doc.filename,
+            "doc_id": doc.id,
+            "vendor": str(ai_data.get('vendor', 'Unknown')),
+            "total": str(ai_data.get('total_amount', '0'))
+        }
+
+    def _chunk_entries(self, doc):
+        """
+        Splits one document into Chroma entries (ids, texts, metadatas).
+        Each chunk carries its doc_id, offsets and (when known) page number.
+        """
+        base_meta = self._vector_meta(doc)
+        page_starts = (doc.cpp_metrics or {}).get('page_starts')
+        ids, texts, metas = [], [], []
+        for chunk in chunk_text(doc.text_content or "", page_starts=page_starts):
+            meta = dict(base_meta, chunk_index=chunk['index'],
+                        start=chunk['start'], end=chunk['end'])
+            if 'page' in chunk:
+                meta['page'] = chunk['page']
+            ids.append(f"{doc.id}:{chunk['index']}")
+            texts.append(chunk['text'])
+            metas.append(meta)
+        return ids, texts, metas
+
+    def _add_chunks(self, entries):
+        # Embeds and writes all chunks of all given docs in as few calls as possible
+        with VectorWriter(self.vector_col) as writer:
+            writer.add_entries(entries)
+
+    @unit_of_work
     def save_document(self, filename, filepath, text_content, ai_data, cpp_data, file_hash=None):
         """
         Saves to BOTH SQL (Record keeping) and Chroma (Search).
         """
-        try:
-            # A. Save to SQL (The System of Record)
-            new_doc = Document(
-                id=str(uuid.uuid4()),
-                filename=filename,
-                file_path=filepath,
-                file_type=os.path.splitext(filename)[1].lower(),
-                file_size=os.path.getsize(filepath) if os.path.exists(filepath) else 0,
-                text_content=text_content,
-                ai_summary=ai_data.get('summary', 'No summary provided.'),
-                metadata_json=ai_data,
-                cpp_metrics=cpp_data,
-                file_hash=file_hash
-            )
-            self.sql_db.add(new_doc)
-            self.sql_db.commit()
-            
-            # B. Save to Vector DB (The Search Engine)
-            # We strip metadata to simple strings for Chroma compatibility
-            simple_meta = {
-                "filename": filename,
-                "doc_id": new_doc.id,
-                "vendor": str(ai_data.get('vendor', 'Unknown')),
-                "total": str(ai_data.get('total_amount', '0'))
-            }
-            
-            self.vector_col.add(
-                documents=[text_content],
-                metadatas=[simple_meta],
-                ids=[new_doc.id]
+        # A. Save to SQL (The System of Record)
+        new_doc = self._build_document(filename, filepath, text_content, ai_data, cpp_data, file_hash)
+        entries = self._chunk_entries(new_doc)
+        new_doc.vendor_id = self.resolve_vendor_id(ai_data.get('vendor'))
+        self.update_vendor_stats(new_doc)
+        self.sql_db.add(new_doc)
+        self.sql_db.commit()
+
+        # B. Save to Vector DB (The Search Engine)
+        self._add_chunks([entries])
+
+        return new_doc.id
+
+    @unit_of_work
+    def save_documents(self, records):
+        """
+        Batch version of save_document for the ingestion pipeline.
+        One SQL transaction and one Chroma call for the whole batch.
+        Each record is a dict with the save_document arguments as keys.
+        Returns the new doc ids in record order.
+        """
+        if not records:
+            return []
+        new_docs = [
+            self._build_document(
+                r['filename'], r['filepath'], r['text_content'],
+                r['ai_data'], r['cpp_data'], r.get('file_hash')
             )
-            
-            return new_doc.id
-        except Exception as e:
-            self.sql_db.rollback()
-            raise e
-        finally:
-            self.sql_db.close()
+            for r in records
+        ]
+        entries = [self._chunk_entries(d) for d in new_docs]
+        for d in new_docs:
+            d.vendor_id = self.resolve_vendor_id((d.metadata_json or {}).get('vendor'))
+            self.update_vendor_stats(d)
+        self.sql_db.add_all(new_docs)
+        self.sql_db.commit()
+
+        self._add_chunks(entries)
+        return [d.id for d in new_docs]
 
+    @unit_of_work
     def get_recent_documents(self, limit=5):
         """Returns list of most recently processed files from SQL"""
-        docs = self.sql_db.query(Document).order_by(Document.processed_at.desc()).limit(limit).all()
-        self.sql_db.close()
-        return docs
+        return self.sql_db.query(Document).order_by(Document.processed_at.desc()).limit(limit).all()
         
-    def query_similar_docs(self, query_text, filename_filter=None, n_results=3):
-        """Semantic search in ChromaDB"""
-        where_filter = None
+    # Columns the document lists actually show. Text and JSON blobs stay on
+    # disk until a single document is opened (get_document).
+    LIST_COLUMNS = (
+        Document.id, Document.filename, Document.processed_at, Document.doc_type,
+        Document.doc_date, Document.total_amount, Document.currency,
+    )
+
+    @unit_of_work
+    def list_documents(self, limit=50, after=None, filename_query=None, **filters):
+        """
+        One page of the document list, newest first, as light rows
+        (LIST_COLUMNS + vendor). Keyset pagination: pass the `after` cursor
+        returned for the previous page, (processed_at, id) of its last row.
+        filename_query is matched by word prefix through the FTS index.
+        Filters are the same as filter_documents.
+        Returns (rows, next_cursor); next_cursor is None on the last page.
+        """
+        query = self.sql_db.query(*self.LIST_COLUMNS, Vendor.display_name.label("vendor")) \
+            .outerjoin(Vendor, Document.vendor_id == Vendor.id)
+        query = self._apply_field_filters(query, **filters)
+        if filename_query:
+            match = build_prefix_query(filename_query, column="filename")
+            if match:
+                query = query.filter(text(
+                    "documents.search_rowid IN (SELECT rowid FROM documents_fts WHERE documents_fts MATCH :fname)"
+                ).bindparams(fname=match))
+        if after:
+            query = query.filter(tuple_(Document.processed_at, Document.id) < tuple_(*after))
+
+        rows = query.order_by(Document.processed_at.desc(), Document.id.desc()).limit(limit + 1).all()
+        next_cursor = (rows[limit - 1].processed_at, rows[limit - 1].id) if len(rows) > limit else None
+        return rows[:limit], next_cursor
+
+    @unit_of_work
+    def get_document(self, doc_id):
+        """The full row (text, JSON, metrics) for one document, loaded on demand."""
+        return self.sql_db.get(Document, doc_id)
+
+    @unit_of_work
+    def count_documents(self):
+        return self.sql_db.query(Document.id).count()
+
+    @unit_of_work
+    def get_document_batch(self, columns, after_id=None, limit=500):
+        """
+        One keyset page (id > after_id, by id) of the named Document columns,
+        for corpus-wide jobs that walk every row in short units of work.
+        """
+        query = self.sql_db.query(*(getattr(Document, c) for c in columns))
+        if after_id is not None:
+            query = query.filter(Document.id > after_id)
+        return query.order_by(Document.id).limit(limit).all()
+
+    @unit_of_work
+    def save_math_checks(self, values):
+        """Upserts MathCheck rows (dicts keyed by column name), one per doc_id."""
+        if not values:
+            return
+        stmt = sqlite_insert(MathCheck).values(values)
+        self.sql_db.execute(stmt.on_conflict_do_update(
+            index_elements=["doc_id"],
+            set_={col: stmt.excluded[col] for col in values[0] if col != "doc_id"},
+        ))
+
+    @unit_of_work
+    def query_similar_docs(self, query_text, filename_filter=None, doc_id=None, n_results=3):
+        """
+        Hybrid (BM25 + semantic) search. Returns the top CHUNKS (not whole docs).
+        doc_id restricts the search to a single document.
+        """
+        return self.hybrid_search(query_text, n_results=n_results, doc_id=doc_id, filename_filter=filename_filter)
+
+    @unit_of_work
+    def search_lexical(self, query_text, n_results=10, doc_id=None, filename_filter=None):
+        """
+        BM25 full-text search over SQLite FTS5 (no embedding call).
+        Returns [{doc_id, filename, score, snippet}], best match first.
+        """
+        fts_query = build_fts_query(query_text)
+        if not fts_query:
+            return []
+
+        filters = ""
+        params = {"q": fts_query, "n": n_results}
+        if doc_id:
+            filters += " AND d.id = :doc_id"
+            params["doc_id"] = doc_id
         if filename_filter:
-            where_filter = {"filename": filename_filter}
-            
-        results = self.vector_col.query(
-            query_texts=[query_text],
-            n_results=n_results,
-            where=where_filter
-        )
-        return results
+            filters += " AND d.filename = :filename"
+            params["filename"] = filename_filter
+
+        # bm25(): lower is better; filename matches weigh double
+        sql = f"""
+            SELECT d.id, d.filename, bm25(documents_fts, 2.0, 1.0) AS score,
+                   snippet(documents_fts, 1, '', '', ' ... ', 64) AS snippet
+            FROM documents_fts
+            JOIN documents d ON d.search_rowid = documents_fts.rowid
+            WHERE documents_fts MATCH :q {filters}
+            ORDER BY score
+            LIMIT :n
+        """
+        try:
+            # Savepoint: a bad MATCH must not roll back the caller's unit of work
+            with self.sql_db.begin_nested():
+                rows = self.sql_db.execute(text(sql), params).fetchall()
+        except OperationalError:
+            # Malformed MATCH expression: treat as "no lexical hits"
+            return []
+        return [{"doc_id": r[0], "filename": r[1], "score": r[2], "snippet": r[3]} for r in rows]
+
+    @unit_of_work
+    def hybrid_search(self, query_text, n_results=10, doc_id=None, filename_filter=None):
+        """
+        Merges BM25 (FTS5) and Chroma results with reciprocal-rank fusion.
+        Identifier-like queries (invoice numbers, IBAN fragments...) use the
+        lexical index alone and only fall back to vectors when it finds nothing.
+        Returns a Chroma-shaped dict: {"ids": [[...]], "documents": [[...]], "metadatas": [[...]]}
+        """
+        lexical = self.search_lexical(query_text, n_results=n_results,
+                                      doc_id=doc_id, filename_filter=filename_filter)
+
+        chunks_by_doc = {}
+        vector_ranking = []
+        if not (lexical and looks_like_identifier(query_text)):
+            where_filter = None
+            if doc_id:
+                where_filter = {"doc_id": doc_id}
+            elif filename_filter:
+                where_filter = {"filename": filename_filter}
+            vector = self.vector_col.query(query_texts=[query_text], n_results=n_results, where=where_filter)
+            if vector['ids']:
+                for cid, text_chunk, meta in zip(vector['ids'][0], vector['documents'][0], vector['metadatas'][0]):
+                    did = meta.get('doc_id', cid)
+                    if did not in chunks_by_doc:
+                        chunks_by_doc[did] = []
+                        vector_ranking.append(did)
+                    chunks_by_doc[did].append((cid, text_chunk, meta))
+
+        lexical_by_doc = {hit['doc_id']: hit for hit in lexical}
+        fused = reciprocal_rank_fusion(vector_ranking, [hit['doc_id'] for hit in lexical])
+
+        ids, docs, metas = [], [], []
+        for did, score in fused:
+            if did in chunks_by_doc:
+                passages = chunks_by_doc[did]
+            else:
+                hit = lexical_by_doc[did]
+                passages = [(f"{did}:fts", hit['snippet'],
+                             {"doc_id": did, "filename": hit['filename'], "source": "lexical"})]
+            for cid, text_chunk, meta in passages:
+                ids.append(cid)
+                docs.append(text_chunk)
+                metas.append(dict(meta, rrf_score=score))
+            if len(ids) >= n_results:
+                break
+
+        n = n_results
+        return {"ids": [ids[:n]], "documents": [docs[:n]], "metadatas": [metas[:n]]}
 
+    @unit_of_work
+    def rebuild_chunk_index(self, batch_size=50):
+        """
+        Indexes every SQL document that has no chunks yet
+        (e.g. rows saved before chunked indexing existed).
+        One Chroma lookup per batch of documents, not per document.
+        Returns the number of documents indexed.
+        """
+        indexed = 0
+        with VectorWriter(self.vector_col) as writer:
+            docs = self.sql_db.execute(select(Document).execution_options(yield_per=batch_size)).scalars()
+            for batch in docs.partitions():
+                found = self.vector_col.get(where={"doc_id": {"$in": [d.id for d in batch]}},
+                                            include=["metadatas"])
+                has_chunks = {m['doc_id'] for m in found['metadatas'] or []}
+                for doc in batch:
+                    if doc.id not in has_chunks:
+                        writer.add_entries([self._chunk_entries(doc)])
+                        indexed += 1
+        return indexed
+
+    def drop_legacy_collection(self):
+        """Deletes the pre-chunking per-document collection, if it is still on disk."""
+        try:
+            self.chroma_client.delete_collection(LEGACY_COLLECTION)
+            return True
+        except Exception:
+            return False  # Never existed / already dropped
+
+    @unit_of_work
     def check_file_hash(self, file_hash):
         """
         Checks if a file with this hash already exists.
@@ -83,71 +360,296 @@ class DatabaseEngine:
         """
         return self.sql_db.query(Document).filter(Document.file_hash == file_hash).first()
 
+    @unit_of_work
+    def find_known_hashes(self, file_hashes, batch_size=500):
+        """
+        Bulk version of check_file_hash for a whole upload batch.
+        Returns the subset of hashes already in the database.
+        Queried in chunks to stay under SQLite's bound-parameter limit.
+        """
+        hashes = list({h for h in file_hashes if h})
+        known = set()
+        for i in range(0, len(hashes), batch_size):
+            chunk = hashes[i:i + batch_size]
+            rows = self.sql_db.query(Document.file_hash).filter(Document.file_hash.in_(chunk)).all()
+            known.update(r[0] for r in rows)
+        return known
+
+    @unit_of_work
+    def has_legacy_hashes(self):
+        """True if any row still carries an MD5 (32 hex chars) file hash."""
+        row = self.sql_db.query(Document.file_hash).filter(func.length(Document.file_hash) == 32).first()
+        return row is not None
+
+    @unit_of_work
     def query_global_context(self, query_text, n_results=10):
         """
         Searches the ENTIRE Knowledge Base (All Vendors, All Dates).
-        Used for 'Cross-Document' intelligence.
+        Used for 'Cross-Document' intelligence. Returns the top chunks
+        from hybrid (BM25 + semantic) search.
+        """
+        # No filter = Search everything
+        return self.hybrid_search(query_text, n_results=n_results)
+
+
+    # ==========================================
+    # VENDORS (Indexed resolution)
+    # ==========================================
+    def resolve_vendor_id(self, raw_name):
+        """
+        Maps a raw vendor string to a vendors.id, creating the vendor and/or
+        alias on first sight. Runs inside the caller's transaction.
         """
-        # No 'where' filter = Search everything in the vector store
-        results = self.vector_col.query(
-            query_texts=[query_text],
-            n_results=n_results
+        if is_unknown(raw_name):
+            alias, slug, display = UNKNOWN_SLUG, UNKNOWN_SLUG, "Unknown"
+        else:
+            alias, slug, display = normalize_vendor(raw_name), vendor_slug(raw_name), str(raw_name).strip()
+
+        # 1. Known spelling -> done (primary key lookup)
+        vendor_id = self.sql_db.query(VendorAlias.vendor_id).filter(VendorAlias.alias_slug == alias).scalar()
+        if vendor_id is not None:
+            return vendor_id
+
+        # 2. New spelling: find or create the canonical vendor, then record the alias.
+        # INSERT OR IGNORE keeps concurrent writers from tripping over each other.
+        self.sql_db.execute(
+            sqlite_insert(Vendor).values(slug=slug, display_name=display)
+            .on_conflict_do_nothing(index_elements=['slug'])
+        )
+        vendor_id = self.sql_db.query(Vendor.id).filter(Vendor.slug == slug).scalar()
+        self.sql_db.execute(
+            sqlite_insert(VendorAlias).values(alias_slug=alias, vendor_id=vendor_id, raw_name=display)
+            .on_conflict_do_nothing(index_elements=['alias_slug'])
         )
-        return results
+        return vendor_id
+
+    @unit_of_work
+    def match_vendor_ids(self, vendor_name):
+        """
+        Vendor ids whose alias contains the name, or is contained in it
+        (e.g. "superstore" <-> "superstoreinc"). Both sides are index lookups:
+        a trigram FTS match one way, a primary-key IN list the other way.
+        """
+        target = normalize_vendor(vendor_name)
+        # If the vendor name is too short (e.g. "A"), don't fuzzy match to avoid garbage results
+        if len(target) < 3:
+            return set()
 
+        ids = {
+            r[0] for r in self.sql_db.execute(text("""
+                SELECT a.vendor_id FROM vendor_alias_trigrams t
+                JOIN vendor_aliases a ON a.search_rowid = t.rowid
+                WHERE vendor_alias_trigrams MATCH :q
+            """), {"q": f'"{target}"'})
+        }
+        parts = list(substrings(target))
+        for i in range(0, len(parts), 500):
+            rows = self.sql_db.query(VendorAlias.vendor_id).filter(VendorAlias.alias_slug.in_(parts[i:i + 500])).all()
+            ids.update(r[0] for r in rows)
+        return ids
 
-    def get_vendor_history(self, vendor_name, exclude_filename=None):
+    @unit_of_work
+    def get_vendor_history(self, vendor_name, exclude_filename=None, limit=10):
         """
         Fetches past invoices using NORMALIZED MATCHING (Ignores spaces/case/symbols).
+        Searches the full history through the vendor index, not just recent rows.
         """
-        import re
-        
-        # Helper: "Super Store Inc." -> "superstore"
-        def normalize(text):
-            if not text: return ""
-            # Remove all non-alphanumeric chars and convert to lower
-            return re.sub(r'[^a-z0-9]', '', str(text).lower())
+        vendor_ids = self.match_vendor_ids(vendor_name)
+        if not vendor_ids:
+            return []
 
-        target_slug = normalize(vendor_name)
-        # If the vendor name is too short (e.g. "A"), don't fuzzy match to avoid garbage results
-        if len(target_slug) < 3: return []
+        query = self.sql_db.query(
+            Document.filename, Document.doc_date, Document.total_amount,
+            Document.currency, Vendor.display_name
+        ).join(Vendor, Document.vendor_id == Vendor.id) \
+            .filter(Document.vendor_id.in_(vendor_ids))
+        if exclude_filename:
+            query = query.filter(Document.filename != exclude_filename)
+        rows = query.order_by(Document.processed_at.desc()).limit(limit).all()
 
-        # Fetch recent docs
-        all_docs = self.sql_db.query(Document).order_by(Document.processed_at.desc()).limit(100).all()
-        
-        history = []
-        for doc in all_docs:
-            if exclude_filename and doc.filename == exclude_filename:
-                continue
-                
-            stored_vendor = doc.metadata_json.get('vendor', '')
-            stored_slug = normalize(stored_vendor)
-            
-            # LOGIC: Check if one contains the other
-            # e.g. target="superstore", stored="superstoreinc" -> Match!
-            if target_slug in stored_slug or stored_slug in target_slug:
-                history.append({
-                    "date": doc.metadata_json.get('date', 'Unknown'),
-                    "total": doc.metadata_json.get('total_amount', '0'),
-                    "vendor_name": stored_vendor, # Return original name for context
-                    "filename": doc.filename
-                })
-        
-        return history[:10]
+        return [{
+            "date": r.doc_date.isoformat() if r.doc_date else 'Unknown',
+            "total": r.total_amount if r.total_amount is not None else 0.0,
+            "currency": r.currency,
+            "vendor_name": r.display_name,
+            "filename": r.filename
+        } for r in rows]
     
+    @unit_of_work
     def get_all_vendors(self):
         """
         Returns a frequency map of all vendors in the database.
-        Used for the 'Database Inspector' UI.
+        Used for the 'Database Inspector' UI. One GROUP BY over the vendor index.
         """
-        # Query all documents
-        all_docs = self.sql_db.query(Document).all()
-        
-        # Tally up the vendors
+        rows = self.sql_db.query(Vendor.display_name, func.count(Document.id)) \
+            .join(Document, Document.vendor_id == Vendor.id) \
+            .group_by(Vendor.id).all()
         vendor_counts = {}
-        for d in all_docs:
-            # Extract vendor from the JSON blob
-            v = d.metadata_json.get('vendor', 'Unknown')
-            vendor_counts[v] = vendor_counts.get(v, 0) + 1
-            
-        return vendor_counts
\ No newline at end of file
+        for name, count in rows:
+            vendor_counts[name] = vendor_counts.get(name, 0) + count
+        return vendor_counts
+
+
+    # ==========================================
+    # VENDOR BASELINES (Running stats + outlier scoring)
+    # ==========================================
+    STATS_FIELDS = tuple(new_stats())
+
+    # Documents scored per vectorized pass (each carries a SKETCH_SIZE sample row)
+    SCORE_BATCH = 10000
+
+    def update_vendor_stats(self, doc):
+        """
+        Folds a new document's amount into its vendor's running stats.
+        Runs inside the caller's transaction, so stats and rows commit together.
+        """
+        if doc.vendor_id is None or doc.total_amount is None:
+            return
+        key = (doc.vendor_id, doc.currency or "")
+        # A no-op UPDATE takes SQLite's write lock before we read, so two
+        # concurrent savers can't both read the same stats and lose an update
+        self.sql_db.flush()
+        self.sql_db.execute(
+            update(VendorStats).where(VendorStats.vendor_id == key[0], VendorStats.currency == key[1])
+            .values(count=VendorStats.count)
+        )
+        row = self.sql_db.get(VendorStats, key, populate_existing=True)
+        if row is None:
+            row = VendorStats(vendor_id=key[0], currency=key[1], **new_stats())
+            self.sql_db.add(row)
+            self.sql_db.flush()  # Next doc of this vendor in the same batch must find it
+        stats = update_stats({f: getattr(row, f) for f in self.STATS_FIELDS}, doc.total_amount, doc.doc_date)
+        for field, value in stats.items():
+            setattr(row, field, value)
+
+    @unit_of_work
+    def get_vendor_baseline(self, doc):
+        """
+        Compact numeric summary of the document vendor's history (same
+        currency), with the document's own amount scored against it.
+        Returns None when there is nothing to compare against.
+        """
+        if doc.vendor_id is None:
+            return None
+        row = self.sql_db.get(VendorStats, (doc.vendor_id, doc.currency or ""))
+        if row is None:
+            return None
+        summary = summarize({f: getattr(row, f) for f in self.STATS_FIELDS}, doc.total_amount)
+        summary["vendor"] = self.sql_db.query(Vendor.display_name).filter(Vendor.id == doc.vendor_id).scalar()
+        summary["currency"] = doc.currency
+        if doc.doc_date:
+            previous = self.sql_db.query(func.max(Document.doc_date)).filter(
+                Document.vendor_id == doc.vendor_id, Document.doc_date < doc.doc_date
+            ).scalar()
+            if previous:
+                summary["days_since_previous"] = (doc.doc_date - previous).days
+        return summary
+
+    @unit_of_work
+    def score_all_documents(self, limit=None):
+        """
+        Scores every document against its vendor baseline in two queries and
+        vectorized passes of SCORE_BATCH documents. Returns rows ranked most anomalous first;
+        documents without enough vendor history are left out.
+        """
+        # Each vendor's stats (with its reservoir sample) are read once, not per document
+        stats = self.sql_db.query(
+            VendorStats.vendor_id, VendorStats.currency, VendorStats.count, VendorStats.mean,
+            VendorStats.m2, VendorStats.median, VendorStats.sample
+        ).all()
+        key_index = {(s.vendor_id, s.currency): i for i, s in enumerate(stats)}
+        docs = self.sql_db.query(
+            Document.id, Document.filename, Document.total_amount, Document.currency,
+            Document.vendor_id, Vendor.display_name
+        ).join(Vendor, Vendor.id == Document.vendor_id) \
+            .filter(Document.total_amount.isnot(None)).all()
+        rows = [d for d in docs if (d.vendor_id, d.currency or "") in key_index]
+        if not rows:
+            return []
+
+        k = np.array([key_index[(r.vendor_id, r.currency or "")] for r in rows])
+        amounts = np.array([r.total_amount for r in rows], dtype=float)
+        count, mean, m2 = (np.array([getattr(s, f) for s in stats], dtype=float)[k]
+                           for f in ("count", "mean", "m2"))
+        samples = sample_matrix([s.sample for s in stats])
+        z, robust_z, anomaly = (np.concatenate(parts) for parts in zip(*(
+            score_amounts(amounts[i:i + self.SCORE_BATCH], count[i:i + self.SCORE_BATCH], mean[i:i + self.SCORE_BATCH],
+                          m2[i:i + self.SCORE_BATCH], samples[k[i:i + self.SCORE_BATCH]])
+            for i in range(0, len(rows), self.SCORE_BATCH)
+        )))
+        ranked = np.argsort(-np.nan_to_num(anomaly, nan=-1.0))
+        ranked = [i for i in ranked if np.isfinite(anomaly[i])][:limit]
+
+        return [{
+            "doc_id": rows[i].id,
+            "filename": rows[i].filename,
+            "vendor": rows[i].display_name,
+            "currency": rows[i].currency,
+            "total": rows[i].total_amount,
+            "vendor_median": stats[k[i]].median,
+            "z_score": None if np.isnan(z[i]) else round(float(z[i]), 2),
+            "robust_z_score": None if np.isnan(robust_z[i]) else round(float(robust_z[i]), 2),
+            "anomaly_score": round(float(anomaly[i]), 2),
+            "is_outlier": bool(anomaly[i] > 1),
+        } for i in ranked]
+
+    # ==========================================
+    # TYPED FIELD QUERIES (Filters + Aggregates in SQL)
+    # ==========================================
+    def _apply_field_filters(self, query, doc_type=None, currency=None, vendor_ids=None,
+                             min_amount=None, max_amount=None, date_from=None, date_to=None):
+        if doc_type:
+            query = query.filter(Document.doc_type == doc_type)
+        if currency:
+            query = query.filter(Document.currency == currency)
+        if vendor_ids:
+            query = query.filter(Document.vendor_id.in_(vendor_ids))
+        if min_amount is not None:
+            query = query.filter(Document.total_amount >= min_amount)
+        if max_amount is not None:
+            query = query.filter(Document.total_amount <= max_amount)
+        if date_from:
+            query = query.filter(Document.doc_date >= date_from)
+        if date_to:
+            query = query.filter(Document.doc_date <= date_to)
+        return query
+
+    @unit_of_work
+    def filter_documents(self, limit=100, **filters):
+        """
+        Documents matching typed-field filters, newest first.
+        Filters: doc_type, currency, vendor_ids, min_amount, max_amount, date_from, date_to.
+        """
+        query = self._apply_field_filters(self.sql_db.query(Document), **filters)
+        return query.order_by(Document.processed_at.desc()).limit(limit).all()
+
+    @unit_of_work
+    def get_doc_types(self):
+        rows = self.sql_db.query(Document.doc_type).filter(Document.doc_type.isnot(None)).distinct().all()
+        return sorted(r[0] for r in rows)
+
+    @unit_of_work
+    def get_spend_summary(self, group_by="currency", **filters):
+        """
+        SUM/COUNT of total_amount computed by SQL.
+        group_by: "currency", "vendor", "type" or "month". Results are always
+        split by currency too, so different currencies are never added together.
+        Returns [{"key", "currency", "count", "total"}], biggest total first.
+        """
+        keys = {
+            "currency": Document.currency,
+            "vendor": Vendor.display_name,
+            "type": Document.doc_type,
+            "month": func.strftime('%Y-%m', Document.doc_date),
+        }
+        key_col = keys[group_by].label("key")
+        query = self.sql_db.query(
+            key_col, Document.currency,
+            func.count(Document.id), func.coalesce(func.sum(Document.total_amount), 0.0)
+        )
+        if group_by == "vendor":
+            query = query.join(Vendor, Document.vendor_id == Vendor.id)
+        query = self._apply_field_filters(query, **filters)
+        rows = query.group_by(key_col, Document.currency).all()
+        summary = [{"key": k, "currency": c, "count": n, "total": t} for k, c, n, t in rows]
+        return sorted(summary, key=lambda r: r['total'], reverse=True)
@@ -0,0 +1,197 @@
+"""
+Map-reduce helpers for analyzing long documents.
+
+Long texts are split into page-aligned segments (split_segments), each
+segment is analyzed on its own, and the per-segment JSON results are merged
+back into one analysis (merge_segment_results).
+"""
+from chunking import chunk_text
+from vendors import normalize_vendor
+
+# Up to this size a document is analyzed in one call, as before
+SINGLE_CALL_CHARS = 30000
+
+# Target size of one segment (~6k tokens)
+SEGMENT_CHARS = 24000
+
+# specific_data keys whose value belongs to the END of a document
+# (a total on the last page beats a carried-over subtotal on page 1)
+LAST_WINS = {
+    "total", "total_amount", "tax", "subtotal", "balance", "closing_balance",
+    "amount_due", "balance_due", "total_deposits", "total_withdrawals", "contract_value",
+}
+
+
+def page_spans(text, page_starts=None):
+    """
+    [(start, end, page_number)] for each page. Uses the extractor's page
+    offsets when known, otherwise form feeds, otherwise one single "page".
+    """
+    if page_starts:
+        starts = [s for s in page_starts if 0 <= s < len(text)] or [0]
+    elif "\f" in text:
+        starts = [0] + [i + 1 for i, c in enumerate(text) if c == "\f" and i + 1 < len(text)]
+    else:
+        starts = [0]
+    ends = starts[1:] + [len(text)]
+    return [(s, e, n) for n, (s, e) in enumerate(zip(starts, ends), start=1)]
+
+
+class SegmentBuilder:
+    """
+    Groups pages into segments of at most max_chars as the pages arrive, so
+    a streamed document can be analyzed before its last page is extracted.
+    add() returns the segments a new page completed; finish() the last one.
+    A page larger than max_chars is split on sentence/line boundaries.
+    """
+
+    def __init__(self, max_chars=SEGMENT_CHARS):
+        self.max_chars = max_chars
+        self.current = None
+        self.count = 0
+
+    def _pieces(self, text, start):
+        if len(text) <= self.max_chars:
+            return [(start, text)]
+        cuts = [c['start'] for c in chunk_text(text, chunk_tokens=self.max_chars // 4, overlap_tokens=0)]
+        cuts = [0] + cuts[1:] + [len(text)]
+        return [(start + a, text[a:b]) for a, b in zip(cuts, cuts[1:])]
+
+    def _close(self):
+        seg, self.current = self.current, None
+        seg['index'] = self.count
+        seg['text'] = "".join(seg.pop('parts'))
+        self.count += 1
+        return seg
+
+    def add(self, text, page, start):
+        done = []
+        for piece_start, piece in self._pieces(text, start):
+            end = piece_start + len(piece)
+            if self.current and end - self.current['start'] <= self.max_chars:
+                self.current['parts'].append(piece)
+                self.current['end'] = end
+                self.current['last_page'] = page
+                continue
+            if self.current:
+                done.append(self._close())
+            self.current = {"start": piece_start, "end": end, "first_page": page, "last_page": page, "parts": [piece]}
+        return done
+
+    def finish(self):
+        return [self._close()] if self.current else []
+
+
+def split_segments(text, page_starts=None, max_chars=SEGMENT_CHARS):
+    """
+    Groups whole pages of a finished text into segments (see SegmentBuilder).
+    Returns [{index, text, start, end, first_page, last_page}].
+    """
+    builder = SegmentBuilder(max_chars)
+    segments = []
+    for start, end, page in page_spans(text, page_starts):
+        segments += builder.add(text[start:end], page, start)
+    return segments + builder.finish()
+
+
+def _empty(val):
+    return val is None or (isinstance(val, str) and val.strip().lower() in ("", "null", "none", "n/a", "unknown"))
+
+
+def _source(seg):
+    return {"segment": seg['index'], "pages": [seg['first_page'], seg['last_page']]}
+
+
+def _merge_parties(target, values, seen):
+    # The same party is usually named on several pages
+    for item in values if isinstance(values, list) else [values]:
+        if _empty(item):
+            continue
+        key = normalize_vendor(item) if isinstance(item, str) else repr(item)
+        if key not in seen:
+            seen.add(key)
+            target.append(item)
+
+
+def merge_segment_results(results, segments):
+    """
+    Reduce step: one analysis from the per-segment results (same order as
+    segments). Failed segments (type ERROR or not a dict) are skipped.
+    - type / language: confidence-weighted vote
+    - vendor / date: first segment that has them (letterhead, issue date)
+    - total_amount / currency and LAST_WINS fields: last segment that has them
+    - parties: union in document order; list fields (line items): concatenated
+    - every field's origin goes into "field_sources"
+    """
+    pairs = [(r, s) for r, s in zip(results, segments) if isinstance(r, dict) and r.get('type') != "ERROR"]
+    if not pairs:
+        return None
+
+    merged = {"field_sources": {}, "segments": len(segments)}
+    sources = merged['field_sources']
+
+    for field in ("type", "language"):
+        votes = {}
+        for r, _ in pairs:
+            if not _empty(r.get(field)):
+                votes[r[field]] = votes.get(r[field], 0) + (r.get('confidence_score') or 1)
+        merged[field] = max(votes, key=votes.get) if votes else None
+
+    for field in ("vendor", "date"):
+        for r, seg in pairs:
+            if not _empty(r.get(field)):
+                merged[field] = r[field]
+                sources[field] = _source(seg)
+                break
+        else:
+            merged[field] = None
+
+    # Totals (and their currency) come from the same, latest segment
+    merged['total_amount'] = merged['currency'] = None
+    for r, seg in reversed(pairs):
+        if not _empty(r.get('total_amount')):
+            merged['total_amount'] = r['total_amount']
+            merged['currency'] = r.get('currency') if not _empty(r.get('currency')) else None
+            sources['total_amount'] = _source(seg)
+            break
+    if merged['currency'] is None:
+        for r, seg in pairs:
+            if not _empty(r.get('currency')):
+                merged['currency'] = r['currency']
+                break
+
+    parties, seen = [], set()
+    for r, _ in pairs:
+        _merge_parties(parties, r.get('parties') or [], seen)
+    merged['parties'] = parties
+
+    # Segments don't overlap, so list fields (line items, transactions) are
+    # simply concatenated in page order
+    specific = {}
+    for r, seg in pairs:
+        for key, val in (r.get('specific_data') or {}).items():
+            if _empty(val):
+                continue
+            if isinstance(val, list) and isinstance(specific.get(key, []), list):
+                specific.setdefault(key, []).extend(v for v in val if not _empty(v))
+                sources.setdefault(f"specific_data.{key}", []).append(seg['index'])
+            elif key in LAST_WINS or key not in specific:
+                specific[key] = val
+                sources[f"specific_data.{key}"] = _source(seg)
+    merged['specific_data'] = specific
+
+    scores = [r.get('confidence_score') for r, _ in pairs if isinstance(r.get('confidence_score'), (int, float))]
+    merged['confidence_score'] = round(min(scores)) if scores else None
+
+    summaries = [r.get('summary') for r, _ in pairs if not _empty(r.get('summary'))]
+    summary = summaries[0] if summaries else ""
+    if len(segments) > 1:
+        last_page = segments[-1]['last_page']
+        summary += f" (Analyzed in {len(segments)} parts" + (f", {last_page} pages)" if last_page > 1 else ")")
+    merged['summary'] = summary.strip()
+    if len(pairs) < len(segments):
+        merged['failed_segments'] = [
+            s['index'] for r, s in zip(results, segments)
+            if not isinstance(r, dict) or r.get('type') == "ERROR"
+        ]
+    return merged
@@ -0,0 +1,241 @@
+import itertools
+import json
+import os
+import queue
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class DocprocError(RuntimeError):
+    """Raised when a docproc worker crashes, times out or returns garbage."""
+
+
+class DocprocTimeout(DocprocError):
+    """Raised when a job runs longer than the pool timeout."""
+
+
+def join_pages(pages):
+    """
+    Rebuilds docproc's content layout (each page's text + "\n") from the
+    streamed page lines. Returns (content, page_starts). Offsets are counted
+    here, in Python characters, so they always match the joined string.
+    """
+    parts, page_starts, offset = [], [], 0
+    for page in pages:
+        page_starts.append(offset)
+        parts.append(page['text'] + "\n")
+        offset += len(page['text']) + 1
+    return "".join(parts), page_starts
+
+
+class DocprocWorker:
+    """
+    One long-lived `docproc --server` process.
+    Jobs go in as JSON lines on stdin, results come back as JSON lines on stdout.
+    PDFs stream one {"event": "page"} line per page before their result line.
+    """
+
+    def __init__(self, binary_path, pdf_threads=None, debug_images=False):
+        self.jobs_done = 0
+        args = [binary_path, "--server"]
+        if pdf_threads:
+            args[1:1] = ["--threads", str(pdf_threads)]
+        if debug_images:
+            args[1:1] = ["--debug-images"]
+        self.proc = subprocess.Popen(
+            args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,  # [CPP-DEBUG] logs are not needed here
+            text=True,
+            bufsize=1,
+        )
+        # A reader thread lets us wait on stdout with a timeout
+        self._lines = queue.Queue()
+        self._reader = threading.Thread(target=self._read_stdout, daemon=True)
+        self._reader.start()
+
+    def _read_stdout(self):
+        for line in self.proc.stdout:
+            self._lines.put(line)
+        self._lines.put(None)  # EOF = the process died
+
+    def is_alive(self):
+        return self.proc.poll() is None
+
+    def run(self, job_id, path, timeout, on_page=None):
+        """
+        Sends one job and blocks until its result line arrives.
+        on_page(page) is called for every streamed page, in order, with
+        "start"/"end" set to its offsets in the joined content. The timeout
+        counts from the last line received, so a long PDF that keeps
+        producing pages is not killed as hung.
+        """
+        pages = []
+        try:
+            self.proc.stdin.write(json.dumps({"id": job_id, "path": path}) + "\n")
+            self.proc.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            raise DocprocError(f"Worker crashed before accepting job: {e}")
+
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise DocprocTimeout(f"Timed out after {timeout}s on {path}")
+            try:
+                line = self._lines.get(timeout=remaining)
+            except queue.Empty:
+                raise DocprocTimeout(f"Timed out after {timeout}s on {path}")
+
+            if line is None:
+                raise DocprocError(f"Worker crashed on {path}")
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # Ignore stray non-JSON output
+            if result.get("id") != job_id:
+                continue
+            if result.get("event") == "page":
+                result['start'] = pages[-1]['end'] + 1 if pages else 0
+                result['end'] = result['start'] + len(result['text'])
+                pages.append(result)
+                deadline = time.monotonic() + timeout
+                if on_page:
+                    on_page(result)
+                continue
+
+            self.jobs_done += 1
+            if pages:
+                result['content'], result['page_starts'] = join_pages(pages)
+            return result
+
+    def stop(self):
+        """Closes stdin (the worker exits on EOF) and kills it if it hangs."""
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.proc.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+
+class DocprocPool:
+    """
+    Keeps N `docproc --server` workers warm so Tesseract is loaded once per
+    worker instead of once per file.
+
+    - Timeouts: the stuck worker is killed and replaced, the job fails.
+    - Crashes: the worker is replaced and the job is retried (`crash_retries`).
+    - Recycling: a worker is restarted after `max_jobs_per_worker` jobs
+      to cap any slow memory growth inside Tesseract/Poppler.
+    """
+
+    def __init__(self, binary_path="./build/docproc", size=None,
+                 timeout=120, max_jobs_per_worker=200, crash_retries=1, pdf_threads=None,
+                 debug_images=False):
+        self.binary_path = binary_path
+        self.size = size or os.cpu_count() or 2
+        self.pdf_threads = pdf_threads  # None = docproc uses one thread per core
+        self.debug_images = debug_images  # keep docproc's intermediate OCR images
+        self.timeout = timeout
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.crash_retries = crash_retries
+
+        # Each slot holds a worker, or None until it is first needed
+        self._slots = queue.Queue()
+        for _ in range(self.size):
+            self._slots.put(None)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._workers = set()
+        self._closed = False
+
+    def _spawn(self):
+        try:
+            worker = DocprocWorker(self.binary_path, self.pdf_threads, self.debug_images)
+        except OSError as e:
+            raise DocprocError(f"Could not start {self.binary_path}: {e}")
+        with self._lock:
+            self._workers.add(worker)
+        return worker
+
+    def _retire(self, worker):
+        if worker is None:
+            return
+        worker.stop()
+        with self._lock:
+            self._workers.discard(worker)
+
+    def process(self, path, timeout=None, on_page=None):
+        """
+        Extracts one file on the next free worker.
+        Returns the docproc JSON dict, raises DocprocError on failure.
+        on_page: see DocprocWorker.run. A crash after pages were already
+        delivered is not retried, so no page is ever delivered twice.
+        """
+        if self._closed:
+            raise DocprocError("Pool is closed")
+
+        timeout = timeout or self.timeout
+        attempts = self.crash_retries + 1
+        delivered = []
+
+        def _on_page(page):
+            delivered.append(page['page'])
+            on_page(page)
+        worker = self._slots.get()
+        try:
+            for attempt in range(attempts):
+                if worker is None or not worker.is_alive():
+                    self._retire(worker)
+                    worker = self._spawn()
+                try:
+                    return worker.run(next(self._ids), path, timeout, _on_page if on_page else None)
+                except DocprocTimeout:
+                    # A hung job is not retried, it would just hang again
+                    self._retire(worker)
+                    worker = None
+                    raise
+                except DocprocError:
+                    self._retire(worker)
+                    worker = None
+                    if attempt == attempts - 1 or delivered:
+                        raise
+        finally:
+            if worker is not None and worker.jobs_done >= self.max_jobs_per_worker:
+                self._retire(worker)
+                worker = None
+            self._slots.put(worker)
+
+    def map(self, paths, timeout=None):
+        """
+        Runs many files across all workers.
+        Returns results in input order; failures come back as error dicts.
+        """
+        def _safe(path):
+            try:
+                return self.process(path, timeout)
+            except DocprocError as e:
+                return {"status": "error", "filepath": path, "error": str(e)}
+
+        with ThreadPoolExecutor(max_workers=self.size) as ex:
+            return list(ex.map(_safe, paths))
+
+    def close(self):
+        self._closed = True
+        with self._lock:
+            workers = list(self._workers)
+        for w in workers:
+            self._retire(w)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,173 @@
+import datetime
+import re
+
+# Bump when the parsers below change; the backfill migration re-parses
+# every row stored with an older version.
+FIELDS_VERSION = 3
+
+# Matched at the start or end of a token only ("$12", "12€", "Rs.500"),
+# never inside a word ("DOLLARS" contains "RS")
+CURRENCY_SYMBOLS = {
+    "US$": "USD", "$": "USD", "€": "EUR", "£": "GBP", "¥": "JPY",
+    "₹": "INR", "RS.": "PKR", "RS": "PKR", "CHF": "CHF", "FR.": "CHF",
+}
+
+# Spelled-out currencies, longest phrase first
+CURRENCY_WORDS = [
+    ("pakistani rupee", "PKR"), ("indian rupee", "INR"), ("canadian dollar", "CAD"),
+    ("australian dollar", "AUD"), ("swiss franc", "CHF"), ("us dollar", "USD"),
+    ("dollar", "USD"), ("euro", "EUR"), ("pound", "GBP"), ("sterling", "GBP"),
+    ("yen", "JPY"), ("rupee", "INR"), ("franc", "CHF"),
+]
+_CURRENCY_WORD = re.compile(r"\b(" + "|".join(w for w, _ in CURRENCY_WORDS) + r")s?\b", re.IGNORECASE)
+_WORD_CODES = dict(CURRENCY_WORDS)
+_ISO_TOKEN = re.compile(r"^[A-Z]{3}$")
+
+# A minus right before the number ("-5", "USD -5.00", "-$5", "$ -5") or an
+# accounting minus after it ("5.00-"); not the dash in "10-5"
+_NEGATIVE = re.compile(r"(?<![\d\w])-\s*(?:[^\d\s]{1,4}\s*)?\d|\d-\s*$")
+
+DATE_FORMATS = (
+    "%Y-%m-%d", "%Y/%m/%d", "%d.%m.%Y",
+    "%b %d %Y", "%b %d, %Y", "%d %b %Y", "%B %d %Y", "%B %d, %Y", "%d %B %Y",
+)
+
+# "03/04/2024" is read day-first unless the document's currency points to a
+# month-first locale; with no currency at all an ambiguous date stays unparsed
+_SLASH_DATE = re.compile(r"^(\d{1,2})/(\d{1,2})/(\d{4})$")
+MONTH_FIRST_CURRENCIES = {"USD"}
+
+_THOUSANDS_COMMA = re.compile(r"^\d{1,3}(,\d{3})+$")
+_THOUSANDS_DOT = re.compile(r"^\d{1,3}(\.\d{3}){2,}$")
+
+
+def _is_empty(val):
+    return val is None or str(val).strip().lower() in ("", "none", "null", "n/a", "unknown")
+
+
+def parse_amount(val):
+    """
+    "$1,234.56" -> 1234.56, "1.234,56 €" -> 1234.56, "(12.00)" -> -12.0
+    Returns None when there is no number.
+    """
+    if isinstance(val, (int, float)):
+        return float(val)
+    if _is_empty(val):
+        return None
+
+    text = str(val).strip()
+    negative = text.startswith("(") and text.endswith(")") or bool(_NEGATIVE.search(text))
+    number = re.sub(r"[^0-9.,]", "", text)
+    if not number or not any(c.isdigit() for c in number):
+        return None
+
+    if "," in number and "." in number:
+        # Whichever comes last is the decimal separator
+        if number.rfind(",") > number.rfind("."):
+            number = number.replace(".", "").replace(",", ".")
+        else:
+            number = number.replace(",", "")
+    elif "," in number:
+        number = number.replace(",", "") if _THOUSANDS_COMMA.match(number) else number.replace(",", ".")
+    elif _THOUSANDS_DOT.match(number):
+        number = number.replace(".", "")
+
+    try:
+        amount = float(number)
+    except ValueError:
+        return None
+    return -amount if negative else amount
+
+
+def parse_currency(currency, amount_text=None):
+    """ISO-4217 code from the AI's currency field, falling back to a symbol in the amount."""
+    for candidate in (currency, amount_text):
+        if _is_empty(candidate):
+            continue
+        text = str(candidate).strip().upper()
+        if _ISO_TOKEN.match(text):
+            return text
+        code = _currency_from_tokens(text)
+        if code:
+            return code
+        word = _CURRENCY_WORD.search(text)
+        if word:
+            return _WORD_CODES[word.group(1).lower()]
+    return None
+
+
+def _currency_from_tokens(text):
+    # "USD 12.00" / "12.00 EUR": an ISO code as its own token next to the amount
+    tokens = text.split()
+    if len(tokens) > 1:
+        for token in (tokens[0], tokens[-1]):
+            if _ISO_TOKEN.match(token) and any(c.isdigit() for c in text):
+                return token
+    for token in tokens:
+        stripped = token.strip("()-+")
+        for symbol, code in CURRENCY_SYMBOLS.items():
+            if symbol.isalpha() or symbol.endswith("."):
+                # Letters: the whole token, or a prefix glued to the number ("RS500")
+                if stripped == symbol or (stripped.startswith(symbol) and stripped[len(symbol):][:1].isdigit()):
+                    return code
+            elif stripped.startswith(symbol) or stripped.endswith(symbol):
+                return code
+    return None
+
+
+def parse_date(val, currency=None):
+    """
+    "2024-03-04", "4 Mar 2024", "04/03/2024"... -> date.
+    Slash dates valid both ways take their order from the currency (ISO code)
+    and are None without one.
+    """
+    if isinstance(val, datetime.datetime):
+        return val.date()
+    if isinstance(val, datetime.date):
+        return val
+    if _is_empty(val):
+        return None
+    text = re.sub(r"\s+", " ", str(val).strip())
+    slash = _SLASH_DATE.match(text)
+    if slash:
+        return _parse_slash_date(*map(int, slash.groups()), currency)
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(text, fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+def _parse_slash_date(first, second, year, currency):
+    readings = []
+    for month, day in ((second, first), (first, second)):  # day-first, month-first
+        try:
+            readings.append(datetime.date(year, month, day))
+        except ValueError:
+            readings.append(None)
+    day_first, month_first = readings
+    if day_first and month_first and day_first != month_first:
+        if not currency:
+            return None
+        return month_first if currency in MONTH_FIRST_CURRENCIES else day_first
+    return day_first or month_first
+
+
+def parse_doc_type(val):
+    if _is_empty(val):
+        return None
+    return str(val).strip().upper().replace(" ", "_")
+
+
+def extract_typed_fields(ai_data):
+    """Typed, indexable columns for one document's AI JSON."""
+    ai_data = ai_data or {}
+    currency = parse_currency(ai_data.get('currency'), ai_data.get('total_amount'))
+    return {
+        "doc_type": parse_doc_type(ai_data.get('type')),
+        "doc_date": parse_date(ai_data.get('date'), currency),
+        "total_amount": parse_amount(ai_data.get('total_amount')),
+        "currency": currency,
+        "fields_version": FIELDS_VERSION,
+    }
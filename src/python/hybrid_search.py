@@ -0,0 +1,64 @@
+import re
+
+# Standard constant from the original RRF paper; dampens the weight of
+# the very top ranks so neither retriever dominates.
+RRF_K = 60
+
+# "INV-2024-0042", "DE89 3704 0044", "#A1234", "4711"
+_ID_TOKEN = re.compile(r"^[A-Za-z0-9#][A-Za-z0-9\-_/.#:]*$")
+_FTS_TOKEN = re.compile(r"[\w#\-/.]+", re.UNICODE)
+
+
+def looks_like_identifier(query):
+    """
+    True for short queries where every token contains a digit, e.g. an
+    invoice number, IBAN fragment or vendor code. Those are exact lookups:
+    embeddings are bad at them and BM25 is good at them.
+    """
+    tokens = query.strip().split()
+    if not 1 <= len(tokens) <= 6:
+        return False
+    return all(_ID_TOKEN.match(t) and any(c.isdigit() for c in t) for t in tokens)
+
+
+def _quote(term):
+    return '"' + term.replace('"', '""') + '"'
+
+
+def build_fts_query(query):
+    """
+    Turns free user text into a safe FTS5 MATCH expression.
+    - Identifiers: the whole query as one phrase (exact sequence match).
+    - Questions:   OR of the individual terms, ranked by BM25.
+    Returns None if there is nothing searchable.
+    """
+    terms = _FTS_TOKEN.findall(query)
+    if not terms:
+        return None
+    if looks_like_identifier(query):
+        return _quote(" ".join(terms))
+    return " OR ".join(_quote(t) for t in terms if len(t) > 1) or None
+
+
+def reciprocal_rank_fusion(*rankings, k=RRF_K):
+    """
+    Merges ranked lists of keys: score(key) = sum(1 / (k + rank)).
+    Returns [(key, score)] best first.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda kv: kv[1], reverse=True)
+
+
+def build_prefix_query(text, column=None):
+    """
+    "hern inv" -> 'filename : ("hern"* AND "inv"*)': every word must start a
+    token in the column. Used for search-as-you-type over filenames.
+    """
+    terms = re.findall(r"\w+", text, re.UNICODE)
+    if not terms:
+        return None
+    expr = " AND ".join(_quote(t) + "*" for t in terms)
+    return f"{column} : ({expr})" if column else expr
@@ -0,0 +1,288 @@
+import asyncio
+import hashlib
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from csv_ingest import is_tabular, ingest_csv
+from docproc_pool import DocprocError
+
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_stream(file_obj, legacy_md5=False, chunk_size=HASH_CHUNK_SIZE):
+    """
+    Hashes a binary file object in fixed-size chunks (never the whole file
+    in memory) with BLAKE2b. With legacy_md5=True, the MD5 used by older
+    versions is computed in the same pass so old rows still match.
+    Returns (blake2_hex, md5_hex or None) and rewinds the stream.
+    """
+    blake = hashlib.blake2b(digest_size=32)
+    md5 = hashlib.md5() if legacy_md5 else None
+    file_obj.seek(0)
+    for chunk in iter(lambda: file_obj.read(chunk_size), b""):
+        blake.update(chunk)
+        if md5:
+            md5.update(chunk)
+    file_obj.seek(0)
+    return blake.hexdigest(), (md5.hexdigest() if md5 else None)
+
+
+def unique_save_path(folder, filename, file_hash):
+    # Prefix with the hash so two different files with the same name never collide
+    return os.path.join(folder, f"{file_hash[:12]}_{filename}")
+
+
+def write_stream(file_obj, path, chunk_size=HASH_CHUNK_SIZE):
+    file_obj.seek(0)
+    with open(path, "wb") as out:
+        shutil.copyfileobj(file_obj, out, chunk_size)
+
+
+def plan_uploads(db, uploads, folder="output", job_queue=None):
+    """
+    Dedup step that runs before anything touches disk or the engine.
+    `uploads` are binary file objects with a `.name` (e.g. Streamlit uploads).
+    Hashes every upload, looks all hashes up in ONE query, and only writes
+    unknown files to disk. With a job_queue, files already queued or being
+    processed are skipped too.
+    Returns (jobs, skipped_names) where jobs are ready for JobQueue.enqueue()
+    (or IngestPipeline.run()).
+    """
+    legacy = db.has_legacy_hashes()
+    hashed = []
+    for f in uploads:
+        file_hash, md5_hash = hash_stream(f, legacy_md5=legacy)
+        hashed.append((f, file_hash, md5_hash))
+
+    known = db.find_known_hashes(
+        [h for _, h, _ in hashed] + [m for _, _, m in hashed if m]
+    )
+    if job_queue is not None:
+        known |= job_queue.active_hashes([h for _, h, _ in hashed])
+
+    os.makedirs(folder, exist_ok=True)
+    jobs, skipped, seen = [], [], set()
+    for f, file_hash, md5_hash in hashed:
+        if file_hash in known or md5_hash in known or file_hash in seen:
+            skipped.append(f.name)
+            continue
+        seen.add(file_hash)
+        save_path = unique_save_path(folder, f.name, file_hash)
+        write_stream(f, save_path)
+        jobs.append({"filename": f.name, "path": save_path, "file_hash": file_hash})
+    return jobs, skipped
+
+
+def extract_file(path, docproc_pool, on_page=None):
+    """
+    Runs the HYBRID extraction step (C++ / Pandas) for one file on disk.
+    Returns (raw_text, cpp_data). Raises on failure.
+    on_page: called with each PDF page as docproc streams it (see DocprocPool.process).
+    """
+    if is_tabular(path):
+        # Streamed in chunks: profile + sample for the LLM, full data to Parquet
+        return ingest_csv(path)
+
+    cpp_data = docproc_pool.process(path, on_page=on_page)
+    if cpp_data.get('status') != 'success':
+        raise DocprocError(cpp_data.get('error', f"Engine failed on {os.path.basename(path)}"))
+    return cpp_data.get('content', ''), cpp_data
+
+
+async def _iter_pages(queue, first):
+    # Pages from the extract stage's queue; None ends it, an exception re-raises
+    item = first
+    while item is not None:
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+        item = await queue.get()
+
+
+class IngestPipeline:
+    """
+    Staged ingestion: extract -> analyze -> write.
+
+    Stages are connected by bounded queues, so a slow stage pushes back on
+    the one before it instead of letting work pile up in memory:
+    - Extract: `extract_workers` jobs in flight on the docproc process pool.
+      A job is handed to Analyze as soon as extraction starts; PDF pages
+      follow through a per-job queue as docproc streams them.
+    - Analyze: up to `llm_concurrency` concurrent documents. Long PDFs
+      start their segment calls before the last page is extracted.
+    - Write:   one writer that commits whatever has queued up as a batch.
+
+    Every job produces exactly one result dict:
+        {"filename", "path", "status": "success"/"error", "stage", "doc_id", "error", "job_id"}
+    ("job_id" is passed through from the job, None when it has none).
+    """
+
+    def __init__(self, db, brain, docproc_pool, extract_workers=None,
+                 llm_concurrency=8, write_batch_size=32, queue_size=16):
+        self.db = db
+        self.brain = brain
+        self.docproc_pool = docproc_pool
+        self.extract_workers = extract_workers or docproc_pool.size
+        self.llm_concurrency = llm_concurrency
+        self.write_batch_size = write_batch_size
+        self.queue_size = queue_size
+
+    def run(self, jobs, progress_callback=None):
+        """
+        Processes jobs and blocks until all of them finished.
+        Each job is a dict: {"filename", "path", "file_hash", "job_id"?}.
+        `jobs` may also be an iterator: it is read lazily, one job whenever
+        the extract queue has room (e.g. claims from a job queue), and
+        progress then reports total=None.
+        progress_callback(done, total, result) is called once per finished job.
+        """
+        if isinstance(jobs, (list, tuple)) and not jobs:
+            return []
+        return asyncio.run(self._run(jobs, progress_callback))
+
+    # --- ORCHESTRATION ---
+    async def _run(self, jobs, progress_callback):
+        self._results = []
+        self._total = len(jobs) if isinstance(jobs, (list, tuple)) else None
+        self._progress_callback = progress_callback
+        loop = asyncio.get_running_loop()
+
+        # Blocking calls (docproc pipes, SQL, the job feed) run on our own threads
+        threads = self.extract_workers + 2
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            self._executor = executor
+            self._loop = loop
+
+            extract_q = asyncio.Queue(maxsize=self.queue_size)
+            analyze_q = asyncio.Queue(maxsize=self.queue_size)
+            write_q = asyncio.Queue(maxsize=self.write_batch_size * 2)
+
+            extractors = [asyncio.create_task(self._extract_stage(extract_q, analyze_q))
+                          for _ in range(self.extract_workers)]
+            analyzers = [asyncio.create_task(self._analyze_stage(analyze_q, write_q))
+                         for _ in range(self.llm_concurrency)]
+            writer = asyncio.create_task(self._write_stage(write_q))
+
+            # put() waits while the queue is full -> backpressure on the feeder
+            feed = iter(jobs)
+            while True:
+                job = await self._in_thread(next, feed, None)
+                if job is None:
+                    break
+                await extract_q.put(job)
+
+            # Shut stages down in order, one sentinel per worker
+            for _ in extractors:
+                await extract_q.put(None)
+            await asyncio.gather(*extractors)
+            for _ in analyzers:
+                await analyze_q.put(None)
+            await asyncio.gather(*analyzers)
+            await write_q.put(None)
+            await writer
+
+        return self._results
+
+    def _finish(self, job, stage, doc_id=None, error=None):
+        result = {
+            "filename": job['filename'],
+            "path": job['path'],
+            "status": "error" if error else "success",
+            "stage": stage,
+            "doc_id": doc_id,
+            "error": error,
+            "job_id": job.get('job_id'),
+        }
+        self._results.append(result)
+        if self._progress_callback:
+            self._progress_callback(len(self._results), self._total, result)
+
+    def _in_thread(self, fn, *args):
+        return self._loop.run_in_executor(self._executor, fn, *args)
+
+    # --- STAGES ---
+    async def _extract_stage(self, in_q, out_q):
+        while True:
+            job = await in_q.get()
+            if job is None:
+                return
+            pages = asyncio.Queue()
+
+            def on_page(page, pages=pages):
+                # Called on the extraction thread
+                self._loop.call_soon_threadsafe(pages.put_nowait, page)
+
+            extraction = self._in_thread(extract_file, job['path'], self.docproc_pool, on_page)
+            await out_q.put(dict(job, pages=pages, extraction=extraction))
+            # Hold this extract slot until docproc is done; errors are
+            # reported by the analyze stage, which owns the job from here
+            try:
+                await extraction
+            except Exception as e:
+                pages.put_nowait(e)
+            else:
+                pages.put_nowait(None)
+
+    async def _analyze_stage(self, in_q, out_q):
+        while True:
+            job = await in_q.get()
+            if job is None:
+                return
+            extraction = job.pop('extraction')
+            pages = job.pop('pages')
+            try:
+                first = await pages.get()
+                if isinstance(first, dict):
+                    # Streamed PDF: analysis runs alongside the rest of the extraction
+                    ai_data = await self.brain.aanalyze_pages(_iter_pages(pages, first))
+                    raw_text, cpp_data = await extraction
+                else:
+                    raw_text, cpp_data = await extraction
+                    # Native async call; retries/backoff happen inside the brain
+                    ai_data = await self.brain.aanalyze_document(raw_text, cpp_data.get('page_starts'))
+            except Exception as e:
+                failed = extraction.done() and not extraction.cancelled() and extraction.exception()
+                self._finish(job, "extract" if failed else "analyze", error=str(failed or e))
+                if not extraction.done():
+                    # Don't leave docproc's result unawaited
+                    await asyncio.gather(extraction, return_exceptions=True)
+                continue
+            await out_q.put(dict(job, raw_text=raw_text, cpp_data=cpp_data, ai_data=ai_data))
+
+    async def _write_stage(self, in_q):
+        done = False
+        while not done:
+            job = await in_q.get()
+            if job is None:
+                return
+            # Take whatever else is already waiting, up to one batch
+            batch = [job]
+            while len(batch) < self.write_batch_size and not in_q.empty():
+                nxt = in_q.get_nowait()
+                if nxt is None:
+                    done = True
+                    break
+                batch.append(nxt)
+            await self._write_batch(batch)
+
+    async def _write_batch(self, batch):
+        records = [{
+            "filename": j['filename'],
+            "filepath": j['path'],
+            "text_content": j['raw_text'],
+            "ai_data": j['ai_data'],
+            "cpp_data": j['cpp_data'],
+            "file_hash": j.get('file_hash'),
+        } for j in batch]
+
+        try:
+            doc_ids = await self._in_thread(self.db.save_documents, records)
+        except Exception as e:
+            for j in batch:
+                self._finish(j, "write", error=str(e))
+            return
+
+        for j, doc_id in zip(batch, doc_ids):
+            self._finish(j, "write", doc_id=doc_id)
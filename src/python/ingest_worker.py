@@ -0,0 +1,251 @@
+"""
+Headless ingestion worker: runs the jobs in the `ingest_jobs` queue
+(see job_queue.py) through IngestPipeline (extract -> analyze -> save).
+
+The app only enqueues uploads; one or more of these workers process them.
+Also scriptable for bulk loads, e.g. a nightly cron job:
+
+    python src/python/ingest_worker.py enqueue /mnt/inbox --batch nightly-2026-10-17
+    python src/python/ingest_worker.py run --once --extract-workers 4 --llm-concurrency 8
+    python src/python/ingest_worker.py status --batch nightly-2026-10-17
+    python src/python/ingest_worker.py retry            # re-queue failed jobs
+
+- Every claimed job is leased to this worker; a heartbeat thread keeps the
+  leases alive. A killed worker's jobs are claimed again once their lease
+  runs out, so an interrupted load resumes where it stopped.
+- Ctrl-C / SIGTERM: stop claiming, finish the jobs in flight, exit.
+  A second Ctrl-C exits immediately (leases expire, jobs resume later).
+"""
+import argparse
+import os
+import signal
+import socket
+import sys
+import threading
+
+from csv_ingest import is_tabular
+from db_engine import DatabaseEngine
+from docproc_pool import DocprocPool
+from ingest_pipeline import IngestPipeline, hash_stream
+from job_queue import JobQueue
+from llm_engine import DocumentBrain
+import migrations
+
+# A dead worker's jobs are picked up again this long after its last heartbeat
+LEASE_SECONDS = 120
+
+# Seconds between queue polls while idle
+POLL_SECONDS = 2.0
+
+# Files picked up when enqueueing a whole directory (plus is_tabular files)
+DOCUMENT_EXTENSIONS = {".pdf", ".jpg", ".jpeg", ".png", ".tif", ".tiff", ".bmp"}
+
+
+class IngestWorker:
+    """
+    Feeds claimed jobs into one IngestPipeline. Jobs are claimed lazily, one
+    whenever the extract queue has room, so a worker never leases far more
+    than it is working on and other workers can share the queue.
+    """
+
+    def __init__(self, db, brain, docproc_pool, llm_concurrency=8,
+                 lease_seconds=LEASE_SECONDS, poll_seconds=POLL_SECONDS, worker_id=None):
+        self.db = db
+        self.queue = JobQueue()
+        self.pipeline = IngestPipeline(db, brain, docproc_pool, llm_concurrency=llm_concurrency,
+                                       queue_size=max(2, docproc_pool.size))
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.stop_event = threading.Event()
+        self.counts = {"done": 0, "failed": 0, "lost": 0}
+        self._in_flight = set()
+        self._lock = threading.Lock()
+
+    # --- FEED ---
+    def _claims(self):
+        # Ends when the queue is empty and nothing is in flight, or on stop.
+        # While jobs are in flight, new uploads are still picked up.
+        while not self.stop_event.is_set():
+            job = self.queue.claim(self.worker_id, self.lease_seconds)
+            if job is None:
+                with self._lock:
+                    if not self._in_flight:
+                        return
+                self.stop_event.wait(self.poll_seconds)
+                continue
+            if job['attempts'] > 1 and self._already_saved(job):
+                continue
+            with self._lock:
+                self._in_flight.add(job['job_id'])
+            yield job
+
+    def _already_saved(self, job):
+        # Resumed job whose worker died between saving and closing it
+        if not job.get('file_hash') or not self.db.find_known_hashes([job['file_hash']]):
+            return False
+        self.queue.finish(job['job_id'], self.worker_id, {"status": "success", "stage": "write"})
+        print(f"[{job['job_id']}] {job['filename']}: already saved")
+        return True
+
+    def _on_result(self, done, total, result):
+        with self._lock:
+            self._in_flight.discard(result['job_id'])
+        if not self.queue.finish(result['job_id'], self.worker_id, result):
+            # Our lease expired and another worker took the job over
+            self.counts['lost'] += 1
+            print(f"[{result['job_id']}] {result['filename']}: lease lost, result dropped")
+            return
+        if result['status'] == "success":
+            self.counts['done'] += 1
+            print(f"[{result['job_id']}] {result['filename']}: saved as {result['doc_id']}")
+        else:
+            self.counts['failed'] += 1
+            print(f"[{result['job_id']}] {result['filename']}: failed in {result['stage']}: {result['error']}")
+
+    # --- HEARTBEAT ---
+    def _heartbeat(self, stopped):
+        while not stopped.wait(self.lease_seconds / 4):
+            with self._lock:
+                job_ids = list(self._in_flight)
+            try:
+                self.queue.heartbeat(self.worker_id, job_ids, self.lease_seconds)
+            except Exception as e:
+                # A missed beat is fine, the lease has room for several
+                print(f"Heartbeat failed: {e}")
+
+    # --- RUN ---
+    def run(self, once=False):
+        """
+        Processes jobs until stopped. once=True: exit as soon as the queue
+        is drained (for scripted bulk loads). Returns the counts.
+        """
+        stopped = threading.Event()
+        beat = threading.Thread(target=self._heartbeat, args=(stopped,), daemon=True)
+        beat.start()
+        try:
+            while not self.stop_event.is_set():
+                results = self.pipeline.run(self._claims(), progress_callback=self._on_result)
+                if once:
+                    break
+                if not results:
+                    self.stop_event.wait(self.poll_seconds)
+        finally:
+            stopped.set()
+            beat.join()
+        return self.counts
+
+    def stop(self, *_):
+        self.stop_event.set()
+
+
+def collect_paths(paths):
+    """Files to enqueue: files as given, directories walked for documents and tables."""
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                found += [os.path.join(root, n) for n in sorted(names)
+                          if os.path.splitext(n)[1].lower() in DOCUMENT_EXTENSIONS
+                          or is_tabular(os.path.join(root, n))]
+        elif os.path.isfile(path):
+            found.append(path)
+        else:
+            print(f"Not found: {path}")
+    return [os.path.abspath(p) for p in found]
+
+
+def plan_paths(db, paths, job_queue=None):
+    """
+    Like plan_uploads for files already on disk: hashes them and skips those
+    in the database (or already queued). The files are queued in place, not copied.
+    Returns (jobs, skipped_paths).
+    """
+    legacy = db.has_legacy_hashes()
+    hashed = []
+    for path in paths:
+        with open(path, "rb") as f:
+            hashed.append((path,) + hash_stream(f, legacy_md5=legacy))
+    known = db.find_known_hashes([h for _, h, _ in hashed] + [m for _, _, m in hashed if m])
+    if job_queue is not None:
+        known |= job_queue.active_hashes([h for _, h, _ in hashed])
+
+    jobs, skipped = [], []
+    for path, file_hash, md5_hash in hashed:
+        if file_hash in known or md5_hash in known:
+            skipped.append(path)
+            continue
+        jobs.append({"filename": os.path.basename(path), "path": path, "file_hash": file_hash})
+    return jobs, skipped
+
+
+def print_status(status):
+    print(f"{status['total']} jobs: {status['queued']} queued, {status['running']} running, "
+          f"{status['done']} done, {status['failed']} failed "
+          f"({status['active_workers']} active worker(s))")
+    for f in status['failures']:
+        print(f"  FAILED {f['filename']} ({f['stage']}): {f['error']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless ingestion worker and job queue")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="Process queued jobs")
+    run.add_argument("--once", action="store_true", help="Exit when the queue is drained")
+    run.add_argument("--extract-workers", type=int, default=None,
+                     help="docproc processes (default: one per core)")
+    run.add_argument("--llm-concurrency", type=int, default=8, help="Documents analyzed at once")
+    run.add_argument("--pdf-threads", type=int, default=None, help="Page threads per docproc process")
+    run.add_argument("--docproc", default="./build/docproc", help="Path to the docproc binary")
+    run.add_argument("--lease", type=int, default=LEASE_SECONDS, help="Lease length in seconds")
+    run.add_argument("--poll", type=float, default=POLL_SECONDS, help="Idle poll interval in seconds")
+
+    enqueue = commands.add_parser("enqueue", help="Queue files or directories (processed in place)")
+    enqueue.add_argument("paths", nargs="+")
+    enqueue.add_argument("--batch", help="Batch name for status/retry (default: random id)")
+
+    status = commands.add_parser("status", help="Show queue progress")
+    status.add_argument("--batch")
+
+    retry = commands.add_parser("retry", help="Re-queue failed jobs")
+    retry.add_argument("--batch")
+
+    args = parser.parse_args()
+    queue = JobQueue()
+
+    if args.command == "enqueue":
+        jobs, skipped = plan_paths(DatabaseEngine(), collect_paths(args.paths), job_queue=queue)
+        batch_id, added = queue.enqueue(jobs, args.batch)
+        print(f"Batch {batch_id}: queued {added}, skipped {len(skipped) + len(jobs) - added} "
+              f"already saved or queued")
+    elif args.command == "status":
+        print_status(queue.status([args.batch] if args.batch else None))
+    elif args.command == "retry":
+        print(f"Re-queued {queue.retry_failed(args.batch)} failed job(s)")
+    else:
+        # Same one-off backfills the app runs, so a worker started first
+        # doesn't save documents into half-migrated tables
+        migrations.run_all(DatabaseEngine(), verbose=True)
+        pool = DocprocPool(args.docproc, size=args.extract_workers, pdf_threads=args.pdf_threads)
+        worker = IngestWorker(DatabaseEngine(), DocumentBrain(), pool,
+                              llm_concurrency=args.llm_concurrency,
+                              lease_seconds=args.lease, poll_seconds=args.poll)
+
+        def on_signal(signum, frame):
+            print("Stopping after the jobs in flight (Ctrl-C again to quit now)")
+            worker.stop()
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+
+        signal.signal(signal.SIGINT, on_signal)
+        signal.signal(signal.SIGTERM, on_signal)
+        print(f"Worker {worker.worker_id}: {pool.size} extract workers, "
+              f"{args.llm_concurrency} concurrent analyses")
+        with pool:
+            counts = worker.run(once=args.once)
+        print(f"Done: {counts['done']} saved, {counts['failed']} failed")
+        sys.exit(1 if counts['failed'] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+Persistent ingestion job queue on the `ingest_jobs` table.
+
+The app and the CLI enqueue files; ingest_worker.py claims and runs them.
+
+- claim(): one UPDATE picks the oldest queued job, or a running job whose
+  lease expired (its worker died), so two workers never get the same job.
+- heartbeat(): a worker extends the leases of the jobs it still holds.
+- finish(): only the lease owner can close a job, so a worker that lost
+  its lease can't overwrite the result of the worker that took over.
+"""
+import datetime
+import uuid
+
+from sqlalchemy import and_, func, or_, select, update
+
+from db_engine import unit_of_work
+from models import IngestJob, Session
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+# A job interrupted this many times (worker crash, kill, OOM) is failed
+# instead of claimed again: it is probably what kills the worker
+MAX_ATTEMPTS = 3
+
+# Failed jobs returned with a status
+FAILURE_LIMIT = 20
+
+
+def _now():
+    return datetime.datetime.utcnow()
+
+
+class JobQueue:
+    """Cheap to create, like DatabaseEngine: every call is its own unit of work."""
+
+    def __init__(self):
+        self.sql_db = Session
+
+    @unit_of_work
+    def enqueue(self, jobs, batch_id=None):
+        """
+        Adds jobs ({"filename", "path", "file_hash"}, e.g. from plan_uploads).
+        Files already queued or running are skipped.
+        Returns (batch_id, number of jobs added).
+        """
+        batch_id = batch_id or uuid.uuid4().hex
+        active = self.active_hashes([j.get('file_hash') for j in jobs])
+        added = 0
+        for job in jobs:
+            if job.get('file_hash') in active:
+                continue
+            active.add(job.get('file_hash'))
+            self.sql_db.add(IngestJob(
+                batch_id=batch_id, filename=job['filename'], path=job['path'],
+                file_hash=job.get('file_hash'), status=QUEUED,
+            ))
+            added += 1
+        return batch_id, added
+
+    @unit_of_work
+    def active_hashes(self, file_hashes, batch_size=500):
+        """The subset of file_hashes with a queued or running job."""
+        hashes = list({h for h in file_hashes if h})
+        active = set()
+        for i in range(0, len(hashes), batch_size):
+            rows = self.sql_db.query(IngestJob.file_hash).filter(
+                IngestJob.file_hash.in_(hashes[i:i + batch_size]),
+                IngestJob.status.in_([QUEUED, RUNNING]),
+            ).all()
+            active.update(r[0] for r in rows)
+        return active
+
+    @unit_of_work
+    def claim(self, worker_id, lease_seconds):
+        """
+        Leases the next job to worker_id. Returns a pipeline job dict
+        {"job_id", "filename", "path", "file_hash", "attempts"} or None.
+        """
+        now = _now()
+        # Interrupted too often: give up on it (see MAX_ATTEMPTS)
+        self.sql_db.execute(
+            update(IngestJob)
+            .where(IngestJob.status == RUNNING, IngestJob.lease_until < now,
+                   IngestJob.attempts >= MAX_ATTEMPTS)
+            .values(status=FAILED, finished_at=now, lease_until=None,
+                    error=f"Interrupted {MAX_ATTEMPTS} times")
+            .execution_options(synchronize_session=False)
+        )
+
+        # Pick + lease in one statement: SQLite runs it under the write lock
+        pick = (
+            select(IngestJob.id)
+            .where(or_(IngestJob.status == QUEUED,
+                       and_(IngestJob.status == RUNNING, IngestJob.lease_until < now)))
+            .order_by(IngestJob.id)
+            .limit(1)
+            .scalar_subquery()
+        )
+        row = self.sql_db.execute(
+            update(IngestJob)
+            .where(IngestJob.id == pick)
+            .values(status=RUNNING, worker_id=worker_id, attempts=IngestJob.attempts + 1,
+                    lease_until=now + datetime.timedelta(seconds=lease_seconds), heartbeat_at=now,
+                    started_at=func.coalesce(IngestJob.started_at, now), error=None)
+            .returning(IngestJob.id, IngestJob.filename, IngestJob.path,
+                       IngestJob.file_hash, IngestJob.attempts)
+            .execution_options(synchronize_session=False)
+        ).first()
+        if row is None:
+            return None
+        return {"job_id": row.id, "filename": row.filename, "path": row.path,
+                "file_hash": row.file_hash, "attempts": row.attempts}
+
+    @unit_of_work
+    def heartbeat(self, worker_id, job_ids, lease_seconds):
+        """Extends worker_id's leases on job_ids. Returns how many it still holds."""
+        if not job_ids:
+            return 0
+        now = _now()
+        result = self.sql_db.execute(
+            update(IngestJob)
+            .where(IngestJob.id.in_(list(job_ids)), IngestJob.worker_id == worker_id,
+                   IngestJob.status == RUNNING)
+            .values(lease_until=now + datetime.timedelta(seconds=lease_seconds), heartbeat_at=now)
+            .execution_options(synchronize_session=False)
+        )
+        return result.rowcount
+
+    @unit_of_work
+    def finish(self, job_id, worker_id, result):
+        """
+        Closes a job with an IngestPipeline result dict.
+        Returns False if worker_id no longer holds the lease.
+        """
+        ok = result.get('status') == "success"
+        updated = self.sql_db.execute(
+            update(IngestJob)
+            .where(IngestJob.id == job_id, IngestJob.worker_id == worker_id,
+                   IngestJob.status == RUNNING)
+            .values(status=DONE if ok else FAILED, stage=result.get('stage'),
+                    doc_id=result.get('doc_id'), error=result.get('error'),
+                    finished_at=_now(), lease_until=None)
+            .execution_options(synchronize_session=False)
+        )
+        return updated.rowcount == 1
+
+    @unit_of_work
+    def retry_failed(self, batch_id=None):
+        """Puts failed jobs back in the queue. Returns how many."""
+        query = update(IngestJob).where(IngestJob.status == FAILED)
+        if batch_id:
+            query = query.where(IngestJob.batch_id == batch_id)
+        result = self.sql_db.execute(
+            query.values(status=QUEUED, attempts=0, worker_id=None, error=None,
+                         stage=None, started_at=None, finished_at=None)
+            .execution_options(synchronize_session=False)
+        )
+        return result.rowcount
+
+    @unit_of_work
+    def status(self, batch_ids=None):
+        """
+        Progress of some batches (all jobs when None), cheap enough to poll:
+        {"queued", "running", "done", "failed", "total", "active_workers",
+         "failures": [{"filename", "stage", "error"}] (latest first)}
+        """
+        filters = [IngestJob.batch_id.in_(list(batch_ids))] if batch_ids else []
+        counts = dict.fromkeys((QUEUED, RUNNING, DONE, FAILED), 0)
+        rows = (self.sql_db.query(IngestJob.status, func.count())
+                .filter(*filters).group_by(IngestJob.status).all())
+        counts.update({s: n for s, n in rows})
+        counts['total'] = sum(n for _, n in rows)
+
+        # Workers holding a live lease (an idle worker holds none)
+        counts['active_workers'] = (
+            self.sql_db.query(func.count(func.distinct(IngestJob.worker_id)))
+            .filter(IngestJob.status == RUNNING, IngestJob.lease_until >= _now())
+            .scalar()
+        )
+        failed = (self.sql_db.query(IngestJob.filename, IngestJob.stage, IngestJob.error)
+                  .filter(IngestJob.status == FAILED, *filters)
+                  .order_by(IngestJob.id.desc()).limit(FAILURE_LIMIT).all())
+        counts['failures'] = [{"filename": f, "stage": s, "error": e} for f, s, e in failed]
+        return counts
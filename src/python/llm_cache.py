@@ -0,0 +1,192 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Lives next to the main database
+CACHE_DB_PATH = "./data/xentro_llm_cache.db"
+
+
+def sha256_text(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def hash_inputs(inputs):
+    """Stable hash for any JSON-able call arguments."""
+    return sha256_text(json.dumps(inputs, sort_keys=True, default=str))
+
+
+class LLMCache:
+    """
+    Persistent cache for LLM results, stored in SQLite.
+
+    Key = operation + prompt template hash + model + temperature + input hash,
+    so a changed template or model never returns a stale answer.
+    Eviction: entries older than `max_age_days` are dropped, and the least
+    recently used entries are dropped once the cache grows past `max_bytes`.
+    """
+
+    def __init__(self, path=CACHE_DB_PATH, max_bytes=256 * 1024 * 1024,
+                 max_age_days=90, prune_every=200):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_days * 86400
+        self.prune_every = prune_every
+
+        self._lock = threading.Lock()
+        self._puts = 0
+        self._synced_templates = set()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY,
+                operation TEXT NOT NULL,
+                template_hash TEXT NOT NULL,
+                model TEXT,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_used_at REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS ix_llm_cache_last_used ON llm_cache (last_used_at);
+            CREATE INDEX IF NOT EXISTS ix_llm_cache_op_template ON llm_cache (operation, template_hash);
+            CREATE TABLE IF NOT EXISTS llm_cache_stats (
+                operation TEXT PRIMARY KEY,
+                hits INTEGER NOT NULL DEFAULT 0,
+                misses INTEGER NOT NULL DEFAULT 0
+            );
+        """)
+
+    # --- KEYS ---
+    @staticmethod
+    def make_key(operation, template, model, temperature, inputs):
+        parts = [operation, sha256_text(template), str(model), str(temperature), hash_inputs(inputs)]
+        return sha256_text("|".join(parts))
+
+    # --- READ / WRITE ---
+    def get(self, key, operation):
+        """Returns the cached value, or None on a miss (or an expired entry)."""
+        now = time.time()
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row and now - row[1] > self.max_age_seconds:
+                self.conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                row = None
+
+            if row:
+                self.conn.execute(
+                    "UPDATE llm_cache SET last_used_at = ?, hits = hits + 1 WHERE key = ?", (now, key)
+                )
+            self._count(operation, hit=row is not None)
+        return json.loads(row[0]) if row else None
+
+    def put(self, key, operation, template, model, value):
+        payload = json.dumps(value)
+        now = time.time()
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO llm_cache "
+                "(key, operation, template_hash, model, value, size, created_at, last_used_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, operation, sha256_text(template), str(model), payload, len(payload), now, now)
+            )
+            self._puts += 1
+            if self._puts % self.prune_every == 0:
+                self._prune_locked()
+
+    def _count(self, operation, hit):
+        column = "hits" if hit else "misses"
+        self.conn.execute(
+            f"INSERT INTO llm_cache_stats (operation, {column}) VALUES (?, 1) "
+            f"ON CONFLICT(operation) DO UPDATE SET {column} = {column} + 1",
+            (operation,)
+        )
+
+    # --- MAINTENANCE ---
+    def sync_templates(self, templates):
+        """
+        Drops entries built from an older version of a prompt template.
+        `templates` maps operation -> current template text. Runs once per
+        operation per process.
+        """
+        with self._lock:
+            for operation, template in templates.items():
+                if operation in self._synced_templates:
+                    continue
+                self.conn.execute(
+                    "DELETE FROM llm_cache WHERE operation = ? AND template_hash != ?",
+                    (operation, sha256_text(template))
+                )
+                self._synced_templates.add(operation)
+
+    def prune(self):
+        with self._lock:
+            self._prune_locked()
+
+    def _prune_locked(self):
+        # 1. Age limit
+        self.conn.execute(
+            "DELETE FROM llm_cache WHERE created_at < ?", (time.time() - self.max_age_seconds,)
+        )
+        # 2. Size limit: drop least recently used rows until we fit
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        freed = 0
+        stale_keys = []
+        for key, size in self.conn.execute("SELECT key, size FROM llm_cache ORDER BY last_used_at"):
+            stale_keys.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        self.conn.executemany("DELETE FROM llm_cache WHERE key = ?", stale_keys)
+
+    def clear(self):
+        with self._lock:
+            self.conn.execute("DELETE FROM llm_cache")
+            self.conn.execute("DELETE FROM llm_cache_stats")
+
+    def stats(self):
+        """Hit/miss counters per operation plus the current cache size."""
+        with self._lock:
+            ops = {
+                op: {"hits": hits, "misses": misses}
+                for op, hits, misses in self.conn.execute(
+                    "SELECT operation, hits, misses FROM llm_cache_stats"
+                )
+            }
+            entries, size = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache"
+            ).fetchone()
+        hits = sum(o["hits"] for o in ops.values())
+        misses = sum(o["misses"] for o in ops.values())
+        return {
+            "entries": entries,
+            "bytes": size,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+            "operations": ops,
+        }
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+def get_default_cache():
+    """One shared cache per process (opened on first use)."""
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = LLMCache()
+        return _default_cache
@@ -0,0 +1,271 @@
+"""
+MathGuard: deterministic arithmetic check for invoices and receipts.
+
+Finds Subtotal / Discount / Tax / Shipping / Total in raw OCR text and
+verifies  Subtotal - Discount + Tax + Shipping == Total  locally, with no
+LLM call. Only ambiguous parses are worth sending to the LLM.
+
+Verify every stored document:
+
+    python src/python/mathguard_engine.py --workers 8
+"""
+import argparse
+import os
+import re
+
+from field_parsing import parse_amount
+
+# Totals usually match to the cent; allow one cent per component for rounding
+TOLERANCE = 0.02
+
+# Checked in this order; a span claimed by an earlier label can't be
+# claimed by a later one ("Sub Total" is a subtotal, not a total).
+LABELS = [
+    ("subtotal", re.compile(r"\bsub[\s\-]?t[o0]tal\b|\bnet\s+amount\b|\bitems?\s+total\b", re.I)),
+    ("discount", re.compile(r"\bdiscount\b|\brabatt\b|\bcoupon\b|\bsavings\b", re.I)),
+    ("tax", re.compile(
+        r"\b(?:sales\s+)?tax\b(?!\s*(?:id|no\b|number|#|reg))|\bvat\b|\bgst\b|\bhst\b|\bpst\b"
+        r"|\bcgst\b|\bsgst\b|\bmwst\b", re.I)),
+    ("shipping", re.compile(r"\bshipping\b|\bdelivery\b|\bfreight\b|\bpostage\b", re.I)),
+    ("total", re.compile(
+        r"\bgrand\s+t[o0]tal\b|\b(?:amount|balance|total)\s+due\b"
+        r"|\bt?[o0]tal\b(?!\s*(?:items?|qty|quantity|pieces|pcs|units))", re.I)),
+]
+
+# Which "total" label wins when several are present
+TOTAL_PRIORITY = ("grand", "total", "due")
+
+# Common OCR digit confusions inside numeric tokens
+OCR_DIGITS = str.maketrans({"O": "0", "o": "0", "D": "0", "I": "1", "l": "1", "|": "1",
+                            "S": "5", "s": "5", "B": "8", "Z": "2", "z": "2"})
+
+_CURRENCY = re.compile(r"^(?:US\$|[$€£¥₹]|USD|EUR|GBP|PKR|INR|CHF|Rs\.?)", re.I)
+_NUMERIC = re.compile(r"^\d{1,3}(?:[.,]\d{3})*(?:[.,]\d{1,2})?$|^\d+(?:[.,]\d{1,2})?$")
+_HAS_CENTS = re.compile(r"[.,]\d{2}$")
+
+
+def _money_tokens(segment):
+    """
+    Yields (amount, has_cents, ocr_fixed) for money-looking tokens in a line segment.
+    Percentages ("(70%)") and words are skipped.
+    """
+    for raw in segment.replace(":", " ").split():
+        token = raw.strip("*;")
+        if not token or "%" in token:
+            continue
+        negative = token.startswith("-") or (token.startswith("(") and token.endswith(")"))
+        token = token.strip("-()")
+        token = _CURRENCY.sub("", token).strip("-() ")
+        if not token or not any(c.isdigit() for c in token):
+            continue
+        fixed = token.translate(OCR_DIGITS)
+        if not _NUMERIC.match(fixed):
+            continue
+        amount = parse_amount(fixed)
+        if amount is None:
+            continue
+        yield (-amount if negative else amount), bool(_HAS_CENTS.search(fixed)), fixed != token
+
+
+def _pick_amount(segment):
+    tokens = list(_money_tokens(segment))
+    if not tokens:
+        return None
+    # "Total Items 4   12.50": prefer amounts with cents
+    with_cents = [t for t in tokens if t[1]]
+    amount, _, fixed = (with_cents or tokens)[-1]
+    return amount, fixed
+
+
+def find_components(text):
+    """
+    Returns {label: [(label_text, amount, ocr_fixed), ...]} for every labelled
+    amount in the text. The amount is the last money token after the label on
+    the same line, or the first one on the next non-empty line.
+    """
+    lines = text.splitlines()
+    found = {name: [] for name, _ in LABELS}
+
+    for i, line in enumerate(lines):
+        spans = []
+        for name, pattern in LABELS:
+            for m in pattern.finditer(line):
+                if any(m.start() < e and s < m.end() for s, e, _, _ in spans):
+                    continue
+                spans.append((m.start(), m.end(), name, m.group(0)))
+        spans.sort()
+
+        for j, (start, end, name, label_text) in enumerate(spans):
+            is_last = j == len(spans) - 1
+            segment = line[end:spans[j + 1][0]] if not is_last else line[end:]
+            picked = _pick_amount(segment)
+            if picked is None and is_last:
+                # Amount printed on the following line
+                nxt = next((l for l in lines[i + 1:i + 3] if l.strip()), "")
+                tokens = list(_money_tokens(nxt))
+                if tokens:
+                    picked = (tokens[0][0], tokens[0][2])
+            if picked is not None:
+                found[name].append((label_text.lower(), picked[0], picked[1]))
+    return found
+
+
+def _single_value(entries):
+    """One value, or None if the label has conflicting values."""
+    values = {round(abs(amount), 2) for _, amount, _ in entries}
+    return values.pop() if len(values) == 1 else None
+
+
+def _resolve_tax(entries):
+    # Different tax labels (CGST + SGST) add up; the same label twice must agree
+    by_label = {}
+    for label, amount, fixed in entries:
+        by_label.setdefault(re.sub(r"\s+", " ", label), []).append((label, amount, fixed))
+    total = 0.0
+    for group in by_label.values():
+        value = _single_value(group)
+        if value is None:
+            return None
+        total += value
+    return round(total, 2)
+
+
+def _resolve_total(entries):
+    for kind in TOTAL_PRIORITY:
+        if kind == "total":
+            group = [e for e in entries if "grand" not in e[0] and "due" not in e[0]]
+        else:
+            group = [e for e in entries if kind in e[0]]
+        if group:
+            return _single_value(group)
+    return None
+
+
+def check_math(text):
+    """
+    Local arithmetic audit. Same result keys as DocumentBrain.verify_math,
+    plus "method" and "ambiguous" (True = the parse can't be trusted alone).
+    """
+    found = find_components(text or "")
+    ocr_fixed = any(fixed for entries in found.values() for _, _, fixed in entries)
+    reasons = []
+
+    total = _resolve_total(found["total"])
+    if total is None:
+        reasons.append("no unambiguous total" if found["total"] else "no total found")
+
+    components = {}
+    for name in ("subtotal", "discount", "shipping"):
+        if found[name]:
+            value = _single_value(found[name])
+            if value is None:
+                reasons.append(f"conflicting {name} values")
+            components[name] = value or 0.0
+        else:
+            components[name] = 0.0
+    tax = _resolve_tax(found["tax"]) if found["tax"] else 0.0
+    if tax is None:
+        reasons.append("conflicting tax values")
+        tax = 0.0
+
+    if not found["subtotal"]:
+        reasons.append("no subtotal found")
+
+    calculated = round(components["subtotal"] - components["discount"] + tax + components["shipping"], 2)
+    is_correct = total is not None and abs(calculated - total) <= TOLERANCE
+    # A mismatch that hinges on an OCR-corrected digit is not trustworthy either
+    if total is not None and not is_correct and ocr_fixed:
+        reasons.append("mismatch involves OCR-corrected digits")
+
+    result = {
+        "found_subtotal": components["subtotal"],
+        "found_discount": components["discount"],
+        "found_tax": tax,
+        "found_shipping": components["shipping"],
+        "found_total": total if total is not None else 0.00,
+        "calculated_total": calculated,
+        "is_math_correct": is_correct,
+        "method": "local",
+        "ambiguous": bool(reasons),
+    }
+    if reasons:
+        result["explanation"] = "Local parse ambiguous: " + ", ".join(reasons) + "."
+    else:
+        result["explanation"] = (
+            f"Subtotal {components['subtotal']:.2f} - Discount {components['discount']:.2f} "
+            f"+ Tax {tax:.2f} + Shipping {components['shipping']:.2f} = {calculated:.2f}; "
+            f"document total is {total:.2f}."
+        )
+    return result
+
+
+# ==========================================
+# CORPUS-WIDE VERIFICATION
+# ==========================================
+def verify_all(workers=None, batch_size=500, progress_callback=None, db=None):
+    """
+    Runs check_math over every stored document on a process pool and stores
+    one MathCheck row per document. Returns counts by outcome.
+    Reads and writes go through DatabaseEngine, one unit of work per batch.
+    """
+    # Imported here so pool workers don't open the database on spawn
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+    import datetime
+    from db_engine import DatabaseEngine
+
+    db = db or DatabaseEngine()
+    total_docs = db.count_documents()
+    summary = {"checked": 0, "correct": 0, "incorrect": 0, "ambiguous": 0}
+    last_id = None
+
+    # spawn, not fork: the caller may be a multithreaded server (Streamlit)
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), mp_context=get_context("spawn")) as pool:
+        while True:
+            rows = db.get_document_batch(("id", "text_content"), after_id=last_id, limit=batch_size)
+            if not rows:
+                break
+
+            results = pool.map(check_math, [r.text_content or "" for r in rows], chunksize=32)
+            now = datetime.datetime.utcnow()
+            values = []
+            for row, result in zip(rows, results):
+                values.append({
+                    "doc_id": row.id,
+                    "is_math_correct": result["is_math_correct"],
+                    "ambiguous": result["ambiguous"],
+                    "found_total": result["found_total"],
+                    "calculated_total": result["calculated_total"],
+                    "method": result["method"],
+                    "result_json": result,
+                    "checked_at": now,
+                })
+                summary["checked"] += 1
+                if result["ambiguous"]:
+                    summary["ambiguous"] += 1
+                elif result["is_math_correct"]:
+                    summary["correct"] += 1
+                else:
+                    summary["incorrect"] += 1
+
+            db.save_math_checks(values)
+            last_id = rows[-1].id
+            if progress_callback:
+                progress_callback(summary["checked"], total_docs)
+
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Verify invoice arithmetic for every stored document")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+    summary = verify_all(args.workers, args.batch_size,
+                         lambda done, total: print(f"Checked {done}/{total}", end="\r"))
+    print()
+    print(summary)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Batched, resumable data migrations for existing databases.
+
+Each backfill works in small committed batches and only selects rows that
+still need work, so it can be interrupted at any point and simply re-run:
+
+    python src/python/migrations.py
+"""
+import datetime
+
+from sqlalchemy import or_
+from models import Document, MigrationMarker, VendorStats
+from db_engine import DatabaseEngine
+from field_parsing import FIELDS_VERSION, extract_typed_fields
+from vendor_stats import new_stats, update_stats
+
+
+def is_done(db, name, version=1):
+    marker = db.sql_db.get(MigrationMarker, name)
+    return marker is not None and (marker.version or 0) >= version
+
+
+def mark_done(db, name, version=1):
+    db.sql_db.merge(MigrationMarker(name=name, version=version, completed_at=datetime.datetime.utcnow()))
+    db.sql_db.commit()
+
+
+def backfill_vendor_links(db, batch_size=500):
+    """Links documents saved before the vendor index existed to their vendor."""
+    updated = 0
+    while True:
+        rows = db.sql_db.query(Document.id, Document.metadata_json) \
+            .filter(Document.vendor_id.is_(None)) \
+            .order_by(Document.id).limit(batch_size).all()
+        if not rows:
+            break
+        for doc_id, meta in rows:
+            vendor_id = db.resolve_vendor_id((meta or {}).get('vendor'))
+            db.sql_db.query(Document).filter(Document.id == doc_id) \
+                .update({Document.vendor_id: vendor_id}, synchronize_session=False)
+        db.sql_db.commit()
+        updated += len(rows)
+    return updated
+
+
+def backfill_typed_fields(db, batch_size=500):
+    """
+    Fills doc_type / doc_date / total_amount / currency from metadata_json
+    for rows saved before those columns existed (or parsed by an older
+    FIELDS_VERSION). Progress lives in the rows themselves: every batch
+    stamps fields_version, so a restart skips what is already done.
+    """
+    updated = 0
+    last_id = None
+    while True:
+        query = db.sql_db.query(Document.id, Document.metadata_json).filter(or_(
+            Document.fields_version.is_(None), Document.fields_version < FIELDS_VERSION
+        ))
+        if last_id is not None:
+            query = query.filter(Document.id > last_id)
+        rows = query.order_by(Document.id).limit(batch_size).all()
+        if not rows:
+            break
+        db.sql_db.bulk_update_mappings(Document, [
+            dict(extract_typed_fields(meta), id=doc_id) for doc_id, meta in rows
+        ])
+        db.sql_db.commit()
+        updated += len(rows)
+        last_id = rows[-1][0]
+    return updated
+
+
+def backfill_vendor_stats(db, batch_size=500):
+    """
+    (Re)builds the running vendor stats from every document, oldest document
+    date first so billing intervals come out right. Runs once per
+    FIELDS_VERSION: stats keyed by an old parser's currency are rebuilt with
+    the new one. From then on save_document keeps the table current.
+    Delete + rebuild is one transaction, so concurrent saves just wait.
+    """
+    if is_done(db, "vendor stats", FIELDS_VERSION):
+        return 0
+    db.sql_db.query(VendorStats).delete(synchronize_session=False)
+    if is_done(db, "vendor stats", FIELDS_VERSION):
+        # Another process (app / ingest worker) finished it while we waited for the lock
+        db.sql_db.rollback()
+        return 0
+    stats = {}
+    rows = db.sql_db.query(Document.vendor_id, Document.currency, Document.total_amount, Document.doc_date) \
+        .filter(Document.vendor_id.isnot(None), Document.total_amount.isnot(None)) \
+        .order_by(Document.doc_date.is_(None), Document.doc_date, Document.processed_at) \
+        .yield_per(batch_size)
+    for vendor_id, currency, amount, doc_date in rows:
+        key = (vendor_id, currency or "")
+        update_stats(stats.setdefault(key, new_stats()), amount, doc_date)
+    db.sql_db.add_all(
+        VendorStats(vendor_id=vendor_id, currency=currency, **values)
+        for (vendor_id, currency), values in stats.items()
+    )
+    mark_done(db, "vendor stats", FIELDS_VERSION)  # Commits stats and marker together
+    return len(stats)
+
+
+def backfill_chunk_index(db):
+    """
+    Chunks documents saved before chunked indexing, then drops the old
+    per-document collection. Runs once: the marker keeps later starts from
+    scanning the corpus again (save_document indexes new rows itself).
+    """
+    if is_done(db, "chunk index"):
+        return 0
+    indexed = db.rebuild_chunk_index()
+    db.drop_legacy_collection()
+    mark_done(db, "chunk index")
+    return indexed
+
+
+MIGRATIONS = [
+    ("vendor links", backfill_vendor_links),
+    ("typed fields", backfill_typed_fields),
+    ("vendor stats", backfill_vendor_stats),
+    ("chunk index", backfill_chunk_index),
+]
+
+
+def run_all(db=None, verbose=False):
+    db = db or DatabaseEngine()
+    results = {}
+    for name, migration in MIGRATIONS:
+        results[name] = migration(db)
+        if verbose:
+            print(f"{name}: {results[name]} rows updated")
+    db.sql_db.remove()
+    return results
+
+
+if __name__ == "__main__":
+    run_all(verbose=True)
@@ -1,5 +1,5 @@
-from sqlalchemy import create_engine, Column, String, Integer, DateTime, Text, JSON
-from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy import create_engine, event, inspect, Column, String, Integer, Float, Boolean, Date, DateTime, Text, JSON, ForeignKey, Index
+from sqlalchemy.orm import declarative_base, sessionmaker, scoped_session
 import datetime
 import uuid
 import os
@@ -11,10 +11,41 @@ if not os.path.exists("data"):
 # SQLite Database File
 SQLALCHEMY_DATABASE_URL = "sqlite:///./data/xentro_enterprise.db"
 
+# One engine per process. Sessions borrow pooled connections, so the pool
+# only needs to cover the threads that talk to SQLite at the same time
+# (Streamlit sessions + ingestion workers).
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False, "timeout": 30},
+    pool_size=8, max_overflow=16, pool_timeout=30, pool_pre_ping=True,
 )
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Applied to every new connection:
+# - WAL: readers don't block the writer and the writer doesn't block readers
+# - synchronous=NORMAL: safe with WAL, far fewer fsyncs per commit
+# - mmap_size / cache_size: keep the hot part of the DB in memory (256 MB / 64 MB)
+# - busy_timeout: wait for the write lock instead of failing with "database is locked"
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 268435456,
+    "cache_size": -65536,
+    "temp_store": "MEMORY",
+    "busy_timeout": 30000,
+}
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {pragma}={value}")
+    cursor.close()
+
+# expire_on_commit=False: rows returned by a finished unit of work stay readable
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+
+# Thread-local session registry: each thread (Streamlit session, ingestion
+# worker) gets its own session; Session.remove() ends its unit of work.
+Session = scoped_session(SessionLocal)
 
 Base = declarative_base()
 
@@ -38,6 +69,237 @@ class Document(Base):
     file_hash = Column(String, index=True) # <--- NEW COLUMN
     processed_at = Column(DateTime, default=datetime.datetime.utcnow)
 # ...
+    vendor_id = Column(Integer, ForeignKey('vendors.id'))  # Resolved at ingestion
+
+    # Typed copies of the AI JSON fields (see field_parsing.py), so we can
+    # filter and aggregate in SQL instead of parsing metadata_json in Python
+    doc_type = Column(String, index=True)        # INVOICE, RECEIPT, ...
+    doc_date = Column(Date, index=True)          # Document date (not processed_at)
+    total_amount = Column(Float, index=True)     # "$1,234.56" -> 1234.56
+    currency = Column(String(3), index=True)     # ISO-4217
+    fields_version = Column(Integer, index=True) # NULL/old = needs backfill
+
+    # Stable integer key for the FTS index (see FTS_DDL). The implicit rowid
+    # of a table with a String primary key can change on VACUUM.
+    search_rowid = Column(Integer)
+
+    __table_args__ = (
+        # Vendor history = "this vendor's docs, newest first"
+        Index('ix_documents_vendor_processed', 'vendor_id', 'processed_at'),
+        # Document list = keyset pages on (processed_at, id), newest first
+        Index('ix_documents_processed_id', 'processed_at', 'id'),
+        Index('ux_documents_search_rowid', 'search_rowid', unique=True),
+    )
+
+class Vendor(Base):
+    """One row per real-world vendor. Documents link here via vendor_id."""
+    __tablename__ = 'vendors'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    slug = Column(String, unique=True, index=True)  # "Super Store Inc." -> "superstore"
+    display_name = Column(String)                   # First raw name we saw
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class VendorAlias(Base):
+    """Every normalized spelling we have seen, mapped to its vendor."""
+    __tablename__ = 'vendor_aliases'
+
+    alias_slug = Column(String, primary_key=True)   # "superstoreinc"
+    vendor_id = Column(Integer, ForeignKey('vendors.id'), index=True)
+    raw_name = Column(String)
+    search_rowid = Column(Integer)                  # Stable key for the trigram index
+
+    __table_args__ = (
+        Index('ux_vendor_aliases_search_rowid', 'search_rowid', unique=True),
+    )
+
+class VendorStats(Base):
+    """
+    Running amount statistics per vendor and currency, updated on every save
+    (see vendor_stats.py). Lets Risk Audit score an invoice without
+    re-reading the vendor's history.
+    """
+    __tablename__ = 'vendor_stats'
+
+    vendor_id = Column(Integer, ForeignKey('vendors.id'), primary_key=True)
+    currency = Column(String(3), primary_key=True)  # "" when unknown
+    count = Column(Integer, default=0)
+    mean = Column(Float, default=0.0)
+    m2 = Column(Float, default=0.0)                  # Welford sum of squared deviations
+    min_amount = Column(Float)
+    max_amount = Column(Float)
+    sample = Column(JSON)                            # Reservoir sample for median/MAD
+    median = Column(Float)
+    mad = Column(Float)
+    last_seen = Column(Date)                         # Latest document date
+    interval_count = Column(Integer, default=0)
+    interval_mean = Column(Float)                    # Typical days between invoices
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+class MathCheck(Base):
+    """Latest MathGuard result per document (see mathguard_engine.py)."""
+    __tablename__ = 'math_checks'
+
+    doc_id = Column(String, ForeignKey('documents.id'), primary_key=True)
+    is_math_correct = Column(Boolean, index=True)
+    ambiguous = Column(Boolean, index=True)       # Local parse not trusted alone
+    found_total = Column(Float)
+    calculated_total = Column(Float)
+    method = Column(String)                       # local / llm
+    result_json = Column(JSON)                    # Full check result
+    checked_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class IngestJob(Base):
+    """
+    One file waiting for / going through ingestion (see job_queue.py).
+    queued -> running -> done / failed. A running job belongs to one worker
+    until lease_until; the worker's heartbeat keeps moving it forward, so a
+    job whose lease ran out was interrupted and is claimed again.
+    """
+    __tablename__ = 'ingest_jobs'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    batch_id = Column(String, index=True)         # One upload / one CLI enqueue
+    filename = Column(String)
+    path = Column(String)
+    file_hash = Column(String, index=True)
+    status = Column(String, default="queued")     # queued / running / done / failed
+    attempts = Column(Integer, default=0)         # Claims so far
+    worker_id = Column(String)                    # Lease owner while running
+    lease_until = Column(DateTime)
+    heartbeat_at = Column(DateTime)
+    stage = Column(String)                        # Stage that finished or failed
+    doc_id = Column(String)
+    error = Column(Text)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+    __table_args__ = (
+        # Claim = "oldest queued job, or a running one whose lease expired"
+        Index('ix_ingest_jobs_status_lease', 'status', 'lease_until'),
+    )
+
+class MigrationMarker(Base):
+    """One row per finished one-off migration (see migrations.py)."""
+    __tablename__ = 'migration_markers'
+
+    name = Column(String, primary_key=True)
+    version = Column(Integer, default=1)          # Re-run when the migration's version grows
+    completed_at = Column(DateTime, default=datetime.datetime.utcnow)
 
 # Create Tables
-Base.metadata.create_all(bind=engine)
\ No newline at end of file
+Base.metadata.create_all(bind=engine)
+
+def add_missing_columns(model):
+    """
+    create_all() never alters existing tables. Adds any column declared on
+    the model but missing in the database, plus the model's indexes.
+    """
+    table = model.__table__
+    existing = {c['name'] for c in inspect(engine).get_columns(table.name)}
+    with engine.begin() as conn:
+        for col in table.columns:
+            if col.name not in existing:
+                col_type = col.type.compile(dialect=engine.dialect)
+                conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {col.name} {col_type}")
+        for index in table.indexes:
+            index.create(bind=conn, checkfirst=True)
+
+add_missing_columns(Document)
+add_missing_columns(VendorAlias)
+
+# --- FULL-TEXT INDEX (SQLite FTS5) ---
+# External-content FTS table over documents.filename / text_content, so the
+# text is not stored twice. Triggers keep it in sync with every write path.
+# Keyed on documents.search_rowid, which the insert trigger assigns.
+FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(
+        filename, text_content,
+        content='documents', content_rowid='search_rowid',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS documents_fts_ai AFTER INSERT ON documents BEGIN
+        UPDATE documents SET search_rowid = (SELECT coalesce(max(search_rowid), 0) + 1 FROM documents)
+        WHERE rowid = new.rowid;
+        INSERT INTO documents_fts(rowid, filename, text_content)
+        SELECT search_rowid, filename, text_content FROM documents WHERE rowid = new.rowid;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS documents_fts_ad AFTER DELETE ON documents BEGIN
+        INSERT INTO documents_fts(documents_fts, rowid, filename, text_content)
+        VALUES ('delete', old.search_rowid, old.filename, old.text_content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS documents_fts_au AFTER UPDATE OF filename, text_content ON documents BEGIN
+        INSERT INTO documents_fts(documents_fts, rowid, filename, text_content)
+        VALUES ('delete', old.search_rowid, old.filename, old.text_content);
+        INSERT INTO documents_fts(rowid, filename, text_content)
+        VALUES (new.search_rowid, new.filename, new.text_content);
+    END""",
+]
+FTS_TRIGGERS = ("documents_fts_ai", "documents_fts_ad", "documents_fts_au")
+
+def setup_fulltext_index():
+    with engine.begin() as conn:
+        existing = conn.exec_driver_sql(
+            "SELECT sql FROM sqlite_master WHERE type='table' AND name='documents_fts'"
+        ).scalar()
+        if existing and "content_rowid='search_rowid'" not in existing:
+            # Older index keyed on documents.rowid: drop it and build it again
+            for trigger in FTS_TRIGGERS:
+                conn.exec_driver_sql(f"DROP TRIGGER IF EXISTS {trigger}")
+            conn.exec_driver_sql("DROP TABLE documents_fts")
+            existing = None
+        for stmt in FTS_DDL:
+            conn.exec_driver_sql(stmt)
+        if not existing:
+            # First run on an existing database: key and index the rows we already have
+            conn.exec_driver_sql(
+                "UPDATE documents SET search_rowid = rowid + "
+                "(SELECT coalesce(max(search_rowid), 0) FROM documents) WHERE search_rowid IS NULL"
+            )
+            conn.exec_driver_sql("INSERT INTO documents_fts(documents_fts) VALUES ('rebuild')")
+
+setup_fulltext_index()
+
+# --- VENDOR TRIGRAM INDEX ---
+# Lets "superstore" find the alias "superstoreinc" without scanning.
+# Keyed on vendor_aliases.search_rowid, like documents_fts.
+VENDOR_TRIGRAM_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS vendor_alias_trigrams USING fts5(
+        alias_slug, content='vendor_aliases', content_rowid='search_rowid', tokenize='trigram'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS vendor_alias_trigrams_ai AFTER INSERT ON vendor_aliases BEGIN
+        UPDATE vendor_aliases SET search_rowid = (SELECT coalesce(max(search_rowid), 0) + 1 FROM vendor_aliases)
+        WHERE rowid = new.rowid;
+        INSERT INTO vendor_alias_trigrams(rowid, alias_slug)
+        SELECT search_rowid, alias_slug FROM vendor_aliases WHERE rowid = new.rowid;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS vendor_alias_trigrams_ad AFTER DELETE ON vendor_aliases BEGIN
+        INSERT INTO vendor_alias_trigrams(vendor_alias_trigrams, rowid, alias_slug)
+        VALUES ('delete', old.search_rowid, old.alias_slug);
+    END""",
+]
+VENDOR_TRIGRAM_TRIGGERS = ("vendor_alias_trigrams_ai", "vendor_alias_trigrams_ad")
+
+def setup_vendor_index():
+    with engine.begin() as conn:
+        existing = conn.exec_driver_sql(
+            "SELECT sql FROM sqlite_master WHERE type='table' AND name='vendor_alias_trigrams'"
+        ).scalar()
+        if existing and "content_rowid='search_rowid'" not in existing:
+            # Older index keyed on vendor_aliases.rowid: drop it and build it again
+            for trigger in VENDOR_TRIGRAM_TRIGGERS:
+                conn.exec_driver_sql(f"DROP TRIGGER IF EXISTS {trigger}")
+            conn.exec_driver_sql("DROP TABLE vendor_alias_trigrams")
+            existing = None
+        for stmt in VENDOR_TRIGRAM_DDL:
+            conn.exec_driver_sql(stmt)
+        if not existing:
+            # Key and index the aliases we already have
+            conn.exec_driver_sql(
+                "UPDATE vendor_aliases SET search_rowid = rowid + "
+                "(SELECT coalesce(max(search_rowid), 0) FROM vendor_aliases) WHERE search_rowid IS NULL"
+            )
+            conn.exec_driver_sql("INSERT INTO vendor_alias_trigrams(vendor_alias_trigrams) VALUES ('rebuild')")
+
+setup_vendor_index()
\ No newline at end of file
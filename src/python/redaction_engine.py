@@ -0,0 +1,279 @@
+"""
+Local, rule-based PII redaction (no LLM call).
+
+Emails, phone numbers, IBANs (mod-97 checked), card numbers (Luhn checked),
+tax IDs and the person/company names listed in the document's own
+`parties` field are replaced in one regex pass per string, over both the
+AI JSON and the raw text.
+
+Export the whole corpus, redacted:
+
+    python src/python/redaction_engine.py --out output/redacted.jsonl
+"""
+import argparse
+import json
+import os
+import re
+
+from vendors import normalize_vendor
+
+NAME_TOKEN = "[REDACTED_NAME]"
+CONTACT_TOKEN = "[REDACTED_CONTACT]"
+BANK_TOKEN = "[REDACTED_BANK]"
+TAX_ID_TOKEN = "[REDACTED_TAX_ID]"
+
+# Business data stays visible (same rule as the LLM redaction prompt)
+KEEP_KEYS = {"type", "language", "confidence_score", "vendor", "date", "total_amount", "currency"}
+
+PATTERNS = [
+    ("email", r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+"),
+    ("iban", r"\b[A-Z]{2}\d{2}(?:[ ]?[A-Z0-9]){11,30}\b"),
+    ("card", r"(?<![\d-])\d(?:[ -]?\d){12,18}(?![\d-])"),
+    # "Tax ID: 12-3456789", "VAT No. DE123456789", "NTN 1234567-8": only the value is replaced
+    ("tax_id", r"(?i:\b(?:tax\s*id|vat\s*(?:no|number|id|reg(?:istration)?)|tin|ein|ntn|gstin"
+               r"|ust-?id(?:nr)?|steuer-?nr|steuernummer)\b\.?[\s:#-]*)"
+               r"(?P<tax_value>[A-Z0-9](?:[A-Z0-9/-]| (?=[A-Z0-9])){4,20})"),
+    ("ssn", r"\b\d{3}-\d{2}-\d{4}\b"),
+    # Unlabelled digit groups are only a phone with a "+49" / "(030)" prefix;
+    # "Invoice No 2024 0001 2345" has the same shape
+    ("phone", r"(?<![\w+])(?:\+\d{1,3}[\s.-]?(?:\(\d{1,4}\)[\s.-]?)?|\(\d{1,4}\)[\s.-]?)\d{2,5}(?:[\s.-]\d{2,8}){1,4}(?![\w.,]\d)"),
+    ("labelled_phone", r"(?i:\b(?:tel|phone|mobile|cell|fax|ph)\b\.?[\s:#]*)"
+                       r"(?P<phone_value>\+?(?:\(\d{1,4}\)[\s.-]?)?\d{2,15}(?:[\s.-]\d{2,8}){0,4})(?![\w.,]\d)"),
+]
+
+def _alternation(patterns):
+    return "|".join(f"(?P<{name}>{pattern})" for name, pattern in patterns)
+_MONEY = re.compile(r"[.,]\d{2}$")
+_DATE = re.compile(r"^\d{4}[./-]\d{1,2}[./-]\d{1,2}$|^\d{1,2}[./-]\d{1,2}[./-]\d{2,4}$")
+
+
+def iban_valid(candidate):
+    """ISO 13616 mod-97 check."""
+    iban = candidate.replace(" ", "").upper()
+    if not 15 <= len(iban) <= 34:
+        return False
+    digits = "".join(str(int(c, 36)) for c in iban[4:] + iban[:4])
+    return int(digits) % 97 == 1
+
+
+def longest_valid_iban(candidate):
+    """
+    The IBAN pattern is greedy and can run into the next tokens
+    ("DE89 3704 0044 0532 0130 00 BIC COBADEFFXXX"). Returns the length of
+    the longest prefix, cut at a space, that passes mod-97 (0 if none).
+    """
+    cuts = [len(candidate)] + [i for i in range(len(candidate) - 1, 0, -1) if candidate[i] == " "]
+    for cut in cuts:
+        if iban_valid(candidate[:cut]):
+            return cut
+    return 0
+
+
+def luhn_valid(candidate):
+    digits = [int(c) for c in candidate if c.isdigit()]
+    if not 13 <= len(digits) <= 19:
+        return False
+    total = 0
+    for i, d in enumerate(reversed(digits)):
+        if i % 2:
+            d = d * 2 - 9 if d > 4 else d * 2
+        total += d
+    return total % 10 == 0
+
+
+def _phone_plausible(candidate):
+    candidate = candidate.strip()
+    digits = sum(c.isdigit() for c in candidate)
+    # Dates and amounts ("12 345.67") look like phone numbers too
+    return 7 <= digits <= 15 and not _DATE.match(candidate) and not _MONEY.search(candidate)
+
+
+def _name_pattern(name):
+    words = re.findall(r"\w+", name)
+    if not words:
+        return None
+    variants = [r"\W+".join(map(re.escape, words))]
+    if len(words) == 2:
+        # "Hernandez, Erica"
+        variants.append(re.escape(words[1]) + r",?\s+" + re.escape(words[0]))
+    # Letters/digits may not touch the name, but "_" may ("invoice_Erica Hernandez_6094.pdf")
+    return r"(?<![^\W_])(?:" + "|".join(variants) + r")(?![^\W_])"
+
+
+class RedactionEngine:
+    """
+    One compiled pattern per document: the static PII patterns plus the
+    document's party names. Use RedactionEngine.for_document(ai_data).
+    """
+
+    def __init__(self, names=()):
+        name_patterns = [p for p in map(_name_pattern, sorted(set(names), key=len, reverse=True)) if p]
+        patterns = list(PATTERNS)
+        if name_patterns:
+            # After emails, so "jane.doe@mail.com" goes as one contact, not a name + rest
+            patterns.insert(1, ("name", f"(?i:{'|'.join(name_patterns)})"))
+        self.pattern = re.compile(_alternation(patterns))
+        self.counts = {}
+
+    @classmethod
+    def for_document(cls, ai_data):
+        """Names to redact = the document's parties, minus the vendor itself."""
+        ai_data = ai_data or {}
+        vendor = normalize_vendor(ai_data.get('vendor'))
+        names = []
+        for party in ai_data.get('parties') or []:
+            slug = normalize_vendor(party)
+            if len(slug) < 3 or (vendor and (slug in vendor or vendor in slug)):
+                continue
+            names.append(str(party))
+        return cls(names)
+
+    def _replace(self, match):
+        kind = match.lastgroup
+        text = match.group(kind)
+        prefix = ""
+
+        if kind == "name":
+            token = NAME_TOKEN
+        elif kind == "email":
+            token = CONTACT_TOKEN
+        elif kind == "iban":
+            cut = longest_valid_iban(text)
+            if not cut:
+                return text
+            # Whatever the match ran into stays as it was
+            self.counts[BANK_TOKEN] = self.counts.get(BANK_TOKEN, 0) + 1
+            return BANK_TOKEN + text[cut:]
+        elif kind == "card":
+            if luhn_valid(text):
+                token = BANK_TOKEN
+            elif (match.start() and match.string[match.start() - 1] == "+"
+                  and re.search(r"[\s-]", text) and _phone_plausible(text)):
+                # "+49 170 1234 5678": an international number, not a card
+                token = CONTACT_TOKEN
+            else:
+                return text
+        elif kind == "tax_id":
+            # Labelled: keep "VAT No." and replace only the value
+            prefix = text[:match.start("tax_value") - match.start()]
+            token = TAX_ID_TOKEN
+        elif kind == "ssn":
+            token = TAX_ID_TOKEN
+        elif kind == "labelled_phone":
+            prefix = text[:match.start("phone_value") - match.start()]
+            if not _phone_plausible(match.group("phone_value")):
+                return text
+            token = CONTACT_TOKEN
+        else:
+            if not _phone_plausible(text):
+                return text
+            token = CONTACT_TOKEN
+
+        self.counts[token] = self.counts.get(token, 0) + 1
+        return prefix + token
+
+    def redact_text(self, text):
+        if not text:
+            return text
+        return self.pattern.sub(self._replace, text)
+
+    def redact_json(self, data, key=None):
+        """Redacts every string in a JSON-like structure, except KEEP_KEYS at any level."""
+        if key in KEEP_KEYS:
+            return data
+        if isinstance(data, dict):
+            return {k: self.redact_json(v, k) for k, v in data.items()}
+        if isinstance(data, list):
+            return [self.redact_json(v) for v in data]
+        if isinstance(data, str):
+            return self.redact_text(data)
+        return data
+
+
+def redact_document(ai_data, text_content=None, filename=None):
+    """
+    Redacts one document's JSON, text and filename with the same engine.
+    Returns {"metadata", "text", "filename", "redactions"}.
+    """
+    engine = RedactionEngine.for_document(ai_data)
+    return {
+        "metadata": engine.redact_json(ai_data or {}),
+        "text": engine.redact_text(text_content),
+        "filename": engine.redact_text(filename),
+        "redactions": engine.counts,
+    }
+
+
+def _redact_row(row):
+    doc_id, filename, processed_at, ai_data, text_content = row
+    result = redact_document(ai_data, text_content, filename)
+    result["doc_id"] = doc_id
+    result["processed_at"] = processed_at
+    return result
+
+
+# ==========================================
+# BULK EXPORT
+# ==========================================
+def export_redacted_corpus(out_path, include_text=True, workers=None, batch_size=500,
+                           progress_callback=None, db=None):
+    """
+    Streams every document through the local engine into a JSONL file,
+    one redacted document per line. Returns the number of documents written.
+    Reads go through DatabaseEngine, one unit of work per batch.
+    """
+    # Imported here so pool workers don't open the database on spawn
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+    from db_engine import DatabaseEngine
+
+    db = db or DatabaseEngine()
+    total = db.count_documents()
+    written = 0
+    last_id = None
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    tmp_path = out_path + ".tmp"
+    columns = ("id", "filename", "processed_at", "metadata_json")
+    if include_text:
+        columns += ("text_content",)
+
+    # spawn, not fork: the caller may be a multithreaded server (Streamlit)
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), mp_context=get_context("spawn")) as pool, \
+            open(tmp_path, "w", encoding="utf-8") as out:
+        while True:
+            rows = db.get_document_batch(columns, after_id=last_id, limit=batch_size)
+            if not rows:
+                break
+
+            payload = [
+                (r.id, r.filename, r.processed_at.isoformat() if r.processed_at else None,
+                 r.metadata_json, r.text_content if include_text else None)
+                for r in rows
+            ]
+            for result in pool.map(_redact_row, payload, chunksize=32):
+                if not include_text:
+                    del result["text"]
+                out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            written += len(rows)
+            last_id = rows[-1].id
+            if progress_callback:
+                progress_callback(written, total)
+
+    os.replace(tmp_path, out_path)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export all documents with PII redacted (JSONL)")
+    parser.add_argument("--out", default="output/redacted_corpus.jsonl")
+    parser.add_argument("--no-text", action="store_true", help="Export only the redacted JSON")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+    count = export_redacted_corpus(args.out, not args.no_text, args.workers,
+                                   progress_callback=lambda done, total: print(f"Redacted {done}/{total}", end="\r"))
+    print()
+    print(f"Wrote {count} documents to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Rebuilds the Chroma chunk index from the SQL `documents` table.
+
+Use it when SQL and Chroma drift apart or after changing the embedding
+model / chunking settings:
+
+    python src/python/reindex.py --workers 4
+    python src/python/reindex.py --restart      # ignore an old checkpoint
+
+- Rows are streamed out of SQLite with a keyset cursor (id > last_id).
+- Chunks are embedded in parallel and upserted into a NEW collection.
+- When the pass completes, the live collection pointer is swapped
+  atomically, and rows saved meanwhile are caught up.
+- Progress is checkpointed after every page, so an interrupted run
+  resumes where it stopped.
+"""
+import argparse
+import datetime
+import json
+import os
+import time
+
+from models import Document
+from db_engine import DatabaseEngine
+from vector_index import (
+    DEFAULT_COLLECTION, VectorWriter,
+    get_active_collection_name, set_active_collection_name,
+)
+
+CHECKPOINT_PATH = "./data/reindex_checkpoint.json"
+
+
+def load_checkpoint():
+    try:
+        with open(CHECKPOINT_PATH) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def save_checkpoint(state):
+    tmp_path = CHECKPOINT_PATH + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, CHECKPOINT_PATH)
+
+
+def iter_document_pages(session, after_id=None, since=None, batch_size=200):
+    """
+    Keyset pagination over `documents` ordered by primary key.
+    Only the columns needed for chunking are loaded.
+    Yields lists of rows; `since` limits the scan to rows processed after it.
+    """
+    query = session.query(
+        Document.id, Document.filename, Document.text_content,
+        Document.metadata_json, Document.cpp_metrics
+    )
+    if since is not None:
+        query = query.filter(Document.processed_at >= since)
+
+    last_id = after_id
+    while True:
+        page_query = query
+        if last_id is not None:
+            page_query = page_query.filter(Document.id > last_id)
+        page = page_query.order_by(Document.id).limit(batch_size).all()
+        if not page:
+            return
+        yield page
+        last_id = page[-1].id
+
+
+def reindex(batch_size=200, workers=4, keep_old=False, restart=False):
+    db = DatabaseEngine()
+    client = db.chroma_client
+
+    state = None if restart else load_checkpoint()
+    if state:
+        print(f"Resuming into '{state['collection']}' after id {state['last_id']} "
+              f"({state['indexed']} docs done)")
+    else:
+        state = {
+            "collection": f"{DEFAULT_COLLECTION}_{int(time.time())}",
+            "last_id": None,
+            "indexed": 0,
+            "started_at": datetime.datetime.utcnow().isoformat(),
+        }
+    target = client.get_or_create_collection(state['collection'])
+    started_at = datetime.datetime.fromisoformat(state['started_at'])
+    total = db.sql_db.query(Document.id).count()
+
+    # 1. Main pass (resumable)
+    with VectorWriter(target, workers=workers) as writer:
+        for page in iter_document_pages(db.sql_db, after_id=state['last_id'], batch_size=batch_size):
+            writer.add_entries(db._chunk_entries(doc) for doc in page)
+            writer.flush()  # Page is durable before we move the checkpoint
+            state['last_id'] = page[-1].id
+            state['indexed'] += len(page)
+            save_checkpoint(state)
+            print(f"Indexed {state['indexed']}/{total} documents", end="\r")
+    print()
+
+    # 2. Atomic swap
+    old_name = get_active_collection_name()
+    set_active_collection_name(state['collection'])
+    print(f"Live collection: {old_name} -> {state['collection']}")
+
+    # 3. Catch up on rows saved into the old collection while we were running
+    caught_up = 0
+    with VectorWriter(target, workers=workers) as writer:
+        for page in iter_document_pages(db.sql_db, since=started_at, batch_size=batch_size):
+            writer.add_entries(db._chunk_entries(doc) for doc in page)
+            caught_up += len(page)
+    if caught_up:
+        print(f"Caught up {caught_up} documents saved during the reindex")
+
+    if not keep_old and old_name != state['collection']:
+        try:
+            client.delete_collection(old_name)
+        except Exception as e:
+            print(f"Could not drop old collection {old_name}: {e}")
+
+    os.remove(CHECKPOINT_PATH)
+    db.sql_db.remove()
+    return state['indexed']
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the vector index from SQL")
+    parser.add_argument("--batch-size", type=int, default=200, help="Documents per SQL page")
+    parser.add_argument("--workers", type=int, default=4, help="Parallel embedding threads")
+    parser.add_argument("--keep-old", action="store_true", help="Keep the previous collection")
+    parser.add_argument("--restart", action="store_true", help="Ignore an existing checkpoint")
+    args = parser.parse_args()
+    reindex(args.batch_size, args.workers, args.keep_old, args.restart)
+
+
+if __name__ == "__main__":
+    main()
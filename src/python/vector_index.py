@@ -0,0 +1,116 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import chromadb
+
+VECTOR_DB_PATH = "./data/xentro_vectors"
+DEFAULT_COLLECTION = "doc_chunks"
+
+# One vector per whole document, before chunked indexing; dropped once the
+# chunk backfill has run (migrations.py)
+LEGACY_COLLECTION = "docs"
+
+# Which Chroma collection is live. Swapped atomically (os.replace) by the
+# reindex command, so readers never see a half-built collection.
+ACTIVE_POINTER_PATH = "./data/vector_index.json"
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_chroma_client():
+    """The process-wide Chroma client (opening one is slow, so it is created once)."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = chromadb.PersistentClient(path=VECTOR_DB_PATH)
+        return _client
+
+
+def get_active_collection_name():
+    try:
+        with open(ACTIVE_POINTER_PATH) as f:
+            return json.load(f).get("collection", DEFAULT_COLLECTION)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return DEFAULT_COLLECTION
+
+
+def set_active_collection_name(name):
+    tmp_path = ACTIVE_POINTER_PATH + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"collection": name}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, ACTIVE_POINTER_PATH)
+
+
+class VectorWriter:
+    """
+    Buffers chunk entries and upserts them into Chroma in batches.
+
+    Chroma embeds the texts of each upsert call in one go, so bigger batches
+    mean fewer, fuller embedding runs. With workers > 1, full batches are
+    embedded and written on a thread pool while the caller keeps chunking.
+    """
+
+    def __init__(self, collection, batch_size=256, workers=1):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.written = 0
+        self._ids, self._texts, self._metas = [], [], []
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+        self._futures = []
+
+    def add(self, ids, texts, metadatas):
+        self._ids += ids
+        self._texts += texts
+        self._metas += metadatas
+        while len(self._ids) >= self.batch_size:
+            self._submit(self.batch_size)
+
+    def add_entries(self, entries):
+        """Adds (ids, texts, metadatas) tuples, e.g. from DatabaseEngine._chunk_entries."""
+        for ids, texts, metas in entries:
+            self.add(ids, texts, metas)
+
+    def _submit(self, n):
+        batch = (self._ids[:n], self._texts[:n], self._metas[:n])
+        del self._ids[:n], self._texts[:n], self._metas[:n]
+        if self._executor:
+            self._futures.append(self._executor.submit(self._write, *batch))
+        else:
+            self._write(*batch)
+
+    def _write(self, ids, texts, metas):
+        # upsert (not add) so re-running a batch after a crash is harmless
+        self.collection.upsert(ids=ids, documents=texts, metadatas=metas)
+        with self._lock:
+            self.written += len(ids)
+
+    def flush(self):
+        """Writes everything buffered and waits for in-flight batches. Re-raises write errors."""
+        if self._ids:
+            self._submit(len(self._ids))
+        futures, self._futures = self._futures, []
+        for f in futures:
+            f.result()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self._executor:
+                self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        elif self._executor:
+            self._executor.shutdown(wait=True)
@@ -0,0 +1,162 @@
+import random
+import warnings
+import numpy as np
+
+# Values kept per vendor for the median/MAD estimate (uniform reservoir sample)
+SKETCH_SIZE = 101
+
+# Below this many past invoices a vendor has no usable baseline
+MIN_HISTORY = 3
+
+# |z| above these is an outlier. 3.5 on the robust (MAD) score is the
+# usual Iglewicz-Hoaglin cut-off.
+Z_THRESHOLD = 3.0
+ROBUST_THRESHOLD = 3.5
+
+# MAD -> standard deviation for normally distributed data
+MAD_SCALE = 0.6745
+
+
+def new_stats():
+    return {
+        "count": 0, "mean": 0.0, "m2": 0.0, "min_amount": None, "max_amount": None,
+        "sample": [], "median": None, "mad": None,
+        "last_seen": None, "interval_count": 0, "interval_mean": None,
+    }
+
+
+def update_stats(stats, amount, doc_date=None, rng=random):
+    """
+    Folds one invoice into a vendor's running stats (Welford for mean and
+    variance, reservoir sample for median/MAD). Mutates and returns `stats`.
+    """
+    n = stats['count'] + 1
+    delta = amount - stats['mean']
+    stats['mean'] += delta / n
+    stats['m2'] += delta * (amount - stats['mean'])
+    stats['count'] = n
+    stats['min_amount'] = amount if stats['min_amount'] is None else min(stats['min_amount'], amount)
+    stats['max_amount'] = amount if stats['max_amount'] is None else max(stats['max_amount'], amount)
+
+    sample = list(stats['sample'] or [])
+    if len(sample) < SKETCH_SIZE:
+        sample.append(amount)
+    else:
+        j = rng.randrange(n)
+        if j < SKETCH_SIZE:
+            sample[j] = amount
+    stats['sample'] = sample
+    values = np.asarray(sample)
+    stats['median'] = float(np.median(values))
+    stats['mad'] = float(np.median(np.abs(values - stats['median'])))
+
+    # Billing interval: gaps between consecutive document dates
+    if doc_date is not None:
+        last = stats['last_seen']
+        if last is not None and doc_date > last:
+            gap = (doc_date - last).days
+            k = stats['interval_count'] + 1
+            prev = stats['interval_mean'] or 0.0
+            stats['interval_mean'] = prev + (gap - prev) / k
+            stats['interval_count'] = k
+        if last is None or doc_date > last:
+            stats['last_seen'] = doc_date
+    return stats
+
+
+def leave_one_out(count, mean, m2, amounts):
+    """
+    Mean and sample std of each vendor's history WITHOUT the invoice being
+    scored (it is already part of the stored stats). Vectorized; all
+    arguments are arrays of equal length.
+    """
+    count = np.asarray(count, dtype=float)
+    mean = np.asarray(mean, dtype=float)
+    m2 = np.asarray(m2, dtype=float)
+    amounts = np.asarray(amounts, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        n = count - 1
+        loo_mean = (count * mean - amounts) / n
+        loo_m2 = np.maximum(m2 - (amounts - loo_mean) * (amounts - mean), 0.0)
+        loo_std = np.sqrt(loo_m2 / (n - 1))
+    return n, loo_mean, loo_std
+
+
+def sample_matrix(samples):
+    """Reservoir samples (lists) as one NaN-padded array, one row per sample."""
+    matrix = np.full((len(samples), SKETCH_SIZE), np.nan)
+    for i, sample in enumerate(samples):
+        if sample:
+            matrix[i, :len(sample)] = sample
+    return matrix
+
+
+def leave_one_out_robust(samples, amounts):
+    """
+    Median and MAD of each vendor's reservoir sample WITHOUT the invoice being
+    scored: one copy of its amount is dropped when the sample kept it.
+    samples: sample_matrix() rows, one per amount.
+    """
+    samples = np.array(samples, dtype=float)
+    amounts = np.asarray(amounts, dtype=float)
+    hit = samples == amounts[:, None]
+    samples[hit & (np.cumsum(hit, axis=1) == 1)] = np.nan
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # All-NaN rows -> NaN
+        median = np.nanmedian(samples, axis=1)
+        mad = np.nanmedian(np.abs(samples - median[:, None]), axis=1)
+    return median, mad
+
+
+def score_amounts(amounts, count, mean, m2, samples):
+    """
+    Z-score and robust (median/MAD) z-score for each amount against its
+    vendor's baseline, both without the invoice itself. Returns
+    (z, robust_z, anomaly); NaN where a vendor has fewer than MIN_HISTORY
+    other invoices or no spread.
+    """
+    amounts = np.asarray(amounts, dtype=float)
+    n, loo_mean, loo_std = leave_one_out(count, mean, m2, amounts)
+    median, mad = leave_one_out_robust(samples, amounts)
+    enough = n >= MIN_HISTORY
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = np.where(enough & (loo_std > 0), (amounts - loo_mean) / loo_std, np.nan)
+        robust_z = np.where(enough & (mad > 0), MAD_SCALE * (amounts - median) / mad, np.nan)
+    anomaly = np.fmax(np.abs(z) / Z_THRESHOLD, np.abs(robust_z) / ROBUST_THRESHOLD)
+    return z, robust_z, anomaly
+
+
+def _round(val, digits=2):
+    return None if val is None or not np.isfinite(val) else round(float(val), digits)
+
+
+def summarize(stats, amount=None):
+    """
+    Compact numeric baseline for the LLM audit. If the invoice being audited
+    is given, it is scored against the history without itself.
+    """
+    count = stats['count']
+    std = np.sqrt(stats['m2'] / (count - 1)) if count > 1 else None
+    summary = {
+        "invoices": count,
+        "mean": _round(stats['mean']),
+        "std": _round(std),
+        "median": _round(stats['median']),
+        "mad": _round(stats['mad']),
+        "min": _round(stats['min_amount']),
+        "max": _round(stats['max_amount']),
+        "last_seen": stats['last_seen'].isoformat() if stats['last_seen'] else None,
+        "typical_interval_days": _round(stats['interval_mean'], 1),
+    }
+    if amount is not None:
+        z, robust_z, anomaly = score_amounts(
+            [amount], [count], [stats['mean']], [stats['m2']], sample_matrix([stats['sample']])
+        )
+        summary["current_amount"] = _round(amount)
+        summary["z_score"] = _round(z[0])
+        summary["robust_z_score"] = _round(robust_z[0])
+        summary["is_outlier"] = bool(anomaly[0] > 1) if np.isfinite(anomaly[0]) else None
+        if count - 1 < MIN_HISTORY:
+            summary["note"] = "Too little history for a statistical baseline"
+    return summary
@@ -0,0 +1,42 @@
+import re
+
+UNKNOWN_SLUG = "unknown"
+
+# Dropped from the END of a vendor name when building its canonical slug,
+# so "Super Store Inc." and "Super Store" resolve to the same vendor.
+LEGAL_SUFFIXES = {
+    "inc", "incorporated", "llc", "ltd", "limited", "corp", "corporation",
+    "co", "company", "gmbh", "ag", "plc", "sa", "sarl", "bv", "srl", "pty",
+}
+
+# Longest slug we expand into substrings for "alias inside the query" lookups
+MAX_SUBSTRING_SLUG = 48
+
+
+def normalize_vendor(text):
+    """ "Super Store Inc." -> "superstoreinc" (remove all non-alphanumerics, lowercase) """
+    if not text:
+        return ""
+    return re.sub(r'[^a-z0-9]', '', str(text).lower())
+
+
+def vendor_slug(text):
+    """ "Super Store Inc." -> "superstore" (normalized, legal suffix dropped) """
+    words = re.findall(r'[a-z0-9]+', str(text or '').lower())
+    while len(words) > 1 and words[-1] in LEGAL_SUFFIXES:
+        words.pop()
+    return "".join(words)
+
+
+def is_unknown(text):
+    return normalize_vendor(text) in ("", UNKNOWN_SLUG, "none", "null")
+
+
+def substrings(slug, min_len=3):
+    """All substrings of at least min_len chars (for an indexed IN lookup)."""
+    slug = slug[:MAX_SUBSTRING_SLUG]
+    return {
+        slug[i:j]
+        for i in range(len(slug))
+        for j in range(i + min_len, len(slug) + 1)
+    }